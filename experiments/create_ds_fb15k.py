@@ -1,58 +1,41 @@
 """
-Obsolete since it exceeds working memory.
+Precomputes the graphs of a dataset into sharded GraphStores, so training runs load them instead of building them.
 """
-import torch
-import numpy as np
-from utils.lp_utils import *
-from tqdm import tqdm
+import argparse
+from utils.lp_utils import load_link_prediction_data
+from utils.graph_cache import GraphStore
 
 
-def create_ds_fb15k(n: int, batch_size: int):
+def create_ds_fb15k(n: int, dataset: str='fb15k', sampler: str='consecutive', seed: int=0, rounds: int=1,
+                    use_test_set: bool=False, shard_size: int=2**16, cache_budget: int=2**30):
     """
-    Converts the fb15k dataset into sparse matrix representation.
+    Converts a dataset into compact graphs of n triples, stored under data/graph_cache. Stores which already exist for
+    the same triples and configuration are opened, not rebuilt.
     Args:
         n: Number of triples to be used in one graph.
-        batch_size: Number of graphs to concatenates per batch.
+        sampler: 'consecutive' or 'subgraph', how the training triples are grouped into graphs.
+        rounds: Number of stored samples of the training graphs with the subgraph sampler.
+        cache_budget: Bytes of shards kept in memory per store.
+    Returns:
+        the train and test GraphStore and the entity and relation counts.
     """
-    data_file = 'data/fb15k_n{}_bs{}.pkl'.format(n, batch_size)
+    (n2i, i2n), (r2i, i2r), train, test, _ = load_link_prediction_data(dataset, use_test_set=use_test_set)
+    n_e, n_r = len(i2n), len(i2r)
+    train_store = GraphStore.open(train, n, n_e, n_r, sampler=sampler, seed=seed, rounds=rounds, cache_budget=cache_budget)
+    test_store = GraphStore.open(test, n, n_e, n_r, cache_budget=cache_budget)
+    return train_store, test_store, (n_e, n_r)
 
-    # Check for data folder and eventually create.
-    if not os.path.isdir('data'):
-        os.mkdir('data')
 
-    if os.path.isfile(data_file):
-        with open(data_file, "rb") as fp:
-            print('Loading dataset..')
-            train_set, test_set, dims = pickle.load(fp)
-    else:
-        print('Creating dataset..')
-        (n2i, i2n), (r2i, i2r), train, test, all_triples = load_link_prediction_data('fb15k')
-        d_n = len(n2i)
-        d_e = len(r2i)
-        train_set = list()
-        test_set = list()
-        i = 0
-        pbar = tqdm(total=len(train)+len(test))
-        for (data_in, data_set) in [(train, train_set), (test, test_set)]:
-            while len(data_in) > i * batch_size:
-                batch_a = list()
-                batch_e = list()
-                batch_f = list()
-                for ii in range(batch_size):
-                    pbar.update(1)
-                    a = i*batch_size + ii*n
-                    if a+n > len(data_in):
-                        break
-                    (A, E, F) = triple2matrix(data_in[a:a+n], d_n, d_e)
-                    if A.shape[1] == 1:
-                        print('Weirdo here:', data_in[a:a+n],a)
-                    batch_a.append(A)
-                    batch_e.append(E)
-                    batch_f.append(F)
-                data_set.append([torch.cat(batch_a, dim=0),torch.cat(batch_e, dim=0),torch.cat(batch_f, dim=0)])
-                i += 1
-        pbar.close()
-        dims = (d_n,d_e)
-        with open(data_file, "wb") as fp:
-                pickle.dump([train_set, test_set, dims], fp)
-    return (train_set, test_set, dims)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', dest='n', type=int, default=1)
+    parser.add_argument('--dataset', dest='dataset', type=str, default='fb15k')
+    parser.add_argument('--sampler', dest='sampler', type=str, default='consecutive', choices=['consecutive', 'subgraph'])
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--rounds', dest='rounds', type=int, default=1)
+    parser.add_argument('--final', dest='final', action='store_true', help='Store the test instead of the validation graphs')
+    arguments = parser.parse_args()
+
+    train_store, test_store, dims = create_ds_fb15k(arguments.n, arguments.dataset, arguments.sampler, arguments.seed,
+                                                    arguments.rounds, use_test_set=arguments.final)
+    print('Stored {} train and {} test graphs in {} and {}'.format(len(train_store), len(test_store), train_store.folder, test_store.folder))
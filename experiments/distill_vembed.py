@@ -0,0 +1,159 @@
+"""
+Experiment: Distill a fast DistMult triple scorer from a trained VAE.
+The student is a VLinkPredictor which learns to reproduce the per triple elbo of the teacher on sampled triples.
+"""
+import os, time, json, argparse
+import torch
+import numpy as np
+import torch.nn.functional as F
+from scipy.stats import spearmanr
+from torch_rgvae.GVAE import GVAE
+from torch_rgvae.GCVAE import GCVAE
+from torch_rgvae.VEmbed import VLinkPredictor
+from utils.lp_utils import *
+from tqdm import tqdm, trange
+
+
+def sample_triples(train, n_e: int, n_samples: int, corrupt_rate: float=0.5, seed: int=0):
+    """
+    Samples training triples and corrupts the head or tail of a part of them, so the student also sees low scores.
+    :param train: (N, 3) long tensor of training triples.
+    :param n_samples: number of triples to sample.
+    :param corrupt_rate: fraction of the sampled triples to corrupt.
+    :return: (n_samples, 3) long tensor.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    triples = train[torch.randint(train.size(0), (n_samples,), generator=generator)].clone()
+    corrupt = torch.rand(n_samples, generator=generator) < corrupt_rate
+    column = torch.randint(2, (n_samples,), generator=generator) * 2     # 0 for head, 2 for tail
+    entities = torch.randint(n_e, (n_samples,), generator=generator)
+    rows = torch.nonzero(corrupt).view(-1)
+    triples[rows, column[rows]] = entities[rows]
+    return triples
+
+def teacher_scores(model, triples, batch_size: int, cache_path: str=None):
+    """
+    Scores single triples with the elbo of the teacher VAE, in batches. Higher is better.
+    :param cache_path: .npy file, the scores are loaded from it if it exists and written to it otherwise.
+    :return: (N,) tensor of scores.
+    """
+    if cache_path is not None and os.path.isfile(cache_path):
+        print('Loading teacher scores from {}'.format(cache_path))
+        return torch.from_numpy(np.load(cache_path))
+
+    assert model.n == 2, 'Per triple scores need a model with one triple per graph.'
+    scores = list()
+    with torch.no_grad():
+        model.train(False)
+        for fr in trange(0, triples.size(0), batch_size, desc='Teacher scores'):
+            target = batch_t2m(triples[fr:fr + batch_size].to(d()), 1, model.n_e, model.n_r)
+            scores.append(- model.elbo(target).view(-1).cpu())
+    scores = torch.cat(scores, dim=0)
+
+    if cache_path is not None:
+        np.save(cache_path, scores.numpy())
+    return scores
+
+def distill_vembed(teacher, train, n_e: int, n_r: int, result_dir: str, n_samples: int=2**18, epochs: int=20,
+                   batch_size: int=2**10, teacher_batch: int=2**9, embedding: int=512, lr: float=0.1, holdout: float=0.1, n_speed: int=3):
+    """
+    Trains a VLinkPredictor student to match the per triple elbo of a trained GVAE/GCVAE teacher.
+    :param teacher: trained VAE with one triple per graph.
+    :param train: list, array or tensor of training triples to sample from.
+    :param result_dir: folder for the teacher score cache and the student checkpoint.
+    :param n_samples: number of sampled triples, a fraction holdout of them is kept for the rank correlation.
+    :param teacher_batch: batch size of the teacher scoring.
+    :param n_speed: number of link prediction queries timed for the speedup.
+    :return: dict with the spearman correlation of student and teacher scores and the query time speedup.
+    """
+    train = torch.as_tensor(np.asarray(train), dtype=torch.long)
+    triples = sample_triples(train, n_e, n_samples)
+    cache_path = result_dir + '/teacher_{}_{}.npy'.format(model_digest(teacher)[:16], tensor_digest(triples)[:16])
+    targets = teacher_scores(teacher, triples, teacher_batch, cache_path=cache_path).to(torch.get_default_dtype())
+
+    # The student regresses the standardized teacher scores.
+    mean, std = targets.mean(), targets.std()
+    targets = (targets - mean) / std
+    n_train = int(n_samples * (1. - holdout))
+
+    student = VLinkPredictor(triples, n_e, n_r, embedding=embedding, reciprocal=False).to(d())
+    optimizer = torch.optim.Adagrad(student.parameters(), lr=lr)
+    for epoch in range(epochs):
+        student.train(True)
+        perm = torch.randperm(n_train)
+        sumloss = 0.
+        for fr in range(0, n_train, batch_size):
+            idx = perm[fr:fr + batch_size]
+            sample = triples[idx].to(d())
+            optimizer.zero_grad()
+            out = student(sample[:, 0:1], sample[:, 1:2], sample[:, 2:3]).view(-1)
+            loss = F.mse_loss(out, targets[idx].to(d()))
+            loss.backward()
+            optimizer.step()
+            sumloss += loss.item() * idx.size(0)
+        print('Epoch {}: student mse {:.4}'.format(epoch, sumloss / n_train))
+
+    # Rank correlation on the held out triples.
+    student.train(False)
+    with torch.no_grad():
+        held = triples[n_train:].to(d())
+        out = batch(student, held[:, 0:1], held[:, 1:2], held[:, 2:3], batch_size=batch_size).view(-1)
+    rho = spearmanr(out.numpy(), targets[n_train:].numpy()).correlation
+
+    # Time both models on full link prediction queries, all n_e candidates per base.
+    bases = triples[:n_speed, :2].to(d())
+    with torch.no_grad():
+        teacher.train(False)
+        tic()
+        score_bases(teacher, bases, n_e, n_r, batch_size=teacher_batch, head=False)
+        t_teacher = toc()
+        tic()
+        TopKRetriever(student, n_e).scores(bases, head=False)
+        t_student = toc()
+
+    torch.save({
+        'model_state_dict': student.state_dict(),
+        'n_e': n_e,
+        'n_r': n_r,
+        'embedding': embedding,
+        'reciprocal': False,
+        'teacher_mean': mean.item(),
+        'teacher_std': std.item()},
+        result_dir + '/vembed_distilled.pt')
+
+    results = {'spearman': float(rho), 'teacher_s_per_query': t_teacher / n_speed, 'student_s_per_query': t_student / n_speed,
+               'speedup': t_teacher / max(t_student, 1e-9)}
+    print('Student/teacher spearman {:.4}, {:.1f}x faster per query.'.format(results['spearman'], results['speedup']))
+    return results
+
+
+if __name__ == "__main__":
+
+    my_dtype = torch.float64
+    torch.set_default_dtype(my_dtype)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', dest='model_path', type=str, help='Checkpoint of the teacher VAE, as saved by train_eval_vae')
+    parser.add_argument('--result_dir', dest='result_dir', type=str, default='results/distill')
+    parser.add_argument('--samples_exp2', dest='samples_exp2', type=int, default=18)
+    parser.add_argument('--epochs', dest='epochs', type=int, default=20)
+    arguments = parser.parse_args()
+
+    checkpoint = torch.load(arguments.model_path, map_location=torch.device(d()))
+    args = checkpoint['model_params']
+    (n2i, i2n), (r2i, i2r), train_set, test_set, all_triples = load_link_prediction_data(args['dataset_name'])
+    n_e, n_r = len(n2i), len(r2i)
+
+    if args['model_name'] == 'GCVAE':
+        teacher = GCVAE(args, n_r, n_e, args['dataset_name']).to(d())
+    elif args['model_name'] == 'GVAE':
+        teacher = GVAE(args, n_r, n_e, args['dataset_name']).to(d())
+    else:
+        raise ValueError('{} not defined!'.format(args['model_name']))
+    teacher.load_state_dict(checkpoint['model_state_dict'])
+
+    if not os.path.isdir(arguments.result_dir):
+        os.makedirs(arguments.result_dir)
+    results = distill_vembed(teacher, train_set, n_e, n_r, arguments.result_dir, n_samples=2**arguments.samples_exp2, epochs=arguments.epochs)
+    with open(arguments.result_dir + '/distill_results.json', 'w') as f:
+        json.dump(results, f)
@@ -4,6 +4,7 @@ import numpy as np
 from torch_rgvae.GVAE import GVAE
 from torch_rgvae.GCVAE import GCVAE
 from utils.lp_utils import *
+from utils.entity_store import load_entity_store
 import pickle as pkl
 import wandb
 
@@ -23,34 +24,27 @@ def eval_triple(triples, exist_triples, key_entities):
     return (n_true/len(triples), p_new, new_triples)
             
 
-def eval_generation(model, i2n, i2r, all_triples, n_eval: int=1000, key_type: str='people', n_std=1):
+def eval_generation(model, i2n, i2r, all_triples, n_eval: int=1000, key_type: str='people', n_std=1, batch_size: int=64):
     """
     Experiment: Generate triples from random latent space signals
                 Filter based on if the predicate including the key type
                 Check if subject entity is of key type 
+    :param batch_size: number of signals sampled and decoded at once.
     """
-    with open('data/fb15k/e2t_dict.pkl', 'rb') as f:
-        entity_text_dict = pkl.load(f)   
-
-    with open('data/fb15k/e2type_dict.pkl', 'rb') as f:
-        entity_type_dict = pkl.load(f)
+    entity_store = load_entity_store('fb15k')
+    assert len(entity_store) == len(i2n), 'The entity store is not aligned with the vocabulary'
 
     r2keep = [index for (index,rel) in enumerate(i2r) if key_type in rel]
     all_filt_triples = set()
 
-    for triple in all_triples:
+    for triple in map(tuple, triples_array(all_triples).tolist()):
         if triple[1] in r2keep:
                 all_filt_triples.add(triple)
 
-    n2keep = []
-    n_blacklist = []
-    for n, entity in enumerate(i2n):
-        try:
-            if key_type in entity_type_dict[entity]:
-                n2keep.append(n)
-        except:
-            n_blacklist.append(n)
-            print('No types for: {}'.format(entity_text_dict[entity][0]))
+    n2keep = set(np.nonzero(entity_store.type_mask(key_type))[0].tolist())
+    n_blacklist = np.nonzero(~entity_store.typed_mask())[0]
+    if len(n_blacklist) > 0:
+        print('No types for {} entities: {}'.format(len(n_blacklist), ', '.join(entity_store.texts(n_blacklist[:10]))))
 
     print('From {} entities, {} contain the keyword {}, or {:.3f}%.'.format(len(i2n), len(n2keep), key_type, 100*len(n2keep)/len(i2n)))
     print('From {} predicates, {} contain the keyword {}, or {:.3f}%.'.format(len(i2r), len(r2keep), key_type, 100*len(r2keep)/len(i2r)))
@@ -58,17 +52,24 @@ def eval_generation(model, i2n, i2r, all_triples, n_eval: int=1000, key_type: st
 
     triples = list()
     breaker = 0
+    inconsistent = 0
+    keep = torch.zeros(len(i2r), dtype=torch.bool, device=d())
+    keep[r2keep] = True
     while breaker < n_eval:
-        signal = torch.randn((1, model.z_dim), device=d()) * n_std
-        pred_dense = matrix2triple(model.sample(signal))
-        for i_triple in pred_dense:
-            if i_triple[1] in r2keep:
-                triples.append(i_triple)
-                breaker += 1
+        signal = torch.randn((batch_size, model.z_dim), device=d()) * n_std
+        pred_dense, n_inconsistent = batch_matrix2triple(*model.sample(signal))
+        inconsistent += n_inconsistent.item()
+        # Graph by graph, as if the signals were sampled one at a time.
+        for i_triple in pred_dense[keep[pred_dense[:, 2]], 1:].tolist():
+            if breaker >= n_eval:
+                break
+            triples.append(tuple(i_triple))
+            breaker += 1
+    wandb.log({'inconsistent_edges': inconsistent})
     
     p_true, p_new, new_triples =  eval_triple(triples, all_filt_triples, n2keep)
-    text_triples = translate_triple(triples, i2n, i2r, entity_text_dict)
-    return (p_true, p_new, translate_triple(new_triples, i2n, i2r, entity_text_dict)), text_triples
+    text_triples = translate_triple(triples, i2n, i2r, entity_store)
+    return (p_true, p_new, translate_triple(new_triples, i2n, i2r, entity_store)), text_triples
             
 
 
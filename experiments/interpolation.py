@@ -6,14 +6,39 @@ from torch_rgvae.GVAE import GVAE
 from torch_rgvae.GCVAE import GCVAE
 from torch_rgvae.train_fn import train_sparse_batch
 from utils.lp_utils import *
+from utils.entity_store import load_entity_store
 import pickle as pkl
 
 
+def decode_samples(prediction, i2n, i2r, entity_dict=None):
+    """
+    Decodes a batch of sampled graphs at once.
+    :return: per graph the sampled adjacency (empty if it has no triples) and its text triples, and the number of
+             inconsistent edges of the batch.
+    """
+    triples, inconsistent = batch_matrix2triple(*prediction)
+    triples = triples.cpu()
+    adjacency = prediction[0].detach().cpu()
+    pred_list, text_triples = list(), list()
+    for i in range(adjacency.size(0)):
+        pred_dense = [tuple(t) for t in triples[triples[:, 0] == i, 1:].tolist()]
+        prediction_json = adjacency[i:i+1].numpy().tolist()
+        print(prediction_json)
+        if len(pred_dense) > 0:
+            pred_list.append(prediction_json)
+            text_triple = translate_triple(pred_dense, i2n, i2r, entity_dict)
+            text_triples.append(text_triple)
+            print(text_triple)
+        else:
+            pred_list.append([])
+            text_triples.append([])
+    return pred_list, text_triples, inconsistent.item()
+
+
 def interpolate_triples(i2n, i2r, steps: int=10, model=None, model_path: str=None, i_type: str='confidence95', i_dims: tuple=(0,1,2,3,4,5,6,7,8,9)):
 
     if model.dataset_name == 'fb15k':
-        with open('data/fb15k/e2t_dict.pkl', 'rb') as f:
-            entity_dict = pkl.load(f)
+        entity_dict = load_entity_store('fb15k')
     else:
         entity_dict = None
     
@@ -37,32 +62,19 @@ def interpolate_triples(i2n, i2r, steps: int=10, model=None, model_path: str=Non
     z = model.reparameterize(*model.encode(batch_t2m(model.model_params['obama_mangelo'], int(model.n / 2), model.n_e, model.n_r)))
     z1, z2 = torch.split(z, 1, dim=0)
 
-    pred_list = list()
-    triples = list()
     interpolations = dict()
     interpolations['between2'] = dict()
     interpolations['confidence95'] = {'confi': dict(), 'text': dict()}
+    interpolations['inconsistent_edges'] = 0
+    alphas = torch.arange(steps, device=z.device, dtype=z.dtype).unsqueeze(1)
 
-    # Interpolate between z1 and z2
+    # Interpolate between z1 and z2, all steps are sampled as one batch
     print('Interpolation experiment: ' + i_type)
     step = (z2 - z1) / (steps-1)
-    for i in range(steps):
-        prediction = model.sample(z1 + step*i)
-        prediction_json = prediction[0].detach().cpu().numpy().tolist()
-        print(prediction_json)
-        pred_dense = matrix2triple(prediction)
-        if len(pred_dense) > 0:
-            pred_list.append(prediction_json)
-            text_triple = translate_triple(pred_dense, i2n, i2r, entity_dict)
-            triples.append(text_triple)
-            print(text_triple)
-        else:
-            pred_list.append([])
-            triples.append([])
+    pred_list, triples, inconsistent = decode_samples(model.sample(z1 + step*alphas), i2n, i2r, entity_dict)
     interpolations['between2']['confi'] = pred_list
     interpolations['between2']['text'] = triples
-    pred_list = list()
-    triples = list()
+    interpolations['inconsistent_edges'] += inconsistent
 
     # Interpolating the latent space on the specified dimensions. Assuming a latent standard normal distribution.
     if i_type == 'confidence95':
@@ -70,23 +82,10 @@ def interpolate_triples(i2n, i2r, steps: int=10, model=None, model_path: str=Non
         step = (1.96 * 2) / (steps-1)
         for i_dim in i_dims:
             if i_dim < model.z_dim:
-                pred_list = list()
-                triples = list()
-                z_pred = z1.clone().detach()
-                for i in range(steps):
-                    z_pred[:, i_dim] = -1.96 + step * i
-                    prediction = model.sample(z_pred)
-                    prediction_json = prediction[0].detach().cpu().numpy().tolist()
-                    print(prediction_json)
-                    pred_dense = matrix2triple(prediction)
-                    if len(pred_dense) > 0:
-                        pred_list.append(prediction_json)
-                        text_triple = translate_triple(pred_dense, i2n, i2r, entity_dict)
-                        triples.append(text_triple)
-                        print(text_triple)
-                    else:
-                        pred_list.append([])
-                        triples.append([])
+                z_pred = z1.detach().repeat(steps, 1)
+                z_pred[:, i_dim] = -1.96 + step * alphas.squeeze(1)
+                pred_list, triples, inconsistent = decode_samples(model.sample(z_pred), i2n, i2r, entity_dict)
+                interpolations['inconsistent_edges'] += inconsistent
                 interpolations['confidence95']['confi'][i_dim] = pred_list
                 interpolations['confidence95']['text'][i_dim] = triples       
     return interpolations
@@ -10,30 +10,98 @@ import json
 from datetime import date
 
 
-def link_prediction(model, testsub, truedict, batch_size):
+def link_prediction(model, testsub, truedict, batch_size, workers: int=1, journal_dir: str=None, ci_width: float=None, time_budget: float=None,
+                    domain_range=None, unpruned: bool=True, retriever=None):
     """
     Performs linkpredcition with the given model on the gives data's testset.
     Saves results as json in /data folder.
     :param model: torch VAE model
     :param dataset: name or the dataset
-    :param truedict: collection of true tripples per head+rel/tail+rel set
+    :param truedict: collection of true tripples per head+rel/tail+rel set, truedicts or FilterIndex
     :param batch_size: batch size
+    :param workers: number of processes to shard the testset over, evaluates in process if 1.
+    :param journal_dir: If set, the ranks are journaled in this folder, keyed by the checkpoint and testset hash.
+                        A restarted evaluation skips the journaled queries and the metrics are computed from the journal.
+                        Only supported for the in process, exact evaluation of the full testset, combining it with
+                        workers, ci_width, time_budget, domain_range or retriever raises a ValueError.
+    :param ci_width: If set, evaluate a random subsample of the testset until the confidence intervals of the metrics
+                     are narrower than ci_width or the time_budget in seconds runs out.
+    :param domain_range: DomainRangeIndex, if set only the entities in a relation's domain or range are scored and the
+                         metrics are reported with a 'pruned_' prefix.
+    :param unpruned: If true and domain_range is set, the testset is evaluated without pruning as well.
+    :param retriever: TopKRetriever, if set only its top k candidates per query are reranked with the elbo. Targets outside of
+                      the top k are ranked directly behind it, so the MRR is an upper bound.
     """
 
+    if journal_dir is not None and (workers > 1 or ci_width is not None or time_budget is not None or domain_range is not None
+                                    or retriever is not None):
+        raise ValueError('The rank journal only supports the in process, exact evaluation of the full testset, '
+                         'not workers, ci_width, time_budget, domain_range or retriever.')
+
     n_e = model.n_e
     n_r = model.n_r
 
-    with torch.no_grad():
-
-        model.train(False)
-
-        mrr, hits, ranks = eval(
-            model=model, valset=testsub, truedicts=truedict, n=n_e, r=n_r,
-            batch_size=batch_size, verbose=True, elbo=True)
+    lp_results = dict()
+    if domain_range is not None:
+        with torch.no_grad():
+
+            model.train(False)
+
+            acc = RankAccumulator(2 * testsub.shape[0], n_r)
+            mrr, hits, ranks = eval(
+                model=model, valset=testsub, truedicts=truedict, n=n_e, r=n_r,
+                batch_size=batch_size, verbose=True, elbo=True, candidates=domain_range, accumulator=acc)
+        coverage = acc.snapshot()['coverage']
+        print(f'Pruned: MRR {mrr:.4}\t hits@1 {hits[0]:.4}\t  hits@3 {hits[1]:.4}\t  hits@10 {hits[2]:.4}\t coverage {coverage:.4}')
+        lp_results.update({'pruned_mrr': mrr, 'pruned_h@1': hits[0], 'pruned_h@3': hits[1], 'pruned_h@10': hits[2],
+                           'pruned_coverage': coverage, 'pruned_candidates': domain_range.pruning()})
+        if not unpruned:
+            return lp_results
+
+    if ci_width is not None or time_budget is not None:
+        with torch.no_grad():
+
+            model.train(False)
+
+            mrr, hits, ranks, info = eval_sequential(
+                model=model, valset=testsub, truedicts=truedict, n=n_e, r=n_r, ci_width=ci_width if ci_width is not None else 0.,
+                time_budget=time_budget, batch_size=batch_size, verbose=True, elbo=True, candidates=retriever)
+        print('Used {} queries in {:.1f}s, 95% intervals: {}'.format(info['n_queries'], info['time'], info['ci']))
+        lp_results.update({'n_queries': info['n_queries'], 'converged': info['converged']})
+        lp_results.update({'{}_ci'.format(metric): list(ci) for metric, ci in info['ci'].items()})
+        wandb.log({'MRR': mrr, 'Hits_1': hits[0], 'Hits_3': hits[1], 'Hits_10': hits[2], 'n_queries': info['n_queries']})
+    elif workers > 1:
+        mrr, hits, ranks, _ = eval_sharded(
+            model=model, valset=testsub, truedicts=truedict, n=n_e, r=n_r, workers=workers,
+            batch_size=batch_size, verbose=True, elbo=True, candidates=retriever)
+        wandb.log({'MRR': mrr, 'Hits_1': hits[0], 'Hits_3': hits[1], 'Hits_10': hits[2]})
+    elif journal_dir is not None:
+        journal_path = journal_dir + '/lp_{}_{}.journal'.format(model_digest(model)[:16], tensor_digest(testsub)[:16])
+        journal = RankJournal(journal_path, testsub.shape[0])
+        acc = journal.accumulator(testsub, n_r)
+        skip = acc.ranks.view(2, -1) > 0
+        print('Resuming from {}, {} of {} queries done.'.format(journal_path, int(skip.sum()), skip.numel()))
+
+        with torch.no_grad():
+
+            model.train(False)
+
+            eval(model=model, valset=testsub, truedicts=truedict, n=n_e, r=n_r,
+                 batch_size=batch_size, verbose=True, elbo=True, accumulator=acc, skip=skip, callback=journal.append)
+
+        mrr, hits, ranks = journal.accumulator(testsub, n_r).results()
+    else:
+        with torch.no_grad():
+
+            model.train(False)
+
+            mrr, hits, ranks = eval(
+                model=model, valset=testsub, truedicts=truedict, n=n_e, r=n_r,
+                batch_size=batch_size, verbose=True, elbo=True, candidates=retriever)
 
     print(f'MRR {mrr:.4}\t hits@1 {hits[0]:.4}\t  hits@3 {hits[1]:.4}\t  hits@10 {hits[2]:.4}')
 
-    lp_results = {'mrr': mrr, 'h@1': hits[0], 'h@3': hits[1], 'h@10': hits[2]}
+    lp_results.update({'mrr': mrr, 'h@1': hits[0], 'h@3': hits[1], 'h@10': hits[2]})
     return lp_results
 
 
@@ -62,8 +130,8 @@ if __name__ == "__main__":
     n_e = len(n2i)
     n_r = len(r2i)
 
-    testsub = torch.tensor(test_set)
-    truedict = truedicts(all_triples)
+    testsub = torch.tensor(test_set, dtype=torch.long)
+    truedict = load_filter_index(dataset, all_triples, n_e, n_r)
 
     # Initialize model.
     model = GCVAE(n*2, n_r, n_e).to(device)
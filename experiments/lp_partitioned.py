@@ -0,0 +1,101 @@
+"""
+Experiment: Train the VEmbed link predictor with entity embeddings partitioned on disk, for graphs that do not fit in memory.
+"""
+import os, random, argparse
+import numpy as np
+import torch, wandb
+from torch_rgvae.VPartition import BucketedTriples, PartitionedEmbeddings, adagrad_
+from experiments.lp_vembed import fused_step
+from utils.lp_utils import d, tic, toc, load_link_prediction_data, truedicts
+from utils.embed_util import eval
+
+
+def train_lp_partitioned(n_e: int, n_r: int, train, test, alltriples, beta: float, epochs: int, batch_size: int, result_dir: str,
+                         n_buckets: int=4, embedding: int=512, lr: float=0.1, test_batch: int=5, eval_int: int=3, evaluate: bool=True, seed: int=0):
+    """
+    Trains a VLinkPredictor one (bucket_i, bucket_j) edge block at a time, with only the two partitions of the block resident.
+    Negatives are drawn from the entities of the block. The partitions, the relations and their Adagrad states are
+    written back after every block and the embedding folder records the progress, an interrupted run resumes from the
+    next block. The block order of an epoch only depends on the seed and the epoch, so it is the same after a resume.
+    :param train: (N, 3) array of training triples, may be memory mapped.
+    :param n_buckets: number of entity buckets, there are up to n_buckets**2 edge blocks.
+    :param evaluate: If true, every eval_int epochs the partitions are assembled into one model and evaluated,
+                     only possible if the full entity table fits in memory.
+    :return: list of the test MRRs.
+    """
+    negative_rate = [10, 0, 10]
+    store_dir, embed_dir = result_dir + '/triples', result_dir + '/embeddings'
+    result_file = result_dir + '/lp_log.txt'
+
+    if os.path.isfile(os.path.join(store_dir, 'meta.json')):
+        store = BucketedTriples(store_dir)
+        assert store.n_buckets == n_buckets, f'{store_dir} has {store.n_buckets} buckets, not {n_buckets}'
+    else:
+        store = BucketedTriples.build(train, n_e, n_buckets, store_dir)
+    if os.path.isfile(os.path.join(embed_dir, 'meta.json')):
+        embeddings = PartitionedEmbeddings(embed_dir)
+        print('Resuming from epoch {}, block {}.'.format(embeddings.meta['epoch'] + 1, embeddings.meta.get('block', 0)))
+    else:
+        embeddings = PartitionedEmbeddings.create(embed_dir, n_e, n_r, embedding, n_buckets, seed=seed)
+
+    truedict = truedicts(alltriples) if evaluate else None
+    test = torch.tensor(test, dtype=torch.long).to(d())
+    test_mrrs = []
+
+    for e in range(embeddings.meta['epoch'] + 1, epochs):
+        blocks = store.blocks()
+        random.Random(seed + e).shuffle(blocks)
+        done = embeddings.meta.get('block', 0) if e == embeddings.meta['epoch'] + 1 else 0
+        seen, sumloss = 0, 0.
+        tic()
+        for k in range(done, len(blocks)):
+            i, j = blocks[k]
+            model, state = embeddings.load(i, j)
+            model.train(True)
+            candidates = embeddings.candidates(i, j)
+            local = embeddings.localize(torch.from_numpy(np.array(store.block(i, j))), i, j)
+            perm = torch.randperm(local.size(0))
+            for fr in range(0, local.size(0), batch_size):
+                positives = local[perm[fr:fr + batch_size]]
+                model.zero_grad()
+                loss, _ = fused_step(model, positives, negative_rate, beta, model.n, n_r, candidates=candidates)
+                adagrad_(model.encoder.e_embed.weight, state['entities'], lr)
+                adagrad_(model.encoder.r_embed.weight, state['relations'], lr)
+                seen += positives.size(0)
+                sumloss += loss * positives.size(0)
+            embeddings.store(model, state, i, j)
+            embeddings.save(e - 1, block=k + 1)
+        embeddings.save(e)
+        print(f'epoch {e}: {len(blocks)} blocks, loss {sumloss / max(seen, 1):.4}, {seen / toc():.1f} triples/s')
+
+        if evaluate and (((e+1) % eval_int == 0) or e == epochs - 1):
+            with torch.no_grad():
+                model = embeddings.to_vlinkpredictor().to(d()).train(False)
+                mrr, hits, ranks = eval(model=model, valset=test, truedicts=truedict, n=n_e, batch_size=test_batch, verbose=True)
+            with open(result_file, 'a+') as f:
+                print(f'epoch {e}: MRR {mrr:.4}\t hits@1 {hits[0]:.4}\t  hits@3 {hits[1]:.4}\t  hits@10 {hits[2]:.4}', file=f)
+            print(f'epoch {e}: MRR {mrr:.4}\t hits@1 {hits[0]:.4}\t  hits@3 {hits[1]:.4}\t  hits@10 {hits[2]:.4}')
+            wandb.log({"mrr": mrr, "h@1": hits[0], "h@3": hits[1], "h@10": hits[2]})
+            test_mrrs.append(mrr)
+    return test_mrrs
+
+
+if __name__ == "__main__":
+
+    my_dtype = torch.float64
+    torch.set_default_dtype(my_dtype)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', dest='dataset', type=str, default='fb15k')
+    parser.add_argument('--result_dir', dest='result_dir', type=str, default='results/lp_partitioned')
+    parser.add_argument('--buckets', dest='buckets', type=int, default=4)
+    parser.add_argument('--epochs', dest='epochs', type=int, default=30)
+    parser.add_argument('--batch_size_exp2', dest='batch_size_exp2', type=int, default=12)
+    arguments = parser.parse_args()
+
+    wandb.init(project="offline-dev", mode='offline')
+    (n2i, i2n), (r2i, i2r), train_set, test_set, all_triples = load_link_prediction_data(arguments.dataset)
+    if not os.path.isdir(arguments.result_dir):
+        os.makedirs(arguments.result_dir)
+    train_lp_partitioned(len(n2i), len(r2i), train_set, test_set, all_triples, beta=1., epochs=arguments.epochs,
+                         batch_size=2**arguments.batch_size_exp2, result_dir=arguments.result_dir, n_buckets=arguments.buckets)
@@ -1,7 +1,6 @@
 from torch_rgvae.VEmbed import VLinkPredictor
-from utils.lp_utils import d, tic, toc, get_slug, load_link_prediction_data, truedicts
-from utils.embed_util import util
-from ranger import Ranger
+from utils.lp_utils import d, tic, toc, get_slug, load_link_prediction_data, truedicts, triples_array, gather_results
+from utils.embed_util import eval
 
 import torch, wandb
 
@@ -9,7 +8,7 @@ from torch import nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 
-import random, sys, tqdm, math, random, os
+import random, sys, tqdm, math, random, os, time, copy
 from datetime import date
 
 from tqdm import trange
@@ -55,24 +54,214 @@ def corrupt_one(batch, candidates, target):
     Corrupts the negatives of a batch of triples (in place).
     Corrupts either only head or only tails
     :param batch_size:
-    :param n: nr of nodes in the graph
+    :param candidates: tensor of the entities to draw corruptions from
     :param target: 0 for head, 1 for predicate, 2 for tail
     :return:
     """
     bs, ns, _ = batch.size()
 
     # new entities to insert
-    #corruptions = torch.randint(size=(bs * ns,),low=0, high=n, dtype=torch.long, device=d(batch))
-    corruptions = torch.tensor(random.choices(candidates, k=bs*ns),  dtype=torch.long, device=d(batch)).view(bs, ns)
+    candidates = torch.as_tensor(candidates, dtype=torch.long, device=d(batch))
+    corruptions = candidates[torch.randint(candidates.size(0), (bs, ns), device=d(batch))]
 
     batch[:, :, target] = corruptions
 
+def draw_corruptions(bs, ng, ctarget, n_e, n_r, candidates=None, device=None):
+    """
+    :return: (bs, ng) corruptions of the target 0 (head), 1 (relation) or 2 (tail), from the candidates of the target if given.
+    """
+    if candidates is not None:
+        cand = candidates[ctarget]
+        return cand[torch.randint(cand.size(0), (bs, ng), device=device)]
+    return torch.randint(n_r if ctarget == 1 else n_e, (bs, ng), device=device)
+
+def target_loss(out, labels, mean, logvar, beta, weight=None):
+    """
+    Loss of the scores of the positives and the corruptions of one target, with the kl term of the scored objects.
+    :return: the loss and its reconstruction part.
+    """
+    out = F.sigmoid(out)
+    recon_loss = F.binary_cross_entropy_with_logits(out, labels, weight=weight)
+    reg_loss = kl_divergence(mean, logvar)
+    return torch.mean(beta * reg_loss - recon_loss), recon_loss
+
+def negative_batch(positives, negative_rate, n_e, n_r, candidates=None):
+    """
+    Draws the corruptions for all targets of a batch at once.
+    Column 0 holds the positives, followed by negative_rate[0] head, negative_rate[1] relation and negative_rate[2] tail
+    corruptions. An index which is never corrupted is kept as (bs, 1), so the decoder can broadcast it late.
+    :param positives: (bs, 3) tensor of true triples.
+    :param negative_rate: number of corruptions per target, [head, relation, tail].
+    :param candidates: tuple of tensors to draw head, relation and tail corruptions from, all if None.
+    :return: s, p, o index tensors and the bce labels, (bs, 1 + sum(negative_rate)).
+    """
+    bs = positives.size(0)
+    total = 1 + sum(negative_rate)
+    spo = list()
+    col = 1
+    for ctarget, ng in enumerate(negative_rate):
+        index = positives[:, ctarget:ctarget+1]
+        if ng > 0:
+            corruptions = draw_corruptions(bs, ng, ctarget, n_e, n_r, candidates, device=d(positives))
+            index = index.expand(bs, total).clone()
+            index[:, col:col+ng] = corruptions
+            col += ng
+        spo.append(index)
+
+    labels = torch.zeros(bs, total, device=d(positives))
+    labels[:, 0] = 1.
+    return spo[0], spo[1], spo[2], labels
+
+def loop_step(model, positives, negative_rate, beta, n_e, n_r, candidates=None, weight=None, log=True):
+    """
+    One forward and backward pass per corrupted target, the gradients accumulate over the targets.
+    The optimizer step is left to the caller.
+    :param weight: bce weights of the (bs, 1 + sum(negative_rate)) scores of negative_batch.
+    :return: the loss summed over the targets and the prep, forward, loss and backward times.
+    """
+    tprep = tforward = tloss = tbackward = 0.
+    bs = positives.size(0)
+    total, col = 0., 1
+    for ctarget, ng in enumerate(negative_rate):    # which part of the triple to corrupt
+        if ng == 0:
+            continue
+        tic()
+        with torch.no_grad():
+            corruptions = draw_corruptions(bs, ng, ctarget, n_e, n_r, candidates, device=d(positives))
+            spo = [positives[:, 0:1], positives[:, 1:2], positives[:, 2:3]]
+            spo[ctarget] = torch.cat([spo[ctarget], corruptions], dim=1)
+            labels = torch.cat([torch.ones(bs, 1, device=d(positives)), torch.zeros(bs, ng, device=d(positives))], dim=1)
+        tprep += toc()
+
+        # -- NB: two of the index vectors s, p o are now size (bs, 1) and the other is (bs, ng+1)
+        #    We will let the model broadcast these to give us a score tensor of (bs, ng+1)
+        tic()
+        out = model.forward(*spo)
+        tforward += toc()
+        assert out.size() == (bs, ng + 1), f'{out.size()=} {(bs, ng + 1)=}'
+
+        tic()
+        cols = [0] + list(range(col, col + ng))
+        loss, recon_loss = target_loss(out, labels, model.encoder.mean, model.encoder.logvar, beta,
+                                       None if weight is None else weight[:, cols])
+        assert not torch.isnan(loss), 'Loss has become NaN'
+        if log:
+            wandb.log({"recon_loss": recon_loss, "loss": loss.item()})
+        total += float(loss.item())
+        col += ng
+        tloss += toc()
+
+        tic()
+        loss.backward()
+        tbackward += toc()
+    return total, (tprep, tforward, tloss, tbackward)
+
+def fused_step(model, positives, negative_rate, beta, n_e, n_r, candidates=None, weight=None, log=True):
+    """
+    Scores the positives and all their corruptions in a single forward pass and does a single backward pass.
+    The loss is that of loop_step: the sum over the corrupted targets of the loss of the positives with the corruptions
+    of that target, and the kl term of the objects loop_step scores for it. For the same random state both draw the
+    same corruptions, in eval mode they give the same loss and gradients.
+    The optimizer step is left to the caller.
+    :return: the loss and the prep, forward, loss and backward times.
+    """
+    tic()
+    with torch.no_grad():
+        s, p, o, labels = negative_batch(positives, negative_rate, n_e, n_r, candidates=candidates)
+    tprep = toc()
+
+    tic()
+    out = model.forward(s, p, o)
+    tforward = toc()
+    assert out.size() == labels.size(), f'{out.size()=} {labels.size()=}'
+    # the embeddings of the objects, they are encoded last
+    mean, logvar = model.encoder.mean, model.encoder.logvar
+
+    tic()
+    loss = recon_loss = 0.
+    col = 1
+    for ctarget, ng in enumerate(negative_rate):
+        if ng == 0:
+            continue
+        cols = torch.tensor([0] + list(range(col, col + ng)), device=d(positives))
+        # loop_step scores the corrupted objects of a tail pass, and only the positive object otherwise
+        ocols = cols if ctarget == 2 else cols[:1]
+        target, recon = target_loss(out[:, cols], labels[:, cols], mean[:, ocols], logvar[:, ocols], beta,
+                                    None if weight is None else weight[:, cols])
+        loss, recon_loss = loss + target, recon_loss + recon
+        col += ng
+    assert not torch.isnan(loss), 'Loss has become NaN'
+    if log:
+        wandb.log({"recon_loss": recon_loss, "loss": loss.item()})
+    tloss = toc()
+
+    tic()
+    loss.backward()
+    tbackward = toc()
+    return float(loss.item()), (tprep, tforward, tloss, tbackward)
+
 def prt(to_p, end='\n'):
     print(to_p + end)
 
-def train_lp_vembed(n_e, n_r, train, test, alltriples, beta: int, epochs: int, batch_size: int, result_dir: str, test_batch: int=5, eval_int: int=3):
+def make_optimizer(model, opt: str='adagrad', lr: float=0.15953749294870845):
+    """
+    Optimizer for the link predictor.
+    :param opt: 'adagrad' works with dense and sparse gradients, 'sparse_adam' needs a model with sparse embeddings
+                and 'adam' a dense one.
+    """
+    if opt == 'adagrad':
+        return torch.optim.Adagrad(model.parameters(), lr=lr)
+    elif opt == 'sparse_adam':
+        assert model.sparse, 'SparseAdam needs sparse embedding gradients'
+        return torch.optim.SparseAdam(list(model.parameters()), lr=lr)
+    elif opt == 'adam':
+        assert not model.sparse, 'Adam does not support sparse gradients, use sparse_adam'
+        return torch.optim.Adam(model.parameters(), lr=lr)
+    else:
+        raise Exception(f'Optimizer {opt} not recognized')
+
+def benchmark_vembed(n_e, n_r, train, batch_size: int=2**12, steps: int=50, negatives: int=10, embedding: int=512, opts=('adagrad', 'sparse_adam'),
+                     beta: float=1.):
+    """
+    Measures the training throughput of the per target loop and the fused step, with the dense and the sparse
+    embedding tables. Every step corrupts the heads and the tails of a batch of positives and does one optimizer step.
+    :param train: (N, 3) long tensor of training triples.
+    :param opts: optimizers for the sparse model, the dense model always uses adagrad.
+    :return: dict of setting -> triples per second, the settings are named like 'sparse_adagrad_fused'.
+    """
+    results = dict()
+    negative_rate = [negatives, 0, negatives]
+    settings = [('dense_adagrad', False, 'adagrad')] + [('sparse_' + opt, True, opt) for opt in opts]
+    for name, sparse, opt in settings:
+        for mode, step_fn in [('loop', loop_step), ('fused', fused_step)]:
+            model = VLinkPredictor(train, n_e, n_r, embedding=embedding, reciprocal=True, sparse=sparse).to(d())
+            optimizer = make_optimizer(model, opt, lr=0.1 if opt == 'adagrad' else 1e-3)
+            model.train(True)
+            seen = 0
+            for step in range(steps + 1):
+                if step == 1:       # the first step warms up the allocator and the optimizer state
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
+                    tic()
+                positives = train[torch.randint(train.size(0), (batch_size,))].to(d())
+                optimizer.zero_grad()
+                step_fn(model, positives, negative_rate, beta, n_e, n_r, log=False)
+                optimizer.step()
+                seen += batch_size if step > 0 else 0
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            results[f'{name}_{mode}'] = seen / toc()
+        print(f'{name}: loop {results[name + "_loop"]:.1f}, fused {results[name + "_fused"]:.1f} triples/s')
+    return results
+
+def train_lp_vembed(n_e, n_r, train, test, alltriples, beta: int, epochs: int, batch_size: int, result_dir: str, test_batch: int=5, eval_int: int=3,
+                    sparse: bool=False, opt: str='adagrad', fused: bool=True):
     """
     Source: pbloem/embed
+    :param sparse: If true, the embeddings have sparse gradients and a step only updates the rows of the batch.
+    :param opt: optimizer, 'adagrad', 'sparse_adam' (sparse only) or 'adam' (dense only).
+    :param fused: If true, all corruptions of a batch are scored in one forward and backward pass, otherwise
+                  in one pass per corrupted target. The time per step of either is printed after the first epoch.
     """
     # Fix some hyperparameters
     repeats = 1
@@ -94,7 +283,7 @@ def train_lp_vembed(n_e, n_r, train, test, alltriples, beta: int, epochs: int, b
     lr = 1e-4
     k = 11
 
-    model = VLinkPredictor(torch.tensor(list(alltriples)), n_e, n_r, embedding=512, decoder='distmult', edropout=None, rdropout=None, init=0.85, biases=False, init_method='uniform', init_parms=(-1.0, 1.0), reciprocal=reciprocal)
+    model = VLinkPredictor(torch.as_tensor(triples_array(alltriples)), n_e, n_r, embedding=512, decoder='distmult', edropout=None, rdropout=None, init=0.85, biases=False, init_method='uniform', init_parms=(-1.0, 1.0), reciprocal=reciprocal, sparse=sparse)
     wandb.watch(model)
 
     tbw = SummaryWriter(log_dir=result_dir)
@@ -102,8 +291,8 @@ def train_lp_vembed(n_e, n_r, train, test, alltriples, beta: int, epochs: int, b
 
     test_mrrs = []
     truedict = truedicts(alltriples)
-    train = torch.tensor(train).to(d())
-    test = torch.tensor(test).to(d())
+    train = torch.tensor(train, dtype=torch.long).to(d())
+    test = torch.tensor(test, dtype=torch.long).to(d())
 
     subjects   = torch.tensor(list({s for s, _, _ in train}), dtype=torch.long, device=d())
     predicates = torch.tensor(list({p for _, p, _ in train}), dtype=torch.long, device=d())
@@ -128,7 +317,7 @@ def train_lp_vembed(n_e, n_r, train, test, alltriples, beta: int, epochs: int, b
         # elif arg.opt == 'adamw':
         #     opt = torch.optim.AdamW(model.parameters(), lr=arg.lr)
         # elif arg.opt == 'adagrad':
-        optimizer = torch.optim.Adagrad(model.parameters(), lr=0.15953749294870845)
+        optimizer = make_optimizer(model, opt)
         # elif arg.opt == 'sgd':
         #     opt = torch.optim.SGD(model.parameters(), lr=arg.lr, nesterov=True, momentum=arg.momentum)
         # else:
@@ -148,6 +337,7 @@ def train_lp_vembed(n_e, n_r, train, test, alltriples, beta: int, epochs: int, b
             tforward = tbackward = 0
             rforward = rbackward = 0
             tprep = tloss = 0
+            tstep, steps = 0.0, 0
             tic()
 
             for fr in trange(0, train.size(0), batch_size):
@@ -159,78 +349,20 @@ def train_lp_vembed(n_e, n_r, train, test, alltriples, beta: int, epochs: int, b
 
                 positives = train[fr:to].to(d())
 
-                for ctarget in [0, 1, 2]: # which part of the triple to corrupt
-                    ng = negative_rate[ctarget]
-
-                    if ng > 0:
-
-                        with torch.no_grad():
-                            bs, _ = positives.size()
-
-                            tic()
-                            if limit_negatives:
-                                cand = ccandidates[ctarget]
-                                mx = cand.size(0)
-                                idx = torch.empty(bs, ng, dtype=torch.long, device=d()).random_(0, mx)
-                                corruptions = cand[idx]
-                            else:
-                                mx = n_r if ctarget == 1 else n_e
-                                corruptions = torch.empty(bs, ng, dtype=torch.long, device=d()).random_(0, mx)
-                            tprep += toc()
-
-                            s, p, o = positives[:, 0:1], positives[:, 1:2], positives[:, 2:3]
-                            if ctarget == 0:
-                                s = torch.cat([s, corruptions], dim=1)
-                            if ctarget == 1:
-                                p = torch.cat([p, corruptions], dim=1)
-                            if ctarget == 2:
-                                o = torch.cat([o, corruptions], dim=1)
-
-                            # -- NB: two of the index vectors s, p o are now size (bs, 1) and the other is (bs, ng+1)
-                            #    We will let the model broadcast these to give us a score tensor of (bs, ng+1)
-                            #    In most cases we can optimize the decoder to broadcast late for better speed.
-
-                            if loss_fn == 'bce':
-                                labels = torch.cat([torch.ones(bs, 1, device=d()), torch.zeros(bs, ng, device=d())], dim=1)
-                            elif loss_fn == 'ce':
-                                labels = torch.zeros(bs, dtype=torch.long, device=d())
-                                # -- CE loss treats the problem as a multiclass classification problem: for a positive triple,
-                                #    together with its k corruptions, identify which is the true triple. This is always triple 0.
-                                #    (It may seem like the model could easily cheat by always choosing triple 0, but the score
-                                #    function is order equivariant, so it can't choose by ordering.)
-
-                        recip = None if not reciprocal else ('head' if ctarget == 0 else 'tail')
-                        # -- We use the tail relations if the target is the relation (usually p-corruption is not used)
-
-                        tic()
-                        out = model.forward(s, p, o)
-                        tforward += toc()
-
-                        assert out.size() == (bs, ng + 1), f'{out.size()=} {(bs, ng + 1)=}'
-
-                        tic()
-                        if loss_fn == 'bce':
-                            out = F.sigmoid(out)
-                            recon_loss = F.binary_cross_entropy_with_logits(out, labels, weight=weight)
-                            wandb.log({"recon_loss": recon_loss})
-                            reg_loss = kl_divergence(model.encoder.mean, model.encoder.logvar)
-                            loss = torch.mean(beta * reg_loss - recon_loss)
-                        # elif loss_fn == 'ce':
-                        #     loss = F.cross_entropy(out, labels)
-                        wandb.log({"loss": loss.item()})
-                        assert not torch.isnan(loss), 'Loss has become NaN'
-
-                        sumloss += float(loss.item())
-                        seen += bs; seeni += bs
-                        tloss += toc()
-
-                        tic()
-                        loss.backward()
-                        tbackward += toc()
-                        # No step yet, we accumulate the gradients over all corruptions.
-                        # -- this causes problems with modules like batchnorm, so be careful when porting.
-
                 tic()
+                if fused:
+                    loss, (tp, tf, tl, tb) = fused_step(model, positives, negative_rate, beta, n_e, n_r,
+                                                        candidates=ccandidates if limit_negatives else None, weight=weight)
+                else:
+                    # -- No step yet, we accumulate the gradients over all corruptions.
+                    #    this causes problems with modules like batchnorm, so be careful when porting.
+                    loss, (tp, tf, tl, tb) = loop_step(model, positives, negative_rate, beta, n_e, n_r,
+                                                       candidates=ccandidates if limit_negatives else None, weight=weight)
+                tprep += tp; tforward += tf; tloss += tl; tbackward += tb
+                sumloss += loss
+                seen += positives.size(0); seeni += positives.size(0)
+
+                # tic()
                 regloss = None
                 # if reg_eweight is not None:
                 #     regloss = model.penalty(which='entities', p=reg_exp, rweight=reg_eweight)
@@ -247,10 +379,13 @@ def train_lp_vembed(n_e, n_r, train, test, alltriples, beta: int, epochs: int, b
                 # rbackward += toc()
 
                 optimizer.step()
+                tstep += toc()
+                steps += 1
 
             if e == 0:
-                print('\n pred: forward {tforward:.4}, backward {tbackward:.4}')
+                print(f'\n pred: forward {tforward:.4}, backward {tbackward:.4}')
                 print (f'           prep {tprep:.4}, loss {tloss:.4}')
+                print (f' per step: {tstep / steps:.4} ({"fused" if fused else "loop"})')
                 print (f' total: {toc():.4}')
                 # -- NB: these numbers will not be accurate for GPU runs unless CUDA_LAUNCH_BLOCKING is set to 1
 
@@ -266,7 +401,7 @@ def train_lp_vembed(n_e, n_r, train, test, alltriples, beta: int, epochs: int, b
                     else:
                         testsub = test[random.sample(range(test.size(0)), k=eval_size)]
 
-                    mrr, hits, ranks = util.eval(
+                    mrr, hits, ranks = eval(
                         model=model, valset=testsub, truedicts=truedict, n=n_e, batch_size=test_batch, verbose=True)
 
                     # if check_simple: # double-check using a separate, slower implementation
@@ -292,8 +427,137 @@ def train_lp_vembed(n_e, n_r, train, test, alltriples, beta: int, epochs: int, b
         print('training finished.', file=f)
     print('training finished.')
 
+    torch.save({
+        'model_state_dict': model.state_dict(),
+        'n_e': n_e,
+        'n_r': n_r,
+        'embedding': model.e,
+        'reciprocal': model.reciprocal,
+        'sparse': model.sparse},
+        result_dir + '/vembed.pt')
+
     temrrs = torch.tensor(test_mrrs)
     with open(result_file, 'a+') as f:
         print(f'mean test MRR    {temrrs.mean():.3} ({temrrs.std():.3})  \t{test_mrrs}', file=f)
     print(f'mean test MRR    {temrrs.mean():.3} ({temrrs.std():.3})  \t{test_mrrs}')
 
+def hogwild_worker(w, model, shard, commands, results, negative_rate, candidates, beta, batch_size, opt, threads, dtype, seed):
+    """
+    Worker of train_lp_vembed_hogwild. Trains the shared model on its own shard of the training triples, one epoch per
+    command, and puts (worker, epoch, triples seen, seconds, summed loss) on the results queue. A None command stops it.
+    The optimizer state is private to the worker, the parameters are updated in place without locks.
+    """
+    torch.set_num_threads(threads)
+    torch.set_default_dtype(dtype)
+    optimizer = make_optimizer(model, opt)
+    n_e, n_r = model.n, model.r
+    generator = torch.Generator()
+
+    while True:
+        e = commands.get()
+        if e is None:
+            break
+        model.train(True)
+        generator.manual_seed(seed + 1000 * e + w)      # the shard order and corruptions only depend on the epoch and worker
+        torch.manual_seed(seed + 1000 * e + w)
+        perm = torch.randperm(shard.size(0), generator=generator)
+        seen, sumloss = 0, 0.
+        start = time.time()
+        for fr in range(0, shard.size(0), batch_size):
+            positives = shard[perm[fr:fr + batch_size]]
+            optimizer.zero_grad()
+            loss, _ = fused_step(model, positives, negative_rate, beta, n_e, n_r, candidates=candidates, log=False)
+            optimizer.step()
+            seen += positives.size(0)
+            sumloss += loss
+        results.put((w, e, seen, time.time() - start, sumloss))
+
+def train_lp_vembed_hogwild(n_e, n_r, train, test, alltriples, beta: int, epochs: int, batch_size: int, result_dir: str, workers: int=4,
+                            test_batch: int=5, eval_int: int=3, opt: str='adagrad', seed: int=0):
+    """
+    Hogwild version of train_lp_vembed for many core cpu nodes.
+    The parameters of a sparse VLinkPredictor live in shared memory and every forked worker trains on its own shard of the
+    triples with lock free sparse updates, see hogwild_worker. The workers meet at a barrier after every epoch and every
+    eval_int epochs a snapshot of the model is evaluated while they wait, so the evaluation itself is deterministic.
+    Training happens on the cpu, only the evaluation uses the gpu if there is one.
+    :param workers: number of worker processes, each gets an equal share of the torch threads.
+    :param opt: optimizer of the workers, 'adagrad' or 'sparse_adam'.
+    :return: list of the test MRRs and list of the training throughputs in triples per second, one per epoch.
+    """
+    negative_rate = [10, 0, 10]
+    result_file = result_dir + '/lp_log.txt'
+
+    model = VLinkPredictor(torch.as_tensor(triples_array(alltriples)), n_e, n_r, embedding=512, decoder='distmult', edropout=None, rdropout=None,
+                           init=0.85, biases=False, init_method='uniform', init_parms=(-1.0, 1.0), reciprocal=True, sparse=True)
+    model.share_memory()
+
+    truedict = truedicts(alltriples)
+    train = torch.tensor(train, dtype=torch.long)
+    test = torch.tensor(test, dtype=torch.long).to(d())
+    ccandidates = tuple(torch.unique(train[:, c]) for c in range(3))
+    shards = [train[w::workers].clone() for w in range(workers)]
+    threads = max(1, torch.get_num_threads() // workers)
+
+    with open(result_file, 'w') as f:
+        print(n_e, 'nodes', file=f)
+        print(n_r, 'relations', file=f)
+        print(train.size(0), 'training triples', file=f)
+        print(f'{workers} hogwild workers with {threads} threads each', file=f)
+
+    # Forked, so the shared model is never pickled.
+    ctx = torch.multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    commands = [ctx.SimpleQueue() for _ in range(workers)]
+    procs = [ctx.Process(target=hogwild_worker, args=(w, model, shard, commands[w], results, negative_rate, ccandidates, beta,
+                                                      batch_size, opt, threads, torch.get_default_dtype(), seed))
+             for w, shard in enumerate(shards)]
+    for proc in procs:
+        proc.start()
+
+    test_mrrs, throughputs = [], []
+    try:
+        for e in range(epochs):
+            tic()
+            for command in commands:
+                command.put(e)
+            reports = gather_results(results, procs)        # barrier, every worker has finished epoch e, raises if one died
+            wall = toc()
+            seen = sum(r[2] for r in reports)
+            sumloss = sum(r[4] for r in reports)
+            throughputs.append(seen / wall)
+            print(f'epoch {e}: {seen / wall:.1f} triples/s, loss {sumloss / seen:.4}')
+            wandb.log({"hogwild_triples_per_s": seen / wall, "loss": sumloss / seen})
+
+            if ((e+1) % eval_int == 0) or e == epochs - 1:
+                with torch.no_grad():
+                    snapshot = copy.deepcopy(model).to(d())
+                    snapshot.train(False)
+                    mrr, hits, ranks = eval(
+                        model=snapshot, valset=test, truedicts=truedict, n=n_e, batch_size=test_batch, verbose=True)
+                    del snapshot
+
+                with open(result_file, 'a+') as f:
+                    print(f'epoch {e}: MRR {mrr:.4}\t hits@1 {hits[0]:.4}\t  hits@3 {hits[1]:.4}\t  hits@10 {hits[2]:.4}\t {seen / wall:.1f} triples/s', file=f)
+                print(f'epoch {e}: MRR {mrr:.4}\t hits@1 {hits[0]:.4}\t  hits@3 {hits[1]:.4}\t  hits@10 {hits[2]:.4}')
+                wandb.log({"mrr": mrr, "h@1": hits[0], "h@3": hits[1], "h@10": hits[2]})
+                test_mrrs.append(mrr)
+    except RuntimeError:
+        for proc in procs:
+            proc.terminate()
+        raise
+    finally:
+        for command in commands:
+            command.put(None)
+        for proc in procs:
+            proc.join()
+
+    torch.save({
+        'model_state_dict': model.state_dict(),
+        'n_e': n_e,
+        'n_r': n_r,
+        'embedding': model.e,
+        'reciprocal': model.reciprocal,
+        'sparse': model.sparse},
+        result_dir + '/vembed.pt')
+    return test_mrrs, throughputs
+
@@ -6,6 +6,9 @@ from experiments.interpolation import interpolate_triples
 import torch
 import numpy as np
 from utils.lp_utils import *
+from utils.graph_data import graph_loader, to_device, DeviceGraphBatcher
+from utils.graph_batch import GraphBatchBuffer
+from utils.graph_cache import GraphStore, CachedGraphBatcher
 from tqdm import tqdm
 from datetime import date
 import wandb, random
@@ -23,6 +26,8 @@ def train_eval_vae(batch_size, epochs, train_set, test_set, model, optimizer, da
     :param model: Pytorch RGVAE model
     :param optimizer: mice r
     :param result_dir: path where to save model state_dict
+    The model_params loader ('device', 'workers' or 'cache'), loader_workers and loader_prefetch choose how batches are built,
+    sampler ('consecutive' or 'subgraph') how the training triples are grouped into graphs.
     :returns : dict with train and val loss per epoch
     """
     n = int(model.n / 2)
@@ -34,6 +39,36 @@ def train_eval_vae(batch_size, epochs, train_set, test_set, model, optimizer, da
     loss_dict = {'val': dict(), 'train': dict(), 'lp': dict()}
     writer = SummaryWriter(log_dir=result_dir)
 
+    # With loader 'device' the triples stay on the device and batches are gathered there by index, the default on gpu.
+    # With loader 'workers' the graph batches are built by loader workers, prefetched and pinned while the model trains.
+    params = model.model_params
+    loader = params['loader'] if 'loader' in params else ('device' if torch.cuda.is_available() else 'workers')
+    seed = params['seed'] if 'seed' in params else 0
+    sampler = params['sampler'] if 'sampler' in params else 'consecutive'
+    if loader == 'device':
+        train_loader = DeviceGraphBatcher(train_set, n, batch_size, n_e, n_r, shuffle=True, seed=seed, sampler=sampler)
+        test_loader = DeviceGraphBatcher(test_set, n, batch_size, n_e, n_r, shuffle=False, seed=seed)
+    elif loader == 'workers':
+        workers = params['loader_workers'] if 'loader_workers' in params else 2
+        prefetch = params['loader_prefetch'] if 'loader_prefetch' in params else 2
+        train_loader = graph_loader(train_set, n, batch_size, n_e, n_r, shuffle=True, workers=workers, prefetch=prefetch, seed=seed,
+                                    sampler=sampler)
+        test_loader = graph_loader(test_set, n, batch_size, n_e, n_r, shuffle=False, workers=workers, prefetch=prefetch, seed=seed)
+    elif loader == 'cache':
+        # Graphs are precomputed once per triples, n and sampler into sharded stores, see experiments/create_ds_fb15k.py.
+        budget = int(params['cache_budget_mb'] * 2**20) if 'cache_budget_mb' in params else 2**30
+        rounds = params['cache_rounds'] if 'cache_rounds' in params else 1
+        window = params['cache_window'] if 'cache_window' in params else 4
+        train_loader = CachedGraphBatcher(GraphStore.open(train_set, n, n_e, n_r, sampler=sampler, seed=seed, rounds=rounds,
+                                                          cache_budget=budget), batch_size, shuffle=True, seed=seed, window=window)
+        test_loader = CachedGraphBatcher(GraphStore.open(test_set, n, n_e, n_r, cache_budget=budget), batch_size, shuffle=False)
+    else:
+        raise ValueError('Loader {} not defined!'.format(loader))
+    # The permutation invariant loss needs dense targets, they are written into the same preallocated tensors every step.
+    # Training and evaluation consume every batch before the next one is filled, so a single slot is shared by both.
+    buffer = GraphBatchBuffer(batch_size, 2*n, n_e, n_r, slots=1)
+    print('The dense target buffer takes up to {:.1f} MB.'.format(buffer.slot_bytes() / 2**20))
+
     # Start training.
     for epoch in range(epochs):
         start_time = time.time()
@@ -44,9 +79,8 @@ def train_eval_vae(batch_size, epochs, train_set, test_set, model, optimizer, da
         loss_train = list()
         permute_list = list()
 
-        for b_from in tqdm(range(0,len(train_set),(batch_size*n)), desc='Epoch {}'.format(epoch), position=2):
-            b_to = min(b_from + batch_size, len(train_set))
-            target = batch_t2m(torch.tensor(train_set[b_from:b_to], device=d()), n, n_e, n_r)
+        for batch in tqdm(train_loader, desc='Epoch {}'.format(epoch), position=2):
+            target = to_device(batch, buffer)
 
             loss, x_permute = train_sparse_batch(target, model, optimizer, epoch)
             loss_train.append(loss)
@@ -60,6 +94,7 @@ def train_eval_vae(batch_size, epochs, train_set, test_set, model, optimizer, da
                     "train_permutation_mean": np.mean(permute_list), "train_permutation_std": np.std(permute_list), "epoch": epoch})
         end_time = time.time()
         print('Time elapsed for epoch{} : {:.3f}\n Mean train elbo: {:.3f}'.format(epoch, end_time - start_time, np.mean(loss_train)))
+        wandb.log({'buffer_' + k: v for k, v in buffer.stats().items()})
 
 
         # Evaluate
@@ -68,9 +103,8 @@ def train_eval_vae(batch_size, epochs, train_set, test_set, model, optimizer, da
             model.eval()
             loss_val = list()
             permute_list = list()
-            for b_from in tqdm(range(0,len(test_set),(batch_size*n)), desc='Epoch {}'.format(epoch), position=2):
-                b_to = min(b_from + batch_size, len(test_set))
-                target = batch_t2m(torch.tensor(test_set[b_from:b_to], device=d()), n, n_e, n_r)
+            for batch in tqdm(test_loader, desc='Epoch {}'.format(epoch), position=2):
+                target = to_device(batch, buffer)
                 loss, x_permute = train_sparse_batch(target, model, optimizer, epoch, eval=True)
                 loss_val.append(loss)
                 permute_list.append(x_permute)
@@ -114,9 +148,12 @@ def train_eval_vae(batch_size, epochs, train_set, test_set, model, optimizer, da
                 wandb.save(interpol_file_path)
 
                 print('Start link prediction at epoch {}:'.format(epoch))
-                testsub = torch.tensor(test_set, device=d())[random.sample(range(len(test_set)), k=50)]   # TODO remove the testset croping
+                # Draw test triples until the metrics are known to within lp_ci_width or the time budget is spent.
+                lp_ci_width = params['lp_ci_width'] if 'lp_ci_width' in params else 0.1
+                lp_time_budget = params['lp_time_budget'] if 'lp_time_budget' in params else 60
+                testsub = torch.tensor(test_set, dtype=torch.long, device=d())
                 lp_start = time.time()
-                lp_results =  link_prediction(model, testsub, truedict, batch_size)
+                lp_results =  link_prediction(model, testsub, truedict, batch_size, ci_width=lp_ci_width, time_budget=lp_time_budget)
                 loss_dict['lp'][epoch] = lp_results
                 lp_results['epoch'] = epoch
                 wandb.log(lp_results)
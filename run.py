@@ -2,7 +2,9 @@ import numpy as np
 from torch_rgvae.GVAE import GVAE
 from torch_rgvae.GCVAE import GCVAE
 from torch_rgvae.GCVAE2 import GCVAE2
+from torch_rgvae.VEmbed import load_vlinkpredictor
 from lp_utils import *
+from utils.entity_store import load_entity_store
 from experiments.train_eval_vae import train_eval_vae
 from experiments.link_prediction import link_prediction
 from experiments.gen_people import eval_generation 
@@ -80,7 +82,7 @@ if __name__ == "__main__":
     n_r = len(r2i)
     args['n_e'] = n_e
     args['n_r'] = n_r
-    truedict = truedicts(all_triples)
+    truedict = load_filter_index(dataset, all_triples, n_e, n_r)
     dataset_tools = [truedict, i2n, i2r]
 
     # Obama triple: /m/02mjmr	/people/person/place_of_birth	/m/02hrh0_Michelangelo triple: /m/058w5	/people/deceased_person/place_of_death	/m/06c62
@@ -123,10 +125,31 @@ if __name__ == "__main__":
     # Link prediction
     if args['link_prediction']:
         print('Start link prediction!')
-        testset_crop = int(len(test_set)/3)         # Yes, only one third
-        testsub = torch.tensor(test_set, device=d())[random.sample(range(len(test_set)), k=testset_crop)]   # TODO remove the testset croping
-
-        lp_results =  link_prediction(model, testsub, truedict, batch_size)
+        lp_workers = args['lp_workers'] if 'lp_workers' in args else 1
+        lp_ci_width = args['lp_ci_width'] if 'lp_ci_width' in args else None
+        lp_time_budget = args['lp_time_budget'] if 'lp_time_budget' in args else None
+        # The full testset, with lp_ci_width or lp_time_budget an adaptive subsample of it is drawn.
+        testsub = torch.tensor(test_set, dtype=torch.long, device=d())
+
+        domain_range = None
+        if 'lp_prune' in args and args['lp_prune']:
+            entity_types = None
+            if 'lp_prune_types' in args and args['lp_prune_types']:
+                entity_types = load_entity_store(dataset)
+                entity_types.require_types()
+            domain_range = DomainRangeIndex.build(train_set, n_e, n_r, i2n=i2n, types=entity_types)
+            print('Domain/range pruning keeps {:.2%} of the head and {:.2%} of the tail candidates.'.format(*domain_range.pruning()))
+
+        retriever = None
+        if 'lp_retriever_path' in args and args['lp_retriever_path']:
+            # Two stage link prediction, rerank the top k of a cheap embedding model with the elbo.
+            retriever = TopKRetriever(load_vlinkpredictor(args['lp_retriever_path']), n_e, k=args['lp_retriever_k'] if 'lp_retriever_k' in args else 100,
+                                      filter=truedict)
+
+        lp_results =  link_prediction(model, testsub, truedict, batch_size, workers=lp_workers, ci_width=lp_ci_width, time_budget=lp_time_budget,
+                                      journal_dir=args['lp_journal_dir'] if 'lp_journal_dir' in args else None,
+                                      domain_range=domain_range, unpruned=args['lp_unpruned'] if 'lp_unpruned' in args else True,
+                                      retriever=retriever)
         lp_file_path = result_dir + '/lp_{}_{}.json'.format(exp_name, todate)
         with open(lp_file_path, 'w') as outfile:
             json.dump(lp_results, outfile)
@@ -0,0 +1,27 @@
+import numpy as np
+import torch
+from torch_rgvae.VEmbed import VLinkPredictor
+from utils.ann_index import IVFPQIndex, entity_vectors, query_vectors, index_recall
+
+# This sets the default torch dtype. Double-power
+my_dtype = torch.float64
+torch.set_default_dtype(my_dtype)
+
+n_e = 50
+n_r = 3
+seed = 11
+torch.manual_seed(seed)
+model = VLinkPredictor(torch.zeros((0, 3), dtype=torch.long), n_e, n_r, embedding=8, reciprocal=True).train(False)
+queries = torch.tensor([[0, 1], [5, 0], [49, 2], [17, 1]])
+
+
+def test_exact_search(tmp_path):
+    # Probing every cell and reranking every entity makes the search exact.
+    index = IVFPQIndex.build(entity_vectors(model), n_list=4, m=2, ksub=16)
+    assert index_recall(index, model, queries, k=5, n_probe=4, rerank=n_e)['recall@5'] == 1.
+
+    index.save(str(tmp_path / 'index.npz'))
+    loaded = IVFPQIndex.load(str(tmp_path / 'index.npz'))
+    vectors = query_vectors(model, queries[:, 0], queries[:, 1])
+    for a, b in zip(index.search(vectors, k=5, n_probe=2), loaded.search(vectors, k=5, n_probe=2)):
+        assert np.array_equal(a, b)
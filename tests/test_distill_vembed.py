@@ -0,0 +1,66 @@
+import pytest
+import torch
+import wandb
+from experiments.distill_vembed import sample_triples, teacher_scores, distill_vembed
+from utils.lp_utils import batch_t2m
+
+# This sets the default torch dtype. Double-power
+my_dtype = torch.float64
+torch.set_default_dtype(my_dtype)
+wandb.init(mode='disabled')
+
+n_e = 7
+n_r = 3
+seed = 11
+torch.manual_seed(seed)
+train = torch.tensor([[0, 0, 1], [2, 0, 1], [0, 0, 3], [4, 1, 5], [6, 1, 5], [3, 2, 1], [5, 0, 1]])
+
+
+class Teacher(torch.nn.Module):
+    """
+    Stand-in for a VAE with one triple per graph, scores graphs by their node entities.
+    """
+    n = 2
+
+    def __init__(self):
+        super().__init__()
+        self.n_e, self.n_r = n_e, n_r
+        self.entity_scores = torch.nn.Parameter(torch.rand(n_e))
+
+    def elbo(self, target):
+        A, E, F = target
+        return - (F.sum(1) * self.entity_scores).sum(-1)
+
+
+class BrokenTeacher(Teacher):
+    def elbo(self, target):
+        raise ValueError('The cached scores should have been used')
+
+
+def test_sample_triples():
+    triples = sample_triples(train, n_e, 50, corrupt_rate=0.5, seed=seed)
+    assert triples.size() == (50, 3)
+    assert torch.equal(triples, sample_triples(train, n_e, 50, corrupt_rate=0.5, seed=seed))
+    # Every sample is a training triple with at most its head or its tail replaced.
+    for s, p, o in triples.tolist():
+        assert any(tp == p and (ts == s or to == o) for ts, tp, to in train.tolist())
+    assert set(map(tuple, sample_triples(train, n_e, 20, corrupt_rate=0., seed=seed).tolist())) <= set(map(tuple, train.tolist()))
+
+
+def test_teacher_scores(tmp_path):
+    teacher = Teacher()
+    cache_path = str(tmp_path / 'teacher.npy')
+    scores = teacher_scores(teacher, train, 3, cache_path=cache_path)
+    with torch.no_grad():
+        assert torch.allclose(scores, - teacher.elbo(batch_t2m(train, 1, n_e, n_r)).view(-1))
+    # A second call loads the scores from the cache instead of running the teacher.
+    assert torch.equal(teacher_scores(BrokenTeacher(), train, 3, cache_path=cache_path), scores)
+
+
+def test_distill_vembed(tmp_path):
+    results = distill_vembed(Teacher(), train.tolist(), n_e, n_r, str(tmp_path), n_samples=64, epochs=1, batch_size=16,
+                             teacher_batch=16, embedding=4, n_speed=2)
+    assert -1. <= results['spearman'] <= 1.
+    assert results['speedup'] > 0.
+    assert (tmp_path / 'vembed_distilled.pt').is_file()
+    assert len(list(tmp_path.glob('teacher_*.npy'))) == 1
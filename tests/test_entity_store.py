@@ -0,0 +1,54 @@
+import pickle
+import pytest
+import numpy as np
+import torch
+from utils.entity_store import EntityStore
+from utils.lp_utils import translate_triple, DomainRangeIndex
+
+i2n = ['/m/a', '/m/b', '/m/c', '/m/d', '/m/e', '/m/f', '/m/g', '/m/h', '/m/i']
+i2r = ['/people/person/nationality', '/location/location/contains']
+
+
+def build_store(tmp_path):
+    with open(tmp_path / 'entity2text.txt', 'w') as f:
+        f.write('/m/a\tAda Lovelace\n/m/c\tZürich\n/m/x\tNot in the vocabulary\n/m/i\tIda\n')
+    with open(tmp_path / 'entity2type.txt', 'w') as f:
+        f.write('/m/a\t/people/person /common/topic\n/m/c\t/location/location\n/m/i\t/people/person\n')
+    return EntityStore.build(i2n, str(tmp_path / 'store'), str(tmp_path / 'entity2text.txt'), str(tmp_path / 'entity2type.txt'))
+
+
+def test_entity_store(tmp_path):
+    store = build_store(tmp_path)
+
+    assert store.texts(torch.tensor([2, 0, 1, 2])) == ['Zürich', 'Ada Lovelace', '/m/b', 'Zürich']
+    assert translate_triple(np.array([[0, 0, 2], [8, 1, 3]]), i2n, i2r, store) == \
+        [('Ada Lovelace', i2r[0], 'Zürich'), ('Ida', i2r[1], '/m/d')]
+    assert np.nonzero(store.type_mask('people'))[0].tolist() == [0, 8]
+    assert not store.type_mask('music').any()
+    assert np.nonzero(store.typed_mask())[0].tolist() == [0, 2, 8]
+
+    # A pickled store only carries its folder and reopens the arrays lazily.
+    unpickled = pickle.loads(pickle.dumps(store))
+    assert unpickled._arrays is None and unpickled.texts([8]) == ['Ida']
+
+
+def test_entity_store_without_types(tmp_path):
+    with open(tmp_path / 'entity2text.txt', 'w') as f:
+        f.write('/m/a\tAda Lovelace\n')
+    store = EntityStore.build(i2n, str(tmp_path / 'store'), str(tmp_path / 'entity2text.txt'))
+    assert store.texts([0, 1]) == ['Ada Lovelace', '/m/b']
+    for lookup in [lambda: store.type_mask('people'), store.typed_mask, store.type_pairs]:
+        with pytest.raises(FileNotFoundError):
+            lookup()
+
+
+def test_domain_range_types(tmp_path):
+    store = build_store(tmp_path)
+    types = {'/m/a': '/people/person /common/topic', '/m/c': '/location/location', '/m/i': '/people/person'}
+    train = [[0, 0, 2], [0, 1, 3]]
+    from_store = DomainRangeIndex.build(train, len(i2n), len(i2r), i2n=i2n, types=store)
+    from_dict = DomainRangeIndex.build(train, len(i2n), len(i2r), i2n=i2n, types=types)
+    for a, b in zip(from_store.domain + from_store.range, from_dict.domain + from_dict.range):
+        assert torch.equal(a, b)
+    # Both domains are Ada, expanded with Ida who is a person as well.
+    assert from_store.domain[1].tolist() == [0, 8, 0, 8]
@@ -0,0 +1,122 @@
+import numpy as np
+import torch
+from utils.graph_batch import GraphBatch, GraphBatchBuffer
+from utils.graph_data import graph_loader, DeviceGraphBatcher, SubgraphSampler
+from utils.graph_cache import GraphStore, CachedGraphBatcher
+
+# This sets the default torch dtype. Double-power
+my_dtype = torch.float64
+torch.set_default_dtype(my_dtype)
+
+n_e = 7
+n_r = 3
+seed = 11
+torch.manual_seed(seed)
+
+graphs = torch.tensor([[[0, 0, 1], [2, 1, 0], [0, 2, 3]],
+                       [[4, 1, 5], [4, 1, 5], [5, 0, 4]],
+                       [[6, 2, 6], [1, 0, 2], [1, 2, 2]]])
+batch = GraphBatch.from_triples(graphs, n_e, n_r)
+A, E, F = batch
+bs, N = A.shape[0], A.shape[1]
+
+
+def test_flat_linear():
+    linear = torch.nn.Linear(N*N + N*N*n_r + N*n_e, 5)
+    x = torch.cat([A.reshape(bs, -1), E.reshape(bs, -1), F.reshape(bs, -1)], dim=1)
+    assert torch.allclose(batch.flat_linear(linear), linear(x))
+
+
+def test_node_matmul():
+    weight = torch.rand(N*n_r + n_e, 4)
+    features = torch.cat((E.reshape(bs, N, N*n_r), F), -1)
+    assert torch.allclose(batch.node_matmul(weight), features @ weight)
+
+
+def test_labels():
+    assert torch.equal(batch.adjacency(), A)
+    assert torch.equal(batch.edge_labels(), torch.argmax(E, -1))
+    assert torch.equal(batch.node_labels(), torch.argmax(F, -1))
+    assert batch.edge_count(1) == torch.norm(A[1], p=1).item()
+    assert batch.triples()[:, 1:].tolist() == graphs.view(-1, 3).tolist()
+
+
+def test_buffer():
+    buffer = GraphBatchBuffer(bs, N, n_e, n_r, slots=2)
+    for step in range(4):
+        # Alternating batches reuse the slots, only the entries of the previous batch are reset.
+        sub = graphs[step % 2:]
+        for m, dense in zip(GraphBatch.from_triples(sub, n_e, n_r, buffer=buffer), GraphBatch.from_triples(sub, n_e, n_r)):
+            assert torch.equal(m, dense)
+    assert buffer.stats()['allocations'] == 2 and buffer.stats()['fills'] == 4
+
+    # A slot is sized by the batches filled into it, not by the largest batch size it was created for.
+    lazy = GraphBatchBuffer(1000, N, n_e, n_r)
+    for sub in [graphs[1:], graphs, graphs[2:]]:
+        for m, dense in zip(GraphBatch.from_triples(sub, n_e, n_r, buffer=lazy), GraphBatch.from_triples(sub, n_e, n_r)):
+            assert torch.equal(m, dense)
+    assert lazy.stats()['allocations'] == 2 and lazy.stats()['bytes'] == lazy.slot_bytes(bs)
+
+
+def test_graph_loader():
+    triples = graphs.view(-1, 3)
+    epochs = [[b.triples()[:, 1:] for b in graph_loader(triples, 1, 4, n_e, n_r, workers=0, seed=1)] for _ in range(2)]
+    for epoch in epochs:
+        assert sorted(torch.cat(epoch).tolist()) == sorted(triples.tolist())
+    rerun = [b.triples()[:, 1:] for b in graph_loader(triples, 1, 4, n_e, n_r, workers=0, seed=1)]
+    assert all(torch.equal(a, b) for a, b in zip(rerun, epochs[0]))
+
+
+def test_device_batcher():
+    triples = graphs.view(-1, 3)
+    batcher = DeviceGraphBatcher(triples, 3, 2, n_e, n_r, seed=1)
+    assert len(batcher) == 2
+    epoch = torch.cat([b.triples()[:, 1:] for b in batcher]).cpu()
+    assert sorted(epoch.view(-1, 3, 3).tolist()) == sorted(graphs.tolist())
+
+
+def test_graph_store(tmp_path):
+    triples = graphs.view(-1, 3)
+    store = GraphStore.open(triples, 3, n_e, n_r, root=str(tmp_path), cache_budget=0)
+    assert len(store) == 3 and len(store.offsets) == 2
+    for m, dense in zip(store.take(np.array([2, 0])), GraphBatch.from_triples(graphs[[2, 0]], n_e, n_r)):
+        assert torch.equal(m, dense)
+    # Shards smaller than the budget are kept in memory, a reopened store is not rebuilt.
+    reopened = GraphStore.open(triples, 3, n_e, n_r, root=str(tmp_path))
+    assert reopened.folder == store.folder
+    epoch = torch.cat([b.triples()[:, 1:].cpu() for b in CachedGraphBatcher(reopened, 2, seed=1)])
+    assert sorted(epoch.view(-1, 3, 3).tolist()) == sorted(graphs.tolist())
+    assert reopened.cache.misses == 1 and reopened.cache.hits == 1
+
+    # The graphs of a window of shards are shuffled together, a batch can mix graphs of different shards.
+    sharded = GraphStore.build(triples, 3, n_e, n_r, str(tmp_path / 'sharded'), shard_size=2)
+    assert len(sharded.offsets) == 3
+    batcher = CachedGraphBatcher(sharded, 2, seed=1, window=2)
+    firsts = [next(iter(batcher)).triples()[:, 1:].cpu().view(-1, 3, 3).tolist() for _ in range(20)]
+    assert any(graphs[2].tolist() in first and len(first) == 2 for first in firsts)
+    epoch = torch.cat([b.triples()[:, 1:].cpu() for b in batcher])
+    assert sorted(epoch.view(-1, 3, 3).tolist()) == sorted(graphs.tolist())
+
+    empty = GraphStore.build(torch.zeros((0, 3), dtype=torch.long), 3, n_e, n_r, str(tmp_path / 'empty'))
+    assert len(CachedGraphBatcher(empty, 2)) == 0 and list(CachedGraphBatcher(empty, 2)) == []
+
+
+def test_subgraph_sampler():
+    triples = torch.tensor([[0, 0, 1], [1, 1, 2], [2, 0, 3], [3, 2, 0], [4, 1, 5], [5, 0, 6], [6, 2, 4]])
+    sampler = SubgraphSampler(triples, n_e)
+    samples = sampler.sample(torch.arange(triples.size(0)), 3, generator=torch.Generator().manual_seed(seed))
+    assert torch.equal(samples[:, 0], torch.arange(triples.size(0)))
+    for sample in samples.tolist():
+        for k in range(1, len(sample)):
+            seen = {e for t in sample[:k] for e in (triples[t, 0].item(), triples[t, 2].item())}
+            assert triples[sample[k], 0].item() in seen or triples[sample[k], 2].item() in seen
+
+    # With enough retries every graph has distinct triples, the cycles are long enough for it.
+    sampler = SubgraphSampler(triples, n_e, retries=30)
+    samples = sampler.sample(torch.arange(triples.size(0)), 3, generator=torch.Generator().manual_seed(seed))
+    assert all(len(set(sample)) == 3 for sample in samples.tolist())
+
+    # The seed of graph i is one of the triples i*n to i*n + n - 1.
+    batcher = DeviceGraphBatcher(triples, 3, 1, n_e, n_r, seed=1, device='cpu', sampler='subgraph')
+    seeds = [triples.tolist().index(b.triples()[0, 1:].tolist()) for b in batcher]
+    assert sorted(seed // 3 for seed in seeds) == [0, 1]
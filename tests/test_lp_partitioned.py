@@ -0,0 +1,31 @@
+import json
+import numpy as np
+import torch
+import wandb
+from experiments.lp_partitioned import train_lp_partitioned
+
+# This sets the default torch dtype. Double-power
+my_dtype = torch.float64
+torch.set_default_dtype(my_dtype)
+wandb.init(mode='disabled')
+
+n_e = 10
+n_r = 3
+train = np.array([[0, 0, 9], [1, 2, 3], [9, 1, 0], [4, 0, 5], [8, 2, 8], [2, 1, 7], [1, 0, 2], [6, 1, 3]])
+test = np.array([[0, 0, 3], [4, 1, 5]])
+
+
+def test_train_lp_partitioned(tmp_path):
+    mrrs = train_lp_partitioned(n_e, n_r, train, test, np.concatenate([train, test]), beta=1., epochs=1, batch_size=4,
+                                result_dir=str(tmp_path), n_buckets=2, embedding=4, eval_int=1)
+    assert len(mrrs) == 1 and 0. < mrrs[0] <= 1.
+    with open(tmp_path / 'embeddings' / 'meta.json', 'r') as f:
+        assert json.load(f)['epoch'] == 0
+
+    # A second call resumes after the finished epoch.
+    mrrs = train_lp_partitioned(n_e, n_r, train, test, np.concatenate([train, test]), beta=1., epochs=2, batch_size=4,
+                                result_dir=str(tmp_path), n_buckets=2, embedding=4, eval_int=1)
+    assert len(mrrs) == 1
+    with open(tmp_path / 'embeddings' / 'meta.json', 'r') as f:
+        meta = json.load(f)
+    assert meta['epoch'] == 1 and meta['block'] == 0
@@ -0,0 +1,263 @@
+import pytest
+import numpy as np
+import torch
+import wandb
+from utils.lp_utils import eval, eval_sequential, eval_sharded, truedicts, filter_scores_, FilterIndex, RankAccumulator, RankJournal, DomainRangeIndex, TopKRetriever, \
+    load_link_prediction_data, load_strings, dataset_files, batch_t2m, batch_matrix2triple, matrix2triple
+
+# This sets the default torch dtype. Double-power
+my_dtype = torch.float64
+torch.set_default_dtype(my_dtype)
+wandb.init(mode='disabled')
+
+n_e = 7
+n_r = 3
+seed = 11
+torch.manual_seed(seed)
+
+# Fixed score per subject and object entity, so the ranks can be checked by hand.
+entity_scores = torch.rand(n_e)
+valset = torch.tensor([[0, 0, 1], [2, 0, 1], [0, 0, 3], [4, 1, 5], [6, 1, 5], [0, 0, 1]])
+all_triples = {tuple(t) for t in valset.tolist()} | {(3, 2, 1), (5, 0, 1)}
+
+
+class ScoreModel():
+    """
+    Stand-in for a VAE, scores single triple graphs by their node entities.
+    """
+    n = 2
+
+    def elbo(self, target):
+        A, E, F = target
+        return - (F.sum(1) * entity_scores).sum(-1)
+
+
+class ScoreModule(torch.nn.Module):
+    """
+    ScoreModel as a module, for the shared memory of eval_sharded.
+    """
+    n = 2
+
+    def elbo(self, target):
+        return ScoreModel().elbo(target)
+
+
+class BrokenModule(ScoreModule):
+    def elbo(self, target):
+        raise ValueError('Worker crash')
+
+
+class CheapModel(torch.nn.Module):
+    """
+    Stand-in for an embedding model, scores triples directly from their indices.
+    """
+    def forward(self, s, p, o):
+        return entity_scores[s] + entity_scores[o]
+
+
+def naive_ranks(head):
+    ranks = []
+    heads, tails = truedicts(all_triples)
+    for s, p, o in valset.tolist():
+        other = o if head else s
+        scores = entity_scores + entity_scores[other]
+        scores[other] = entity_scores[other]        # a self loop has a single node
+        true = s if head else o
+        for c in (heads[p, o] if head else tails[s, p]):
+            if c != true:
+                scores[c] = float('-inf')
+        rank = torch.sum(scores > scores[true]).item() + (torch.sum(scores == scores[true]).item() - 1) // 2
+        ranks.append(rank + 1)
+    return ranks
+
+
+def test_eval_shared_bases():
+    mrr, hits, ranks = eval(ScoreModel(), valset, truedicts(all_triples), n_e, n_r, batch_size=2, verbose=False)
+    assert ranks == naive_ranks(True) + naive_ranks(False)
+    assert mrr == pytest.approx(sum([1.0 / r for r in ranks]) / len(ranks))
+
+
+def test_eval_sharded():
+    full = eval(ScoreModule(), valset, truedicts(all_triples), n_e, n_r, batch_size=2, log_int=0)
+    mrr, hits, ranks, acc = eval_sharded(ScoreModule(), valset, truedicts(all_triples), n_e, n_r, workers=2, batch_size=2)
+    assert ranks == full[2]
+    assert mrr == pytest.approx(full[0])
+
+    # A crashed worker raises instead of leaving the evaluation waiting for its ranks.
+    with pytest.raises(RuntimeError):
+        eval_sharded(BrokenModule(), valset, truedicts(all_triples), n_e, n_r, workers=2, batch_size=2)
+
+
+def test_filter_index():
+    index = FilterIndex.build(all_triples, n_e, n_r)
+    for head in [True, False]:
+        scores_dict = torch.rand(valset.shape[0], n_e)
+        scores_index = scores_dict.clone()
+        filter_scores_(scores_dict, valset, truedicts(all_triples), head=head)
+        filter_scores_(scores_index, valset, index, head=head)
+        assert torch.equal(scores_dict, scores_index)
+
+
+def test_rank_accumulator():
+    ranks = torch.tensor([1, 4, 2, 12, 3])
+    rels = torch.tensor([0, 1, 0, 2, 1])
+    acc = RankAccumulator(ranks.shape[0], n_r, hitsat=[1, 3, 10], device='cpu')
+    acc.update(ranks[:2], torch.arange(2), rels=rels[:2])
+    acc.update(ranks[2:], torch.arange(2, 5), rels=rels[2:])
+
+    snap = acc.snapshot()
+    assert snap['n'] == 5
+    assert snap['mrr'] == pytest.approx((1.0 / ranks.double()).mean().item())
+    assert snap['h@3'] == pytest.approx(3 / 5)
+    assert acc.results()[2] == ranks.tolist()
+    assert acc.per_relation()[0]['mrr'] == pytest.approx(0.75)
+    assert acc.per_relation()[2]['h@10'] == 0.
+
+    ci = acc.intervals()
+    assert ci['h@1'][0] < 1 / 5 < ci['h@1'][1]
+
+    # Every query is a hit, the Wilson interval still has a width where the normal approximation has none.
+    perfect = RankAccumulator(5, n_r, device='cpu')
+    perfect.update(torch.ones(5, dtype=torch.long), torch.arange(5))
+    ci = perfect.intervals()
+    assert ci['h@1'][0] < 1. and ci['h@1'][1] == pytest.approx(1.)
+
+
+def test_rank_journal_resume(tmp_path):
+    full = eval(ScoreModel(), valset, truedicts(all_triples), n_e, n_r, batch_size=2, log_int=0)
+    journal = RankJournal(str(tmp_path / 'lp.journal'), valset.shape[0])
+    eval(ScoreModel(), valset, truedicts(all_triples), n_e, n_r, batch_size=2, log_int=0, callback=journal.append)
+
+    # An interruption in the middle of a line, the partial line must not count as a rank.
+    with open(journal.path, 'rb') as f:
+        lines = f.readlines()
+    with open(journal.path, 'wb') as f:
+        f.writelines(lines[:5])
+        f.write(lines[5][:-1])
+
+    acc = journal.accumulator(valset, n_r)
+    skip = acc.ranks.view(2, -1) > 0
+    assert int(skip.sum()) == 5
+    eval(ScoreModel(), valset, truedicts(all_triples), n_e, n_r, batch_size=2, log_int=0, accumulator=acc, skip=skip,
+         callback=journal.append)
+    mrr, hits, ranks = journal.accumulator(valset, n_r).results()
+    assert ranks == full[2]
+    assert mrr == pytest.approx(full[0])
+
+
+def test_eval_sequential():
+    full = eval(ScoreModel(), valset, truedicts(all_triples), n_e, n_r, batch_size=2, log_int=0)
+    mrr, hits, ranks, info = eval_sequential(ScoreModel(), valset, truedicts(all_triples), n_e, n_r, ci_width=0., chunk=4)
+    # An unreachable target width exhausts the valset, which gives the full metrics.
+    assert not info['converged']
+    assert info['n_queries'] == 2 * valset.shape[0]
+    assert mrr == pytest.approx(full[0])
+    assert info['ci']['mrr'][0] <= mrr <= info['ci']['mrr'][1]
+
+    # Any width is reached at once, but not before min_queries are ranked.
+    mrr, hits, ranks, info = eval_sequential(ScoreModel(), valset, truedicts(all_triples), n_e, n_r, ci_width=1., chunk=1, min_queries=4)
+    assert info['converged'] and info['n_queries'] == 4
+
+    # An empty valset gives empty results and the widest intervals.
+    mrr, hits, ranks, info = eval_sequential(ScoreModel(), valset[:0], truedicts(all_triples), n_e, n_r, ci_width=0.1)
+    assert ranks == [] and info['n_queries'] == 0 and not info['converged']
+    assert info['ci']['mrr'] == (0., 1.)
+
+
+def test_domain_range_pruning():
+    index = DomainRangeIndex.build(list(all_triples), n_e, n_r)
+    assert index.candidates(torch.tensor([[1, 5]]), head=True)[0].tolist() == [4, 6]
+    assert index.candidates(torch.tensor([[0, 0]]), head=False)[0].tolist() == [1, 3]
+
+    full = eval(ScoreModel(), valset, truedicts(all_triples), n_e, n_r, batch_size=2, log_int=0)
+    acc = RankAccumulator(2 * valset.shape[0], n_r, device='cpu')
+    mrr, hits, ranks = eval(ScoreModel(), valset, truedicts(all_triples), n_e, n_r, batch_size=2, log_int=0,
+                            candidates=index, accumulator=acc)
+    # All test targets are in the domain and range, pruning can only move them up.
+    assert acc.snapshot()['coverage'] == 1.
+    assert all(p <= f for p, f in zip(ranks, full[2]))
+
+
+def test_topk_rerank():
+    # A retriever with the same scores as the reranker and k = n_e changes nothing.
+    retriever = TopKRetriever(CheapModel(), n_e, k=n_e)
+    full = eval(ScoreModel(), valset, truedicts(all_triples), n_e, n_r, batch_size=2, log_int=0)
+    reranked = eval(ScoreModel(), valset, truedicts(all_triples), n_e, n_r, batch_size=2, log_int=0, candidates=retriever)
+    assert reranked[2] == full[2]
+
+    retriever.k = 2
+    _, _, ranks = eval(ScoreModel(), valset, truedicts(all_triples), n_e, n_r, batch_size=2, log_int=0, candidates=retriever)
+    assert max(ranks) <= 3
+
+    # With the filter, the top k are the best entities which are not filtered out of the ranking.
+    heads, _ = truedicts(all_triples)
+    filtered = TopKRetriever(CheapModel(), n_e, k=2, filter=truedicts(all_triples))
+    for (p, o), cands in zip(valset[:, 1:].tolist(), filtered.candidates(valset[:, 1:], head=True)):
+        others = [e for e in torch.argsort(entity_scores, descending=True).tolist() if e not in heads[p, o]]
+        expected = set(others[:2]) | {e for e in heads[p, o] if entity_scores[e] >= entity_scores[others[1]]}
+        assert set(cands.tolist()) == expected
+    _, _, ranks = eval(ScoreModel(), valset, FilterIndex.build(all_triples, n_e, n_r), n_e, n_r, batch_size=2, log_int=0,
+                       candidates=filtered)
+    assert max(ranks) <= 3
+
+
+def test_compiled_dataset(tmp_path):
+    folder = str(tmp_path / 'compiled')
+    (n2i, i2n), (r2i, i2r), train, test, all_triples = load_link_prediction_data('wn18rr', folder=folder)
+    assert isinstance(train, np.memmap) and isinstance(test, np.memmap)
+    assert i2n == sorted(i2n) and i2r == sorted(i2r)
+    strings = load_strings(dataset_files('wn18rr')[0])
+    assert [[i2n[s], i2r[p], i2n[o]] for s, p, o in train[:100].tolist()] == strings[:100]
+    assert all_triples.shape[0] == len({tuple(t) for t in train.tolist() + test.tolist()})
+
+    # The cached ids are the same with the test set.
+    (n2i_final, _), _, train_final, _, _ = load_link_prediction_data('wn18rr', use_test_set=True, folder=folder)
+    assert n2i_final == n2i
+    assert (train_final[:train.shape[0]] == train).all()
+
+
+def naive_matrices(triples):
+    # Node ids of the original per graph dict, subjects first, an entity which is also an object takes the object id.
+    n_list = list(dict.fromkeys([t[0] for t in triples])) + list(dict.fromkeys([t[2] for t in triples]))
+    n_dict = dict(zip(n_list, range(len(n_list))))
+    n = 2 * len(triples)
+    A, E, F = torch.zeros((1, n, n)), torch.zeros((1, n, n, n_r)), torch.zeros((1, n, n_e))
+    for s, r, o in triples:
+        A[0, n_dict[s], n_dict[o]] = 1
+        E[0, n_dict[s], n_dict[o], r] = 1
+        F[0, n_dict[s], s] = 1
+        F[0, n_dict[o], o] = 1
+    return A, E, F
+
+
+def test_batch_t2m():
+    graphs = torch.tensor([[[0, 0, 1], [2, 1, 0], [0, 2, 3]],
+                           [[4, 1, 5], [4, 1, 5], [5, 0, 4]],
+                           [[6, 2, 6], [1, 0, 2], [2, 0, 1]]])
+    A, E, F = batch_t2m(graphs, 3, n_e, n_r)
+    for g, triples in enumerate(graphs.tolist()):
+        for dense, naive in zip((A, E, F), naive_matrices(triples)):
+            assert torch.equal(dense[g:g+1], naive)
+
+    # Flat triples are split into single triple graphs.
+    A, E, F = batch_t2m(valset, 1, n_e, n_r)
+    assert torch.equal(F[3:4], naive_matrices(valset[3:4].tolist())[2])
+
+
+def test_batch_matrix2triple():
+    graphs = torch.tensor([[[0, 0, 1], [2, 1, 0], [0, 2, 3]],
+                           [[4, 1, 5], [4, 1, 5], [5, 0, 4]]])
+    A, E, F = batch_t2m(graphs, 3, n_e, n_r)
+    triples, inconsistent = batch_matrix2triple(A, E, F)
+    assert inconsistent.item() == 0
+    for g, graph in enumerate(graphs.tolist()):
+        assert sorted(triples[triples[:, 0] == g, 1:].tolist()) == sorted(map(list, set(map(tuple, graph))))
+    assert sorted(matrix2triple((A[1], E[1], F[1]))) == [(4, 1, 5), (5, 0, 4)]
+
+    # Sampled graphs have relation and entity ids, an edge without relation in a multi-hot E is dropped and counted.
+    s, o = torch.nonzero(A[0])[0]
+    E[0, s, o] = 0
+    triples, inconsistent = batch_matrix2triple(A, E, F)
+    assert inconsistent.item() == 1 and triples.size(0) == 4
+    triples, inconsistent = batch_matrix2triple(A, E.argmax(-1), F.argmax(-1))
+    assert inconsistent.item() == 0 and triples.size(0) == 5
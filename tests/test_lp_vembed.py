@@ -0,0 +1,61 @@
+import pytest
+import torch
+import wandb
+from experiments.lp_vembed import make_optimizer, fused_step, loop_step, train_lp_vembed_hogwild
+from torch_rgvae.VEmbed import VLinkPredictor
+
+# This sets the default torch dtype. Double-power
+my_dtype = torch.float64
+torch.set_default_dtype(my_dtype)
+wandb.init(mode='disabled')
+
+n_e = 11
+n_r = 3
+seed = 11
+torch.manual_seed(seed)
+train = torch.tensor([[0, 0, 1], [1, 1, 2], [2, 0, 3], [3, 2, 0], [4, 1, 5], [5, 0, 4], [1, 2, 3], [0, 1, 5]])
+# Corruptions stay within entities 0-5, so the rows 6-10 get no gradient.
+candidates = (torch.arange(6), torch.arange(n_r), torch.arange(6))
+
+
+def test_sparse_step():
+    for opt in ['adagrad', 'sparse_adam']:
+        model = VLinkPredictor(train, n_e, n_r, embedding=4, reciprocal=True, sparse=True)
+        optimizer = make_optimizer(model, opt, lr=0.1)
+        before = model.encoder.e_embed.weight.detach().clone()
+        optimizer.zero_grad()
+        fused_step(model, train[:4], [2, 0, 2], 1., n_e, n_r, candidates=candidates)
+        assert model.encoder.e_embed.weight.grad.is_sparse
+        optimizer.step()
+        after = model.encoder.e_embed.weight.detach()
+        assert not torch.equal(after[:6], before[:6])
+        assert torch.equal(after[6:], before[6:])
+
+
+def test_fused_step():
+    # In eval mode the scores are deterministic and both steps draw the same corruptions for the same seed.
+    model = VLinkPredictor(train, n_e, n_r, embedding=4, reciprocal=True).train(False)
+    losses, grads = list(), list()
+    for step in [loop_step, fused_step]:
+        torch.manual_seed(seed)
+        model.zero_grad()
+        loss, _ = step(model, train, [3, 1, 2], 0.5, n_e, n_r, candidates=candidates)
+        losses.append(loss)
+        grads.append([model.encoder.e_embed.weight.grad.clone(), model.encoder.r_embed.weight.grad.clone()])
+    assert losses[0] == pytest.approx(losses[1])
+    for loop_grad, fused_grad in zip(*grads):
+        assert torch.allclose(loop_grad, fused_grad)
+
+
+def test_hogwild(tmp_path):
+    test = [[0, 0, 1], [4, 1, 5]]
+    mrrs, throughputs = train_lp_vembed_hogwild(n_e, n_r, train.tolist(), test, train.tolist(), beta=1., epochs=2, batch_size=4,
+                                                result_dir=str(tmp_path), workers=2, eval_int=1)
+    assert len(mrrs) == 2 and len(throughputs) == 2
+    assert all(0. < mrr <= 1. for mrr in mrrs)
+    assert (tmp_path / 'vembed.pt').is_file()
+
+    # A worker which fails raises in the main process instead of leaving it waiting at the barrier.
+    with pytest.raises(RuntimeError):
+        train_lp_vembed_hogwild(n_e, n_r, train.tolist(), test, train.tolist(), beta=1., epochs=1, batch_size=4,
+                                result_dir=str(tmp_path), workers=2, opt='unknown')
@@ -0,0 +1,23 @@
+import torch
+from torch_rgvae.VEmbed import VLinkPredictor
+
+# This sets the default torch dtype. Double-power
+my_dtype = torch.float64
+torch.set_default_dtype(my_dtype)
+
+n_e = 11
+n_r = 3
+seed = 11
+torch.manual_seed(seed)
+model = VLinkPredictor(torch.zeros((0, 3), dtype=torch.long), n_e, n_r, embedding=4, reciprocal=True).train(False)
+queries = torch.tensor([[0, 1, 2], [5, 0, 9], [10, 2, 10]])
+
+
+def test_score_1n():
+    s, p, o = queries[:, 0:1], queries[:, 1:2], queries[:, 2:3]
+    ar = torch.arange(n_e).view(1, n_e).expand(queries.shape[0], n_e)
+    with torch.no_grad():
+        tails = model(s.expand(-1, n_e), p.expand(-1, n_e), ar)
+        heads = model(ar, p.expand(-1, n_e), o.expand(-1, n_e))
+        assert torch.allclose(model.score_1n(s=queries[:, 0], p=queries[:, 1], chunk=4), tails)
+        assert torch.allclose(model.score_1n(p=queries[:, 1], o=queries[:, 2], chunk=4), heads)
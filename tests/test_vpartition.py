@@ -0,0 +1,52 @@
+import numpy as np
+import torch
+from torch_rgvae.VPartition import BucketedTriples, PartitionedEmbeddings
+
+# This sets the default torch dtype. Double-power
+my_dtype = torch.float64
+torch.set_default_dtype(my_dtype)
+
+n_e = 10
+n_r = 3
+n_buckets = 3
+triples = np.array([[0, 0, 9], [1, 2, 3], [9, 1, 0], [4, 0, 5], [8, 2, 8], [2, 1, 7], [1, 0, 2]])
+
+
+def test_bucketed_triples(tmp_path):
+    store = BucketedTriples.build(triples, n_e, n_buckets, str(tmp_path), chunk=3)
+    assert len(store) == triples.shape[0]
+    stored = np.concatenate([store.block(i, j) for i, j in store.blocks()], axis=0)
+    assert sorted(map(tuple, stored.tolist())) == sorted(map(tuple, triples.tolist()))
+    for i, j in store.blocks():
+        block = store.block(i, j)
+        assert np.all((store.bounds[i] <= block[:, 0]) & (block[:, 0] < store.bounds[i + 1]))
+        assert np.all((store.bounds[j] <= block[:, 2]) & (block[:, 2] < store.bounds[j + 1]))
+
+
+def test_partitioned_embeddings(tmp_path):
+    store = BucketedTriples.build(triples, n_e, n_buckets, str(tmp_path / 'triples'))
+    embeddings = PartitionedEmbeddings.create(str(tmp_path / 'embeddings'), n_e, n_r, 4, n_buckets)
+    full = embeddings.to_vlinkpredictor().train(False)
+
+    # The scores of every block match the full model, as long as nothing has been written back.
+    for i, j in store.blocks():
+        block = torch.from_numpy(np.array(store.block(i, j)))
+        model, state = embeddings.load(i, j)
+        local = embeddings.localize(block, i, j)
+        with torch.no_grad():
+            model.train(False)
+            assert torch.allclose(model(local[:, 0:1], local[:, 1:2], local[:, 2:3]), full(block[:, 0:1], block[:, 1:2], block[:, 2:3]))
+
+    for k, (i, j) in enumerate(store.blocks()):
+        model, state = embeddings.load(i, j)
+        with torch.no_grad():
+            model.encoder.e_embed.weight.add_(1.)
+            model.encoder.r_embed.weight.add_(1.)
+        embeddings.store(model, state, i, j)
+        embeddings.save(-1, block=k + 1)
+
+    # Partitions and relations are written back with every block, the progress is in meta.json.
+    reloaded = PartitionedEmbeddings(str(tmp_path / 'embeddings'))
+    assert reloaded.meta['epoch'] == -1 and reloaded.meta['block'] == len(store.blocks())
+    assert not torch.allclose(reloaded.to_vlinkpredictor().encoder.e_embed.weight, full.encoder.e_embed.weight)
+    assert torch.allclose(reloaded.relations, full.encoder.r_embed.weight + len(store.blocks()))
@@ -11,6 +11,7 @@ from torch_rgvae.decoders import *
 import torch.nn as nn
 from torch_rgvae.losses import *
 from utils.utils import *
+from utils.graph_batch import GraphBatch
 from scipy import sparse
 
 
@@ -47,12 +48,17 @@ class GCVAE(GVAE):
             E: Edge attribute matrix of size n*n*n_r
             F: Node attribute matrix of size n*n_e
         """
-        (A, E, F) = args_in
-        self.edge_count = torch.norm(A[0], p=1)
-        bs = A.shape[0]
+        if isinstance(args_in, GraphBatch):
+            # The graph convolution multiplies the compact node features directly.
+            A, features = args_in.adjacency(), args_in
+            self.edge_count = args_in.edge_count(0)
+        else:
+            (A, E, F) = args_in
+            self.edge_count = torch.norm(A[0], p=1)
+            bs = A.shape[0]
 
-        # We reshape E to (bs,n,n*d_e) and then concat it with F
-        # features = np.concatenate((np.reshape(E, (bs, self.n, self.n*self.n_r)), F), axis=-1)
-        features = torch.cat((torch.reshape(E, (bs, self.n, self.n*self.n_r)), F), -1)
+            # We reshape E to (bs,n,n*d_e) and then concat it with F
+            # features = np.concatenate((np.reshape(E, (bs, self.n, self.n*self.n_r)), F), axis=-1)
+            features = torch.cat((torch.reshape(E, (bs, self.n, self.n*self.n_r)), F), -1)
         # features = torch.Tensor(np.array(features))
         return torch.split(self.encoder(features, A), self.z_dim, dim=1)
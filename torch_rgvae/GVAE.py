@@ -9,6 +9,7 @@ from torch_rgvae.decoders import *
 from torch_rgvae.losses import *
 from utils.utils import *
 from utils.lp_utils import d
+from utils.graph_batch import GraphBatch
 
 
 class GVAE(nn.Module):
@@ -62,7 +63,13 @@ class GVAE(nn.Module):
             A: Adjacency matrix of size n*n
             E: Edge attribute matrix of size n*n*n_r
             F: Node attribute matrix of size n*n_e
+        A GraphBatch is not densified, the first layer only sums the weights of its nonzero inputs.
         """
+        if isinstance(args_in, GraphBatch):
+            self.edge_count = args_in.edge_count(0)
+            x = self.encoder.mlp[1:](args_in.flat_linear(self.encoder.mlp[0]))
+            return torch.split(x, self.z_dim, dim=1)
+
         (A, E, F) = args_in
         self.edge_count = torch.norm(A[0], p=1)
 
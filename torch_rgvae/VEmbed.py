@@ -6,7 +6,11 @@ from torch_rgvae.decoders import DistMult
 
 
 class Venco(nn.Module):
-    def __init__(self, n_e: int, n_r: int, z_dim: int, var: bool=True):
+    def __init__(self, n_e: int, n_r: int, z_dim: int, var: bool=True, sparse: bool=False):
+        """
+        :param sparse: If true, the embedding tables have sparse gradients, so an optimizer step only touches
+                       the rows of the batch. Needs a sparse aware optimizer like SparseAdam or Adagrad.
+        """
         super().__init__()
         self.z_dim = z_dim
         self.n_e = n_e
@@ -15,8 +19,8 @@ class Venco(nn.Module):
         # self.model_params = args
 
         # Encoder
-        self.e_embed = nn.Embedding(n_e, 2*self.z_dim)
-        self.r_embed = nn.Embedding(n_r, 2*self.z_dim)
+        self.e_embed = nn.Embedding(n_e, 2*self.z_dim, sparse=sparse)
+        self.r_embed = nn.Embedding(n_r, 2*self.z_dim, sparse=sparse)
 
     def encode(self, s, r, o):
         """
@@ -30,10 +34,12 @@ class Venco(nn.Module):
 
     def reparameterize(self, mean_logvar):
         """
-        Reparametrization trick.
+        Reparametrization trick. In eval mode the mean is returned, which makes the scores deterministic.
         """
         self.mean = mean = mean_logvar[:, :, :self.z_dim]
         self.logvar = logvar = mean_logvar[:, :, self.z_dim:]
+        if not self.training:
+            return mean
         if self.var:
             eps = torch.normal(torch.zeros_like(mean), std=1.).to(d())
         else:
@@ -48,7 +54,7 @@ class VLinkPredictor(nn.Module):
     """
 
     def __init__(self, triples, n, r, embedding=512, decoder='distmult', edropout=None, rdropout=None, init=0.85,
-                 biases=False, init_method='uniform', init_parms=(-1.0, 1.0), reciprocal=False):
+                 biases=False, init_method='uniform', init_parms=(-1.0, 1.0), reciprocal=False, sparse=False):
 
         super().__init__()
 
@@ -67,7 +73,8 @@ class VLinkPredictor(nn.Module):
         #     self.relations_backward = nn.Parameter(torch.FloatTensor(r, self.e).uniform_(-init, init))
         #     initialize(self.relations, init_method, init_parms)
 
-        self.encoder = Venco(n, r, embedding)
+        self.sparse = sparse
+        self.encoder = Venco(n, r, embedding, sparse=sparse)
 
         if decoder == 'distmult':
             self.decoder = DistMult(embedding)
@@ -136,6 +143,25 @@ class VLinkPredictor(nn.Module):
 
         return scores
 
+    def score_1n(self, s=None, p=None, o=None, chunk: int=2**14):
+        """
+        Scores tail prediction (s, p, ?) or head prediction (?, p, o) queries against all entities, for evaluation.
+        Uses the deterministic means, computes the query vector once and multiplies it with the entity table
+        in chunks of entities. Gives the same scores as forward in eval mode.
+        :param s: (bn,) subjects for tail prediction, None for head prediction.
+        :param p: (bn,) relations.
+        :param o: (bn,) objects for head prediction, None for tail prediction.
+        :param chunk: number of entities per matmul.
+        :return: (bn, n) score matrix.
+        """
+        assert (s is None) != (o is None), 'Give either the subjects or the objects'
+        z_dim = self.encoder.z_dim
+        entities = self.encoder.e_embed.weight[:, :z_dim]
+        relations = self.encoder.r_embed.weight[p, :z_dim]
+        query = relations * (entities[s] if o is None else entities[o])        # distmult is symmetric in s and o
+
+        return torch.cat([torch.matmul(query, entities[fr:fr + chunk].t()) for fr in range(0, self.n, chunk)], dim=1)
+
     def penalty(self, rweight, p, which):
 
         # TODO implement weighted penalty
@@ -151,3 +177,17 @@ class VLinkPredictor(nn.Module):
             params = [p.abs() for p in params]
 
         return (rweight / p) * sum([(p ** p).sum() for p in params])
+
+
+def load_vlinkpredictor(path: str):
+    """
+    Loads a VLinkPredictor checkpoint as saved by experiments.lp_vembed.train_lp_vembed.
+    :param path: path to the vembed.pt checkpoint.
+    :return: the model in eval mode on the default device.
+    """
+    checkpoint = torch.load(path, map_location=torch.device(d()))
+    model = VLinkPredictor(torch.zeros((0, 3), dtype=torch.long), checkpoint['n_e'], checkpoint['n_r'],
+                           embedding=checkpoint['embedding'], reciprocal=checkpoint['reciprocal'],
+                           sparse=checkpoint['sparse'] if 'sparse' in checkpoint else False)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    return model.to(d()).train(False)
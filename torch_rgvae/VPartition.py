@@ -0,0 +1,236 @@
+import os, json
+import numpy as np
+import torch
+from torch_rgvae.VEmbed import VLinkPredictor
+
+
+def bucket_bounds(n_e: int, n_buckets: int):
+    """
+    Splits the entity ids into n_buckets contiguous ranges of (almost) equal size.
+    :return: (n_buckets + 1,) array, bucket i holds the entities bounds[i] up to bounds[i+1].
+    """
+    return np.array([(i * n_e) // n_buckets for i in range(n_buckets + 1)], dtype=np.int64)
+
+def adagrad_(param, state, lr: float, eps: float=1e-10):
+    """
+    In place Adagrad step with an explicit state tensor, so the state can be stored next to its partition.
+    Rows without gradient are left untouched.
+    """
+    grad = param.grad
+    if grad is None:
+        return
+    if grad.is_sparse:
+        grad = grad.coalesce()
+        rows, values = grad.indices()[0], grad.values()
+        state[rows] += values * values
+        param.data[rows] -= lr * values / (state[rows].sqrt() + eps)
+    else:
+        state.add_(grad * grad)
+        param.data.addcdiv_(grad, state.sqrt().add_(eps), value=-lr)
+
+
+class BucketedTriples():
+    """
+    Triple store split in edge blocks by the bucket of the head and of the tail entity.
+    Every non empty block (i, j) is a separate (k, 3) int64 .npy file, read memory mapped.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.n_e, self.n_buckets = meta['n_e'], meta['n_buckets']
+        self.bounds = np.array(meta['bounds'], dtype=np.int64)
+        self.counts = {tuple(int(b) for b in key.split('_')): count for key, count in meta['counts'].items()}
+
+    @classmethod
+    def build(cls, triples, n_e: int, n_buckets: int, path: str, chunk: int=2**22):
+        """
+        Writes the bucketed store in two passes over the triples, chunk triples at a time, so the triples can
+        themselves be a memory mapped array that does not fit in memory.
+        :param triples: (N, 3) array of (s, p, o) ids.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        bounds = bucket_bounds(n_e, n_buckets)
+        triples = triples if isinstance(triples, np.ndarray) else np.asarray(triples, dtype=np.int64)
+
+        def block_keys(part):
+            heads = np.searchsorted(bounds, part[:, 0], side='right') - 1
+            tails = np.searchsorted(bounds, part[:, 2], side='right') - 1
+            return heads * n_buckets + tails
+
+        counts = np.zeros(n_buckets * n_buckets, dtype=np.int64)
+        for fr in range(0, triples.shape[0], chunk):
+            counts += np.bincount(block_keys(triples[fr:fr + chunk]), minlength=n_buckets * n_buckets)
+
+        blocks = {key: np.lib.format.open_memmap(os.path.join(path, 'block_{}_{}.npy'.format(key // n_buckets, key % n_buckets)),
+                                                 mode='w+', dtype=np.int64, shape=(int(counts[key]), 3))
+                  for key in np.nonzero(counts)[0]}
+        filled = np.zeros_like(counts)
+        for fr in range(0, triples.shape[0], chunk):
+            part = np.asarray(triples[fr:fr + chunk], dtype=np.int64)
+            keys = block_keys(part)
+            for key in np.unique(keys):
+                rows = part[keys == key]
+                blocks[key][filled[key]:filled[key] + rows.shape[0]] = rows
+                filled[key] += rows.shape[0]
+        for block in blocks.values():
+            block.flush()
+
+        meta = {'n_e': n_e, 'n_buckets': n_buckets, 'bounds': bounds.tolist(),
+                'counts': {'{}_{}'.format(key // n_buckets, key % n_buckets): int(counts[key]) for key in np.nonzero(counts)[0]}}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        return cls(path)
+
+    def blocks(self):
+        """
+        :return: list of the (i, j) keys of the non empty blocks.
+        """
+        return sorted(self.counts.keys())
+
+    def block(self, i: int, j: int):
+        """
+        :return: memory mapped (k, 3) array with the triples from bucket i to bucket j.
+        """
+        if (i, j) not in self.counts:
+            return np.zeros((0, 3), dtype=np.int64)
+        return np.load(os.path.join(self.path, 'block_{}_{}.npy'.format(i, j)), mmap_mode='r')
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+
+class PartitionedEmbeddings():
+    """
+    Out of core entity table of a VLinkPredictor. The rows of every entity bucket, in the mean and logvar layout of
+    Venco, and their Adagrad state are separate memory mapped .npy files. The small relation table stays in memory.
+    The folder is also the checkpoint: meta.json, entities_<i>.npy, entities_<i>_sum.npy, relations.npy and
+    relations_sum.npy, so a training run can resume from it and single partitions can be copied or inspected.
+    meta.json holds the last finished epoch and the number of edge blocks of the next epoch already written back, it is
+    updated after the partitions and relations of a block, so a run interrupted within a block repeats only that block.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.n_e, self.n_r, self.z_dim = self.meta['n_e'], self.meta['n_r'], self.meta['z_dim']
+        self.n_buckets = self.meta['n_buckets']
+        self.bounds = np.array(self.meta['bounds'], dtype=np.int64)
+        self.relations = torch.from_numpy(np.load(os.path.join(path, 'relations.npy')))
+        self.relations_sum = torch.from_numpy(np.load(os.path.join(path, 'relations_sum.npy')))
+
+    @classmethod
+    def create(cls, path: str, n_e: int, n_r: int, z_dim: int, n_buckets: int, seed: int=0):
+        """
+        Initializes the partitions one at a time, with the normal initialization of nn.Embedding.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        bounds = bucket_bounds(n_e, n_buckets)
+        dtype = torch.empty(0).numpy().dtype
+        generator = torch.Generator().manual_seed(seed)
+        for i in range(n_buckets):
+            size = int(bounds[i + 1] - bounds[i])
+            rows = np.lib.format.open_memmap(cls.file(path, i), mode='w+', dtype=dtype, shape=(size, 2 * z_dim))
+            rows[:] = torch.randn(size, 2 * z_dim, generator=generator).numpy()
+            rows.flush()
+            state = np.lib.format.open_memmap(cls.file(path, i, '_sum'), mode='w+', dtype=dtype, shape=(size, 2 * z_dim))
+            state[:] = 0
+            state.flush()
+        np.save(os.path.join(path, 'relations.npy'), torch.randn(n_r, 2 * z_dim, generator=generator).numpy())
+        np.save(os.path.join(path, 'relations_sum.npy'), np.zeros((n_r, 2 * z_dim), dtype=dtype))
+        meta = {'n_e': n_e, 'n_r': n_r, 'z_dim': z_dim, 'n_buckets': n_buckets, 'bounds': bounds.tolist(), 'epoch': -1, 'block': 0}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        return cls(path)
+
+    @staticmethod
+    def file(path: str, i: int, suffix: str=''):
+        return os.path.join(path, 'entities_{}{}.npy'.format(i, suffix))
+
+    def partition(self, i: int, suffix: str=''):
+        """
+        :return: the rows (or with suffix '_sum' the Adagrad state) of bucket i, memory mapped for writing.
+        """
+        return np.load(self.file(self.path, i, suffix), mmap_mode='r+')
+
+    def buckets(self, i: int, j: int):
+        return [i] if i == j else [i, j]
+
+    def load(self, i: int, j: int):
+        """
+        Loads the partitions of an edge block into a VLinkPredictor over only those entities, local ids are
+        given by localize. At most two partitions are resident at any time.
+        :return: the model and its entity and relation Adagrad states.
+        """
+        rows = np.concatenate([np.asarray(self.partition(b)) for b in self.buckets(i, j)], axis=0)
+        state = np.concatenate([np.asarray(self.partition(b, '_sum')) for b in self.buckets(i, j)], axis=0)
+        model = VLinkPredictor(torch.zeros((0, 3), dtype=torch.long), rows.shape[0], self.n_r, embedding=self.z_dim)
+        with torch.no_grad():
+            model.encoder.e_embed.weight.copy_(torch.from_numpy(rows))
+            model.encoder.r_embed.weight.copy_(self.relations)
+        return model, {'entities': torch.from_numpy(state), 'relations': self.relations_sum.clone()}
+
+    def store(self, model, state, i: int, j: int):
+        """
+        Writes the trained rows and Adagrad states of an edge block back to their partitions, and the relations with
+        their Adagrad state. Call save to record the progress in meta.json afterwards.
+        """
+        rows = model.encoder.e_embed.weight.detach().cpu().numpy()
+        entity_state = state['entities'].cpu().numpy()
+        fr = 0
+        for b in self.buckets(i, j):
+            size = int(self.bounds[b + 1] - self.bounds[b])
+            for suffix, source in [('', rows), ('_sum', entity_state)]:
+                partition = self.partition(b, suffix)
+                partition[:] = source[fr:fr + size]
+                partition.flush()
+            fr += size
+        self.relations = model.encoder.r_embed.weight.detach().cpu().clone()
+        self.relations_sum = state['relations'].cpu().clone()
+        for name, tensor in [('relations', self.relations), ('relations_sum', self.relations_sum)]:
+            np.save(os.path.join(self.path, name + '.tmp.npy'), tensor.numpy())
+            os.replace(os.path.join(self.path, name + '.tmp.npy'), os.path.join(self.path, name + '.npy'))
+
+    def localize(self, triples, i: int, j: int):
+        """
+        Maps the global ids of the triples in block (i, j) to the row ids of the model given by load.
+        """
+        local = triples.clone()
+        local[:, 0] -= int(self.bounds[i])
+        offset = 0 if i == j else int(self.bounds[i + 1] - self.bounds[i])
+        local[:, 2] += offset - int(self.bounds[j])
+        return local
+
+    def candidates(self, i: int, j: int):
+        """
+        Local head, relation and tail corruption candidates of block (i, j), negatives stay within the block.
+        """
+        size_i = int(self.bounds[i + 1] - self.bounds[i])
+        offset = 0 if i == j else size_i
+        heads = torch.arange(size_i)
+        tails = torch.arange(offset, offset + int(self.bounds[j + 1] - self.bounds[j]))
+        return heads, torch.arange(self.n_r), tails
+
+    def save(self, epoch: int, block: int=0):
+        """
+        Records the progress of the checkpoint, the partitions and relations are already written by store.
+        :param epoch: last finished epoch.
+        :param block: number of edge blocks of epoch + 1 already written back.
+        """
+        self.meta['epoch'], self.meta['block'] = epoch, block
+        with open(os.path.join(self.path, 'meta.tmp.json'), 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(os.path.join(self.path, 'meta.tmp.json'), os.path.join(self.path, 'meta.json'))
+
+    def to_vlinkpredictor(self):
+        """
+        Assembles the full in memory VLinkPredictor, for evaluation on graphs that still fit in memory.
+        """
+        model = VLinkPredictor(torch.zeros((0, 3), dtype=torch.long), self.n_e, self.n_r, embedding=self.z_dim)
+        with torch.no_grad():
+            for b in range(self.n_buckets):
+                model.encoder.e_embed.weight[self.bounds[b]:self.bounds[b + 1]] = torch.from_numpy(np.asarray(self.partition(b)))
+            model.encoder.r_embed.weight.copy_(self.relations)
+        return model
@@ -4,6 +4,7 @@ from torch.nn.modules.module import Module
 from torch.nn.parameter import Parameter
 from torch import nn
 import math
+from utils.graph_batch import GraphBatch
 
 
 class RelationalGraphConvolutionRP(Module):
@@ -222,7 +223,10 @@ class GraphConvolution(Module):
             self.bias.data.uniform_(-stdv, stdv)
 
     def forward(self, input, adj):
-        support = torch.matmul(input, self.weight)
+        if isinstance(input, GraphBatch):
+            support = input.node_matmul(self.weight)
+        else:
+            support = torch.matmul(input, self.weight)
         output = torch.matmul(adj, support)
         if self.bias is not None:
             return output + self.bias
@@ -3,6 +3,7 @@ Collection of loss functions.
 """
 from graph_matching.MPGM import MPGM
 from utils.utils import *
+from utils.graph_batch import GraphBatch
 import wandb, torch
 import torch.nn as nn
 
@@ -17,10 +18,17 @@ def graph_CEloss(target, prediction, softmax_E: bool=True, l_A=1., l_E=1., l_F=1
         l_E: weight for BCE or CE of E
         l_F: weight for CE of F
         softmax_E: use CE for E
+    A GraphBatch target is not densified, the cross entropies take its labels and only A is built.
     """
-    # Cast target vectors to tensors.
-    A, E, F = target
     A_hat, E_hat, F_hat = prediction
+    if isinstance(target, GraphBatch):
+        A = target.adjacency()
+        E_labels, F_labels = target.edge_labels(), target.node_labels()
+        E = None if softmax_E else target[1]
+    else:
+        # Cast target vectors to tensors.
+        A, E, F = target
+        E_labels, F_labels = torch.argmax(E, -1, keepdim=False), torch.argmax(F, -1, keepdim=False)
 
     # Define loss function
     bce = torch.nn.BCELoss()
@@ -28,12 +36,12 @@ def graph_CEloss(target, prediction, softmax_E: bool=True, l_A=1., l_E=1., l_F=1
     sigmoid = nn.Sigmoid()
 
     if softmax_E:
-        log_p_E = l_E*cce(E_hat.permute(0,3,1,2), torch.argmax(E, -1, keepdim=False))
+        log_p_E = l_E*cce(E_hat.permute(0,3,1,2), E_labels)
     else:
         log_p_E = l_E*bce(sigmoid(E_hat), E)
         
     log_p_A = l_A*bce(sigmoid(A_hat), A)
-    log_p_F = l_F*cce(F_hat.permute(0,2,1), torch.argmax(F, -1, keepdim=False))
+    log_p_F = l_F*cce(F_hat.permute(0,2,1), F_labels)
 
     # Weight and add loss
     log_p = - log_p_A - log_p_E - log_p_F
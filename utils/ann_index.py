@@ -0,0 +1,184 @@
+import time
+import numpy as np
+import torch
+
+
+def kmeans(x, k: int, iters: int=20, seed: int=0):
+    """
+    Plain Lloyd k-means in numpy, the squared distances are computed with one matrix product per iteration.
+    :param x: (N, d) array.
+    :param k: number of centroids, at most N.
+    :return: (k, d) centroids and the (N,) assignments.
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, x.shape[0])
+    centroids = x[rng.choice(x.shape[0], k, replace=False)].copy()
+    sq = (x * x).sum(1, keepdims=True)
+    for _ in range(iters):
+        dist = sq - 2 * x @ centroids.T + (centroids * centroids).sum(1)
+        assign = dist.argmin(1)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        full = counts > 0
+        centroids[full] = sums[full] / counts[full, None]
+        # An empty cluster takes over the point furthest from its centroid.
+        for c in np.nonzero(~full)[0]:
+            centroids[c] = x[dist[np.arange(x.shape[0]), assign].argmax()]
+    dist = sq - 2 * x @ centroids.T + (centroids * centroids).sum(1)
+    return centroids, dist.argmin(1)
+
+
+class IVFPQIndex():
+    """
+    Inverted file index with product quantized residuals for maximum inner product search over entity embeddings.
+    The entities are clustered into n_list coarse cells, the residual to the cell centroid is split into m subvectors
+    and each is stored as the id of its nearest subcentroid (one byte for up to 256 subcentroids).
+    A query scores the coarse centroids, probes the n_probe best cells and sums per subvector lookup tables over the
+    codes of their entities: q.x ~ q.c + sum_m q_m.codebook_m[code_m]. The best rerank of those are optionally rescored
+    exactly with the stored vectors.
+    """
+    def __init__(self, coarse, codebooks, list_offsets, ids, codes, vectors=None):
+        self.coarse = coarse                    # (n_list, d)
+        self.codebooks = codebooks              # (m, ksub, d / m)
+        self.list_offsets = list_offsets        # (n_list + 1,) into ids and codes
+        self.ids = ids                          # (N,) entity ids, sorted by cell
+        self.codes = codes                      # (N, m) uint8
+        self.vectors = vectors                  # (N, d) in the order of ids or None
+        self.m, self.ksub, self.dsub = codebooks.shape
+
+    @classmethod
+    def build(cls, vectors, n_list: int=64, m: int=16, ksub: int=256, iters: int=20, keep_vectors: bool=True, seed: int=0):
+        """
+        :param vectors: (N, d) array or tensor of entity embeddings, d divisible by m.
+        :param n_list: number of coarse cells.
+        :param m: number of subvectors per residual.
+        :param ksub: number of subcentroids per subvector, at most 256.
+        :param keep_vectors: If true, the raw vectors are kept for exact reranking.
+        """
+        vectors = np.ascontiguousarray(vectors.detach().cpu().numpy() if torch.is_tensor(vectors) else vectors, dtype=np.float32)
+        n, dim = vectors.shape
+        assert dim % m == 0, f'Dimension {dim} is not divisible by {m} subvectors'
+        assert ksub <= 256, 'Codes are stored in one byte'
+
+        coarse, cells = kmeans(vectors, n_list, iters=iters, seed=seed)
+        residuals = vectors - coarse[cells]
+        dsub = dim // m
+        codebooks = np.zeros((m, min(ksub, n), dsub), dtype=np.float32)
+        codes = np.zeros((n, m), dtype=np.uint8)
+        for sub in range(m):
+            codebooks[sub], codes[:, sub] = kmeans(residuals[:, sub * dsub:(sub + 1) * dsub], ksub, iters=iters, seed=seed + sub + 1)
+
+        order = np.argsort(cells, kind='stable')
+        list_offsets = np.searchsorted(cells[order], np.arange(coarse.shape[0] + 1)).astype(np.int64)
+        return cls(coarse, codebooks, list_offsets, order.astype(np.int64), codes[order],
+                   vectors[order] if keep_vectors else None)
+
+    def search(self, queries, k: int=10, n_probe: int=8, rerank: int=0):
+        """
+        :param queries: (nq, d) array or tensor of query vectors, for DistMult the elementwise product s * p.
+        :param n_probe: number of coarse cells scanned per query.
+        :param rerank: number of quantized candidates rescored with the exact vectors, 0 for none.
+        :return: (nq, k) arrays of entity ids and their scores, best first.
+        """
+        queries = np.ascontiguousarray(queries.detach().cpu().numpy() if torch.is_tensor(queries) else queries, dtype=np.float32)
+        queries = queries.reshape(-1, self.coarse.shape[1])
+        n_probe = min(n_probe, self.coarse.shape[0])
+        coarse_scores = queries @ self.coarse.T
+        probes = np.argpartition(-coarse_scores, n_probe - 1, axis=1)[:, :n_probe]
+        # (nq, m, ksub) lookup tables of the inner products of the query subvectors with the subcentroids
+        luts = np.einsum('qmd,mkd->qmk', queries.reshape(-1, self.m, self.dsub), self.codebooks)
+        subs = np.arange(self.m)
+
+        ids = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        for qi in range(queries.shape[0]):
+            rows = np.concatenate([np.arange(self.list_offsets[c], self.list_offsets[c + 1]) for c in probes[qi]])
+            cells = np.repeat(probes[qi], np.diff(self.list_offsets)[probes[qi]])
+            approx = coarse_scores[qi, cells] + luts[qi][subs, self.codes[rows]].sum(1)
+            if rerank > 0 and self.vectors is not None:
+                keep = self.top(approx, max(rerank, k))
+                rows, approx = rows[keep], self.vectors[rows[keep]] @ queries[qi]
+            best = self.top(approx, k)
+            ids[qi, :best.shape[0]], scores[qi, :best.shape[0]] = self.ids[rows[best]], approx[best]
+        return ids, scores
+
+    @staticmethod
+    def top(scores, k: int):
+        """
+        Indices of the k highest scores, best first.
+        """
+        if scores.shape[0] > k:
+            part = np.argpartition(-scores, k - 1)[:k]
+        else:
+            part = np.arange(scores.shape[0])
+        return part[np.argsort(-scores[part], kind='stable')]
+
+    def save(self, path: str):
+        arrays = {'coarse': self.coarse, 'codebooks': self.codebooks, 'list_offsets': self.list_offsets, 'ids': self.ids, 'codes': self.codes}
+        if self.vectors is not None:
+            arrays['vectors'] = self.vectors
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            return cls(data['coarse'], data['codebooks'], data['list_offsets'], data['ids'], data['codes'],
+                       data['vectors'] if 'vectors' in data.files else None)
+
+
+def entity_vectors(model):
+    """
+    Mean entity embeddings of a VLinkPredictor, the logvar half of the table is dropped.
+    """
+    return model.encoder.e_embed.weight[:, :model.encoder.z_dim].detach()
+
+def query_vectors(model, s, p):
+    """
+    DistMult query vectors for (s, p, ?) queries. DistMult is symmetric, so (?, p, o) queries use o in place of s.
+    """
+    z_dim = model.encoder.z_dim
+    return (model.encoder.e_embed.weight[s, :z_dim] * model.encoder.r_embed.weight[p, :z_dim]).detach()
+
+def index_recall(index, model, queries, k: int=10, n_probe: int=8, rerank: int=0):
+    """
+    Recall@k of the index against exact 1-N scoring with model.score_1n, and the search latency.
+    :param queries: (nq, 2) tensor of (s, p) tail prediction queries.
+    :return: dict with the mean recall@k and the milliseconds per query.
+    """
+    with torch.no_grad():
+        model.train(False)
+        exact = torch.topk(model.score_1n(s=queries[:, 0], p=queries[:, 1]), k, dim=1).indices.cpu().numpy()
+        vectors = query_vectors(model, queries[:, 0], queries[:, 1])
+    start = time.perf_counter()
+    ids, _ = index.search(vectors, k=k, n_probe=n_probe, rerank=rerank)
+    elapsed = time.perf_counter() - start
+    recall = np.mean([len(set(a.tolist()) & set(b.tolist())) / k for a, b in zip(ids, exact)])
+    return {f'recall@{k}': float(recall), 'ms_per_query': 1000 * elapsed / queries.shape[0]}
+
+
+if __name__ == "__main__":
+    import argparse
+    from torch_rgvae.VEmbed import load_vlinkpredictor
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', dest='model_path', type=str, help='vembed.pt checkpoint of a VLinkPredictor')
+    parser.add_argument('--index_path', dest='index_path', type=str, default=None, help='Defaults to the checkpoint path with .ivfpq.npz')
+    parser.add_argument('--n_list', dest='n_list', type=int, default=64)
+    parser.add_argument('--m', dest='m', type=int, default=16)
+    parser.add_argument('--n_probe', dest='n_probe', type=int, default=8)
+    parser.add_argument('--rerank', dest='rerank', type=int, default=100)
+    parser.add_argument('--queries', dest='queries', type=int, default=1000)
+    arguments = parser.parse_args()
+
+    model = load_vlinkpredictor(arguments.model_path)
+    index_path = arguments.index_path or arguments.model_path.rsplit('.', 1)[0] + '.ivfpq.npz'
+    try:
+        index = IVFPQIndex.load(index_path)
+    except FileNotFoundError:
+        index = IVFPQIndex.build(entity_vectors(model), n_list=arguments.n_list, m=arguments.m)
+        index.save(index_path)
+
+    queries = torch.stack([torch.randint(model.n, (arguments.queries,)), torch.randint(model.r, (arguments.queries,))], dim=1).to(model.encoder.e_embed.weight.device)
+    for k in [1, 10, 100]:
+        print(index_recall(index, model, queries, k=k, n_probe=arguments.n_probe, rerank=arguments.rerank))
@@ -154,15 +154,18 @@ def eval(model : nn.Module, valset, truedicts, n, batch_size=16, hitsat=[1, 3, 1
             bases   = batch[:, 1:] if head else batch[:, :2]
             targets = batch[:, 0]  if head else batch[:, 2]
 
-            # collect the triples for which to compute scores
-            bexp = bases.view(bn, 1, 2).expand(bn, n, 2)
-            ar   = torch.arange(n, device=d()).view(1, n, 1).expand(bn, n, 1)
-            toscore = torch.cat([ar, bexp] if head else [bexp, ar], dim=2)
-            assert toscore.size() == (bn, n, 3)
-
             tic()
+            if hasattr(model, 'score_1n'):
+                # one matmul per query against the whole entity table
+                scores = model.score_1n(p=bases[:, 0], o=bases[:, 1]) if head else model.score_1n(s=bases[:, 0], p=bases[:, 1])
+            else:
+                # collect the triples for which to compute scores
+                bexp = bases.view(bn, 1, 2).expand(bn, n, 2)
+                ar   = torch.arange(n, device=d()).view(1, n, 1).expand(bn, n, 1)
+                toscore = torch.cat([ar, bexp] if head else [bexp, ar], dim=2)
+                assert toscore.size() == (bn, n, 3)
 
-            scores = model(toscore[:,:,0], toscore[:,:,1], toscore[:,:,2])
+                scores = model(toscore[:,:,0], toscore[:,:,1], toscore[:,:,2])
             tforward += toc()
             assert scores.size() == (bn, n)
 
@@ -0,0 +1,193 @@
+"""
+Entity text and type lookups aligned with the compiled vocabulary of a dataset.
+"""
+import os, json
+import numpy as np
+import torch
+from utils.lp_utils import compile_link_prediction_data, dataset_files, file_sha1
+
+
+class EntityStore():
+    """
+    Text and types of every entity id, built once from entity2text.txt and entity2type.txt next to the dataset.
+    The utf-8 texts are one byte array with an (n_e + 1,) offset array, the types one packed bitset over the entities
+    per type. The arrays are memory mapped on first use, so forked or spawned workers share the pages, and a pickled
+    store only carries its folder. A store built without a type file raises on every type lookup.
+    """
+    def __init__(self, folder: str):
+        self.folder = folder
+        with open(os.path.join(folder, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.n_e = self.meta['n_e']
+        self._arrays = None
+        self._types = None
+
+    def __getstate__(self):
+        return {'folder': self.folder}
+
+    def __setstate__(self, state):
+        self.__init__(state['folder'])
+
+    @classmethod
+    def build(cls, i2n, folder: str, text_file: str, type_file: str=None, sha1=None):
+        """
+        :param i2n: entity names in id order.
+        :param text_file: tab separated entity name and text per line. Entities without text keep their name.
+        :param type_file: tab separated entity name and whitespace separated types per line, or None if there are no types.
+        :param sha1: hashes of the sources the store is built from, kept in meta.json.
+        """
+        n2i = {n: i for i, n in enumerate(i2n)}
+        texts = list(i2n)
+        with open(text_file, 'r') as f:
+            for line in f:
+                name, text = line.rstrip('\n').split('\t', 1)
+                if name in n2i:
+                    texts[n2i[name]] = text
+        encoded = [t.encode('utf-8') for t in texts]
+        offsets = np.concatenate([[0], np.cumsum([len(t) for t in encoded])]).astype(np.int64)
+
+        type_ids, ents, tids = dict(), list(), list()
+        typed = np.zeros(len(i2n), dtype=bool)
+        if type_file is not None:
+            with open(type_file, 'r') as f:
+                for line in f:
+                    name, types = line.rstrip('\n').split('\t', 1)
+                    if name not in n2i:
+                        continue
+                    typed[n2i[name]] = True
+                    for t in types.split():
+                        ents.append(n2i[name])
+                        tids.append(type_ids.setdefault(t, len(type_ids)))
+        ents, tids = np.asarray(ents, dtype=np.int64), np.asarray(tids, dtype=np.int64)
+        # Bit e of a row is set if the entity has the type, in the big endian bit order of np.packbits.
+        bits = np.zeros((len(type_ids), (len(i2n) + 7) // 8), dtype=np.uint8)
+        np.bitwise_or.at(bits, (tids, ents >> 3), (128 >> (ents & 7)).astype(np.uint8))
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        np.save(os.path.join(folder, 'text_offsets.npy'), offsets)
+        np.save(os.path.join(folder, 'text.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        np.save(os.path.join(folder, 'type_bits.npy'), bits)
+        np.save(os.path.join(folder, 'typed.npy'), np.packbits(typed))
+        with open(os.path.join(folder, 'types.txt'), 'w') as f:
+            f.write('\n'.join(type_ids))
+        with open(os.path.join(folder, 'meta.json'), 'w') as f:
+            json.dump({'n_e': len(i2n), 'n_types': len(type_ids), 'types': type_file is not None, 'sha1': sha1}, f)
+        return cls(folder)
+
+    def arrays(self):
+        """
+        :return: the memory mapped text offsets, text bytes, type bitsets and typed bitset, opened on the first call.
+        """
+        if self._arrays is None:
+            self._arrays = tuple(self.load(name) for name in ['text_offsets', 'text', 'type_bits', 'typed'])
+        return self._arrays
+
+    def load(self, name: str):
+        path = os.path.join(self.folder, name + '.npy')
+        try:
+            return np.load(path, mmap_mode='r')
+        except ValueError:      # empty arrays cannot be memory mapped
+            return np.load(path)
+
+    def types(self):
+        """
+        :return: type names in the order of the bitset rows.
+        """
+        if self._types is None:
+            with open(os.path.join(self.folder, 'types.txt'), 'r') as f:
+                self._types = f.read().split('\n') if self.meta['n_types'] > 0 else []
+        return self._types
+
+    def __len__(self):
+        return self.n_e
+
+    def texts(self, ids):
+        """
+        :param ids: sequence, array or tensor of entity ids.
+        :return: list of their texts, every distinct entity is decoded once.
+        """
+        ids = ids.detach().cpu().numpy() if torch.is_tensor(ids) else np.asarray(ids, dtype=np.int64)
+        offsets, text, _, _ = self.arrays()
+        unique, inverse = np.unique(ids.reshape(-1), return_inverse=True)
+        decoded = [bytes(text[offsets[e]:offsets[e + 1]]).decode('utf-8') for e in unique]
+        return [decoded[i] for i in inverse]
+
+    def translate(self, triples, i2r):
+        """
+        Batched version of translate_triple.
+        :param triples: (N, 3) sequence, array or tensor of (s, r, o) ids.
+        :return: list of (subject text, relation name, object text).
+        """
+        triples = triples.detach().cpu().numpy() if torch.is_tensor(triples) else np.asarray(triples, dtype=np.int64)
+        triples = triples.reshape(-1, 3)
+        texts = self.texts(triples[:, [0, 2]])
+        return [(texts[2*k], i2r[r], texts[2*k + 1]) for k, r in enumerate(triples[:, 1].tolist())]
+
+    def require_types(self):
+        """
+        Raises a FileNotFoundError if the store was built without a type file.
+        """
+        if not self.meta.get('types', self.meta['n_types'] > 0):     # stores from before the flag
+            raise FileNotFoundError('The entity store {} was built without a type file, add an entity2type.txt next to '
+                                    'the dataset for type lookups.'.format(self.folder))
+
+    def type_mask(self, key: str):
+        """
+        :return: (n_e,) bool array of the entities with a type containing key.
+        """
+        self.require_types()
+        _, _, bits, _ = self.arrays()
+        rows = [i for i, t in enumerate(self.types()) if key in t]
+        if len(rows) == 0:
+            return np.zeros(self.n_e, dtype=bool)
+        return np.unpackbits(np.bitwise_or.reduce(bits[rows], axis=0), count=self.n_e).astype(bool)
+
+    def type_pairs(self):
+        """
+        :return: entity ids and type ids, the rows of the bitsets, of every entity and type it carries.
+        """
+        self.require_types()
+        _, _, bits, _ = self.arrays()
+        ents = [np.nonzero(np.unpackbits(row, count=self.n_e))[0] for row in bits]
+        tids = [np.full(len(e), t, dtype=np.int64) for t, e in enumerate(ents)]
+        if len(ents) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(ents).astype(np.int64), np.concatenate(tids)
+
+    def typed_mask(self):
+        """
+        :return: (n_e,) bool array of the entities listed in the type file.
+        """
+        self.require_types()
+        return np.unpackbits(self.arrays()[3], count=self.n_e).astype(bool)
+
+
+_stores = dict()
+
+def load_entity_store(name):
+    """
+    Opens the entity store of a dataset, building it in its compiled folder if it is missing or its sources changed.
+    Every process opens a store once.
+    :param name: Dataset name, the text and type files are data/<name>/entity2text.txt and entity2type.txt. Without
+                 the type file the store is built from the texts only and its type lookups raise.
+    """
+    if name in _stores:
+        return _stores[name]
+    compiled = compile_link_prediction_data(name)
+    data = os.path.dirname(dataset_files(name)[0])
+    sources = [os.path.join(compiled, 'entities.txt'), os.path.join(data, 'entity2text.txt'), os.path.join(data, 'entity2type.txt')]
+    sha1 = [file_sha1(f) if os.path.isfile(f) else None for f in sources]
+    folder = os.path.join(compiled, 'entity_store')
+
+    store = None
+    if os.path.isfile(os.path.join(folder, 'meta.json')):
+        store = EntityStore(folder)
+        if store.meta['sha1'] != sha1:
+            store = None
+    if store is None:
+        with open(sources[0], 'r') as f:
+            i2n = f.read().split('\n')
+        store = EntityStore.build(i2n, folder, sources[1], sources[2] if sha1[2] is not None else None, sha1=sha1)
+    _stores[name] = store
+    return store
@@ -0,0 +1,272 @@
+"""
+Compact batches of graphs, which only become dense A, E, F matrices when a consumer needs them.
+"""
+import torch
+
+
+def first_occurrence(x):
+    """
+    :param x: (bs, n) tensor.
+    :return: (bs, n) position of the first entry in the row equal to x, n if there is none, and the (bs, n, n)
+             equality matrix, eq[b, k, j] is x[b, k] == x[b, j].
+    """
+    n = x.size(1)
+    eq = x.unsqueeze(2) == x.unsqueeze(1)
+    ar = torch.arange(n, device=x.device).view(1, 1, n).expand_as(eq)
+    return ar.masked_fill(~eq, n).min(dim=2).values, eq
+
+def local_node_ids(triples):
+    """
+    Node ids of the subjects and objects of every graph in a batch, by the rule of the original per graph dict:
+    the unique subjects in order of first occurrence come first, then the unique objects. An entity which is both
+    subject and object gets the id of the object, so ids can have gaps.
+    :param triples: (bs, n, 3) long tensor.
+    :return: (bs, n) subject and object node ids.
+    """
+    bs, n, _ = triples.size()
+    s, o = triples[:, :, 0], triples[:, :, 2]
+    ar = torch.arange(n, device=triples.device).view(1, n)
+
+    def ranks(x):
+        first, _ = first_occurrence(x)
+        order = torch.cumsum(first == ar, dim=1) - 1        # rank among the unique entities of the graph
+        return order.gather(1, first), (first == ar).sum(dim=1, keepdim=True)
+
+    s_rank, n_heads = ranks(s)
+    o_rank, _ = ranks(o)
+    oid = n_heads + o_rank
+
+    # position of the first object equal to the subject, n if it is not an object
+    so = s.unsqueeze(2) == o.unsqueeze(1)
+    j = ar.view(1, 1, n).expand_as(so).masked_fill(~so, n).min(dim=2).values
+    sid = torch.where(j < n, oid.gather(1, j.clamp(max=n - 1)), s_rank)
+    return sid, oid
+
+
+class GraphBatchBuffer():
+    """
+    Ring of preallocated A, E, F tensors for densifying GraphBatches. Filling a slot only zeroes the entries its
+    previous batch set, so once the slots are allocated a training step does no large allocations. The slots are
+    reused round robin, a batch stays valid until slots more batches have been filled.
+    A slot is allocated on its first fill at the size of that batch and only regrown for a larger one. It holds
+    bs * n * (n * (1 + n_r) + n_e) elements of the default dtype, which the F part dominates for a large n_e, and it
+    stays allocated as long as the buffer lives. One slot is enough when every batch is consumed before the next fill.
+    """
+    def __init__(self, bs: int, n: int, n_e: int, n_r: int, slots: int=1):
+        """
+        :param bs: largest number of graphs per batch, only for the memory estimate, the slots are sized by the batches.
+        :param n: number of nodes per graph.
+        """
+        self.bs, self.n, self.n_e, self.n_r = bs, n, n_e, n_r
+        self.slots = [None] * slots
+        self.written = [None] * slots
+        self.next = 0
+        self.allocations = 0
+        self.fills = 0
+
+    def slot_bytes(self, bs: int=None):
+        """
+        :return: bytes of one slot holding bs graphs, the largest batch by default.
+        """
+        bs = self.bs if bs is None else bs
+        return bs * self.n * (self.n * (1 + self.n_r) + self.n_e) * torch.tensor([], dtype=torch.get_default_dtype()).element_size()
+
+    def allocate(self, bs: int, device):
+        self.allocations += 1
+        return (torch.zeros((bs, self.n, self.n), device=device),
+                torch.zeros((bs, self.n, self.n, self.n_r), device=device),
+                torch.zeros((bs, self.n, self.n_e), device=device))
+
+    def fill(self, batch):
+        """
+        :return: views of the next slot holding the dense A, E, F of the batch.
+        """
+        assert (batch.n, batch.n_e, batch.n_r) == (self.n, self.n_e, self.n_r), 'Batch shape does not fit the buffer'
+        i = self.next
+        self.next = (i + 1) % len(self.slots)
+        device = batch.edges.device
+        if self.slots[i] is None or batch.bs > self.slots[i][0].size(0) or self.slots[i][0].device != device:
+            size = batch.bs if self.slots[i] is None or self.slots[i][0].device != device else max(batch.bs, self.slots[i][0].size(0))
+            self.slots[i], self.written[i] = None, None      # release the old slot before allocating its replacement
+            self.slots[i] = self.allocate(size, device)
+
+        zero, one = torch.zeros((), device=device), torch.ones((), device=device)
+        if self.written[i] is not None:
+            for matrix, index in zip(self.slots[i], self.written[i]):
+                matrix.index_put_(index, zero)
+
+        g, s, r, o = batch.edges.unbind(1)
+        gn, node, entity = batch.node_entities()
+        self.written[i] = ((g, s, o), (g, s, o, r), (gn, node, entity))
+        for matrix, index in zip(self.slots[i], self.written[i]):
+            matrix.index_put_(index, one)
+        self.fills += 1
+        return tuple(matrix[:batch.bs] for matrix in self.slots[i])
+
+    def stats(self):
+        """
+        Allocator counters: the buffer allocations and fills, and on cuda the number of device allocations so far.
+        """
+        stats = {'allocations': self.allocations, 'fills': self.fills,
+                 'bytes': sum(m.numel() * m.element_size() for slot in self.slots if slot is not None for m in slot)}
+        if torch.cuda.is_available():
+            stats['cuda_allocations'] = torch.cuda.memory_stats().get('allocation.all.allocated', 0)
+        return stats
+
+
+class GraphBatch():
+    """
+    Batch of graphs as an edge list and the entity of every node, instead of one-hot A, E and F matrices.
+    Unpacking it, A, E, F = batch, densifies it once, so it can be passed to any code expecting the matrices.
+    The encoders and the cross entropy loss use the compact form directly, see flat_linear, node_matmul and the labels.
+    """
+    def __init__(self, edges, nodes, n_e: int, n_r: int, buffer: GraphBatchBuffer=None):
+        """
+        :param edges: (T, 4) long tensor of (graph, local subject, relation, local object).
+        :param nodes: (bs, N) long tensor with the entity of every node, -1 for unused nodes.
+        :param buffer: if given, dense writes into its preallocated tensors instead of allocating new ones.
+        """
+        self.edges = edges
+        self.nodes = nodes
+        self.mask = nodes >= 0
+        self.n_e, self.n_r = n_e, n_r
+        self.bs, self.n = nodes.shape
+        self.buffer = buffer
+        self._dense = None
+
+    @classmethod
+    def from_triples(cls, triples, n_e: int, n_r: int, buffer: GraphBatchBuffer=None):
+        """
+        :param triples: (bs, n, 3) long tensor, n triples per graph. Every graph gets 2n nodes.
+        """
+        bs, n, _ = triples.size()
+        sid, oid = local_node_ids(triples)
+        g = torch.arange(bs, device=triples.device).view(bs, 1).expand(bs, n)
+        edges = torch.stack([g, sid, triples[:, :, 1], oid], dim=2).view(-1, 4)
+        nodes = torch.full((bs, 2*n), -1, dtype=torch.long, device=triples.device)
+        nodes[g, sid] = triples[:, :, 0]
+        nodes[g, oid] = triples[:, :, 2]
+        return cls(edges, nodes, n_e, n_r, buffer=buffer)
+
+    def to(self, device, non_blocking: bool=False, buffer: GraphBatchBuffer=None):
+        return GraphBatch(self.edges.to(device, non_blocking=non_blocking), self.nodes.to(device, non_blocking=non_blocking),
+                          self.n_e, self.n_r, buffer=buffer if buffer is not None else self.buffer)
+
+    def pin_memory(self):
+        """
+        Called by the DataLoader when it pins batches.
+        """
+        return GraphBatch(self.edges.pin_memory(), self.nodes.pin_memory(), self.n_e, self.n_r)
+
+    def node_entities(self):
+        """
+        :return: graph ids, local node ids and entities of all used nodes.
+        """
+        g, node = torch.nonzero(self.mask, as_tuple=True)
+        return g, node, self.nodes[g, node]
+
+    def adjacency(self):
+        """
+        Dense A only, it is small compared to E and F.
+        """
+        if self._dense is not None:
+            return self._dense[0]
+        g, s, _, o = self.edges.unbind(1)
+        A = torch.zeros((self.bs, self.n, self.n), device=self.edges.device)
+        A.index_put_((g, s, o), torch.ones((), device=self.edges.device))
+        return A
+
+    def dense(self):
+        """
+        :return: A (bs, N, N), E (bs, N, N, n_r), F (bs, N, n_e), computed on the first call.
+        """
+        if self._dense is None and self.buffer is not None:
+            self._dense = self.buffer.fill(self)
+        if self._dense is None:
+            g, s, r, o = self.edges.unbind(1)
+            gn, node, entity = self.node_entities()
+            one = torch.ones((), device=self.edges.device)
+            E = torch.zeros((self.bs, self.n, self.n, self.n_r), device=self.edges.device)
+            F = torch.zeros((self.bs, self.n, self.n_e), device=self.edges.device)
+            E.index_put_((g, s, o, r), one)
+            F.index_put_((gn, node, entity), one)
+            self._dense = (self.adjacency(), E, F)
+        return self._dense
+
+    def __iter__(self):
+        return iter(self.dense())
+
+    def __getitem__(self, i):
+        return self.dense()[i]
+
+    def __len__(self):
+        return 3
+
+    def edge_count(self, graph: int=0):
+        """
+        Number of nonzero entries of A in one graph.
+        """
+        g, s, _, o = self.edges[self.edges[:, 0] == graph].unbind(1)
+        return torch.unique(s * self.n + o).numel()
+
+    def flat_linear(self, linear):
+        """
+        Applies a linear layer to the flattened and concatenated [A, E, F] input of the GVAE encoder, by summing the
+        weight columns of the nonzero inputs only.
+        :return: (bs, out_features) tensor.
+        """
+        N, n_r, n_e = self.n, self.n_r, self.n_e
+        assert linear.in_features == N*N + N*N*n_r + N*n_e
+        g, s, r, o = self.edges.unbind(1)
+        gn, node, entity = self.node_entities()
+        graphs = torch.cat([g, g, gn])
+        index = torch.cat([s*N + o, N*N + (s*N + o)*n_r + r, N*N + N*N*n_r + node*n_e + entity])
+        keys = torch.unique(graphs * linear.in_features + index)        # one-hot inputs are 1, not the edge count
+        graphs, index = keys // linear.in_features, keys % linear.in_features
+
+        out = torch.zeros((self.bs, linear.out_features), device=self.edges.device, dtype=linear.weight.dtype)
+        out = out.index_add(0, graphs, linear.weight[:, index].t())
+        return out + linear.bias if linear.bias is not None else out
+
+    def node_matmul(self, weight):
+        """
+        Multiplies the GCN node features, the flattened E rows concatenated with F, with a weight matrix.
+        :param weight: (N * n_r + n_e, out) tensor.
+        :return: (bs, N, out) tensor.
+        """
+        N, n_r = self.n, self.n_r
+        n_feat = weight.size(0)
+        g, s, r, o = self.edges.unbind(1)
+        gn, node, entity = self.node_entities()
+        rows = torch.cat([g*N + s, gn*N + node])
+        index = torch.cat([o*n_r + r, N*n_r + entity])
+        keys = torch.unique(rows * n_feat + index)
+        rows, index = keys // n_feat, keys % n_feat
+
+        out = torch.zeros((self.bs * N, weight.size(1)), device=self.edges.device, dtype=weight.dtype)
+        return out.index_add(0, rows, weight[index]).view(self.bs, N, -1)
+
+    def edge_labels(self):
+        """
+        Class labels of the E cross entropy, the argmax over the relations: the smallest relation of a node pair and
+        0 where there is no edge.
+        :return: (bs, N, N) long tensor.
+        """
+        g, s, r, o = self.edges.unbind(1)
+        labels = torch.zeros(self.bs * self.n * self.n, dtype=torch.long, device=self.edges.device)
+        labels.scatter_reduce_(0, (g*self.n + s)*self.n + o, r, reduce='amin', include_self=False)
+        return labels.view(self.bs, self.n, self.n)
+
+    def node_labels(self):
+        """
+        Class labels of the F cross entropy, the argmax over the entities, 0 for unused nodes.
+        :return: (bs, N) long tensor.
+        """
+        return self.nodes.clamp(min=0)
+
+    def triples(self):
+        """
+        :return: (T, 4) long tensor of (graph, subject entity, relation, object entity).
+        """
+        g, s, r, o = self.edges.unbind(1)
+        return torch.stack([g, self.nodes[g, s], r, self.nodes[g, o]], dim=1)
@@ -0,0 +1,208 @@
+"""
+Sharded on-disk store of compact graph batches, so repeated epochs and sweep runs skip graph construction.
+"""
+import os, json, hashlib
+from collections import OrderedDict
+import numpy as np
+import torch
+from utils.graph_batch import GraphBatch
+from utils.graph_data import SubgraphSampler
+from utils.lp_utils import locate_file, triples_array, triples_digest, d
+
+
+def store_key(digest: str, n: int, n_e: int, n_r: int, sampler: str, seed: int, rounds: int):
+    """
+    Folder name of a store, a hash of the triples digest and everything the stored graphs depend on.
+    """
+    config = {'digest': digest, 'n': n, 'n_e': n_e, 'n_r': n_r, 'sampler': sampler, 'seed': seed, 'rounds': rounds}
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class ShardCache():
+    """
+    Least recently used cache of shards read into memory, bounded by a byte budget. A shard larger than the budget is
+    not cached and stays memory mapped.
+    """
+    def __init__(self, budget: int):
+        """
+        :param budget: bytes of shard arrays kept in memory.
+        """
+        self.budget = budget
+        self.shards = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+
+    def get(self, key, load):
+        """
+        :param load: called on a miss, returns the memory mapped arrays of the shard.
+        """
+        if key in self.shards:
+            self.hits += 1
+            self.shards.move_to_end(key)
+            return self.shards[key]
+        self.misses += 1
+        arrays = load()
+        nbytes = sum(a.nbytes for a in arrays)
+        if nbytes > self.budget:
+            return arrays
+        while self.size + nbytes > self.budget:
+            _, evicted = self.shards.popitem(last=False)
+            self.size -= sum(a.nbytes for a in evicted)
+        arrays = tuple(np.array(a) for a in arrays)
+        self.shards[key] = arrays
+        self.size += nbytes
+        return arrays
+
+
+class GraphStore():
+    """
+    Graphs of n triples stored as indices, not one-hot matrices: per graph the (n, 3) local subject, relation and
+    local object of its edges and the (2n,) entities of its nodes, -1 for unused nodes. The graphs are split into
+    shards of .npy files, memory mapped when read and kept in a ShardCache. The edges use the narrowest unsigned
+    dtype the node and relation ids fit in, the nodes int32.
+    With the subgraph sampler, rounds independent samples of the graphs are stored and epoch e reads round e % rounds.
+    """
+    def __init__(self, folder: str, cache_budget: int=2**30):
+        """
+        :param folder: store folder written by build.
+        :param cache_budget: bytes of shards kept in memory.
+        """
+        self.folder = folder
+        with open(os.path.join(folder, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.n, self.n_e, self.n_r = self.meta['n'], self.meta['n_e'], self.meta['n_r']
+        self.graphs_per_round = self.meta['graphs_per_round']
+        self.offsets = np.array(self.meta['shard_offsets'], dtype=np.int64)
+        self.cache = ShardCache(cache_budget)
+
+    @classmethod
+    def build(cls, triples, n: int, n_e: int, n_r: int, folder: str, sampler: str='consecutive', seed: int=0, rounds: int=1,
+              shard_size: int=2**16, cache_budget: int=2**30):
+        """
+        :param triples: (N, 3) array, list or tensor of triples, a trailing remainder of less than n triples is dropped.
+        :param sampler: 'consecutive' or 'subgraph', see TripleGraphDataset.
+        :param rounds: number of stored samples of the graphs, 1 for the consecutive sampler.
+        :param shard_size: graphs per shard.
+        """
+        triples = torch.from_numpy(triples_array(triples))
+        n_graphs = triples.size(0) // n
+        rounds = rounds if sampler == 'subgraph' else 1
+        graph_sampler = SubgraphSampler(triples, n_e) if sampler == 'subgraph' else None
+        generator = torch.Generator().manual_seed(seed)
+        edge_dtype = np.min_scalar_type(max(2*n, n_r))
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        offsets = [0]
+        for r in range(rounds):
+            if graph_sampler is not None:
+                seeds = torch.randperm(triples.size(0), generator=generator)[:n_graphs]
+            for fr in range(0, n_graphs, shard_size):
+                if graph_sampler is None:
+                    graphs = triples[fr*n:min(fr + shard_size, n_graphs)*n].view(-1, n, 3)
+                else:
+                    graphs = triples[graph_sampler.sample(seeds[fr:fr + shard_size], n, generator=generator)]
+                batch = GraphBatch.from_triples(graphs, n_e, n_r)
+                shard = len(offsets) - 1
+                np.save(os.path.join(folder, 'edges_{}.npy'.format(shard)), batch.edges[:, 1:].numpy().astype(edge_dtype).reshape(-1, n, 3))
+                np.save(os.path.join(folder, 'nodes_{}.npy'.format(shard)), batch.nodes.numpy().astype(np.int32))
+                offsets.append(offsets[-1] + graphs.size(0))
+
+        # meta.json is written last, a store without it is incomplete and rebuilt.
+        with open(os.path.join(folder, 'meta.json'), 'w') as f:
+            json.dump({'n': n, 'n_e': n_e, 'n_r': n_r, 'sampler': sampler, 'seed': seed, 'rounds': rounds,
+                       'graphs_per_round': n_graphs, 'shard_offsets': offsets}, f)
+        return cls(folder, cache_budget=cache_budget)
+
+    @classmethod
+    def open(cls, triples, n: int, n_e: int, n_r: int, sampler: str='consecutive', seed: int=0, rounds: int=1,
+             root: str=None, cache_budget: int=2**30):
+        """
+        Opens the store of these triples and configuration under root, data/graph_cache by default, or builds it.
+        """
+        rounds = rounds if sampler == 'subgraph' else 1
+        root = locate_file('data/graph_cache') if root is None else root
+        folder = os.path.join(root, store_key(triples_digest(triples), n, n_e, n_r, sampler, seed, rounds))
+        if os.path.isfile(os.path.join(folder, 'meta.json')):
+            return cls(folder, cache_budget=cache_budget)
+        print('Building the graph store {}.'.format(folder))
+        return cls.build(triples, n, n_e, n_r, folder, sampler=sampler, seed=seed, rounds=rounds, cache_budget=cache_budget)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def rounds(self):
+        return self.meta['rounds']
+
+    def shard(self, i: int):
+        """
+        :return: edges (S, n, 3) and nodes (S, 2n) arrays of a shard, from the cache.
+        """
+        return self.cache.get(i, lambda: tuple(np.load(os.path.join(self.folder, '{}_{}.npy'.format(name, i)), mmap_mode='r')
+                                               for name in ['edges', 'nodes']))
+
+    def shards(self, epoch: int=0):
+        """
+        :return: the shards of the round read in this epoch.
+        """
+        fr, to = (epoch % self.rounds) * self.graphs_per_round, (epoch % self.rounds + 1) * self.graphs_per_round
+        return [i for i in range(len(self.offsets) - 1) if fr <= self.offsets[i] < to]
+
+    def take(self, ids):
+        """
+        :param ids: (b,) int array of graph ids.
+        :return: GraphBatch of the graphs, in the order of ids.
+        """
+        shards = np.searchsorted(self.offsets, ids, side='right') - 1
+        edges = np.empty((ids.shape[0], self.n, 3), dtype=np.int64)
+        nodes = np.empty((ids.shape[0], 2*self.n), dtype=np.int64)
+        for i in np.unique(shards):
+            rows = np.nonzero(shards == i)[0]
+            shard_edges, shard_nodes = self.shard(i)
+            local = ids[rows] - self.offsets[i]
+            edges[rows], nodes[rows] = shard_edges[local], shard_nodes[local]
+        g = np.repeat(np.arange(ids.shape[0]), self.n)
+        edges = np.concatenate([g[:, None], edges.reshape(-1, 3)], axis=1)
+        return GraphBatch(torch.from_numpy(edges), torch.from_numpy(nodes), self.n_e, self.n_r)
+
+
+class CachedGraphBatcher():
+    """
+    Batches of a GraphStore, a drop in for DeviceGraphBatcher. Shuffling permutes the order of the shards and splits it
+    into windows of several shards, the graphs of a window are permuted together. So a batch mixes graphs of different
+    shards, while an epoch reads every shard once even if they do not all fit the cache budget. The budget should hold
+    a window of shards.
+    """
+    def __init__(self, store: GraphStore, batch_size: int, shuffle: bool=True, seed: int=0, window: int=4):
+        """
+        :param window: number of shards whose graphs are shuffled together.
+        """
+        self.store = store
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.window = window
+        self.rng = np.random.default_rng(seed)
+        self.epoch = 0
+        self.target = torch.device(d())
+
+    def __len__(self):
+        return (self.store.graphs_per_round + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        shards = self.store.shards(self.epoch)
+        self.epoch += 1
+        offsets = self.store.offsets
+        if self.shuffle:
+            shards = self.rng.permutation(shards)
+            windows = [np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in shards[fr:fr + self.window]])
+                       for fr in range(0, len(shards), self.window)]
+            order = [self.rng.permutation(w) for w in windows]
+        else:
+            order = [np.arange(offsets[i], offsets[i + 1]) for i in shards]
+        order = np.concatenate(order) if len(order) > 0 else np.zeros(0, dtype=np.int64)
+        for fr in range(0, order.shape[0], self.batch_size):
+            batch = self.store.take(order[fr:fr + self.batch_size])
+            if self.target.type == 'cuda':
+                batch = batch.pin_memory()
+            yield batch.to(self.target, non_blocking=True)
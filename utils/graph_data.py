@@ -0,0 +1,215 @@
+"""
+Background batch construction for the VAE training loop.
+"""
+import random
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
+from utils.graph_batch import GraphBatch, GraphBatchBuffer
+from utils.lp_utils import d, triples_array
+
+
+class SubgraphSampler():
+    """
+    Samples connected graphs of n triples around seed triples. The triples incident to every entity are indexed in
+    compressed sparse row form once. A graph grows one triple per step for all graphs of a batch at once: from a
+    random triple already in the graph it walks to one of its two entities and takes a random incident triple.
+    A triple which is already in the graph is redrawn up to retries times, after that it is kept. The triples of every
+    graph are kept in a small open addressing hash table, so a duplicate check takes O(1) instead of O(k) steps.
+    """
+    def __init__(self, triples, n_e: int, retries: int=2):
+        """
+        :param triples: (N, 3) long tensor, on the device the samples are drawn on.
+        """
+        self.triples = triples
+        self.retries = retries
+        ids = torch.arange(triples.size(0), device=triples.device)
+        entities = torch.cat([triples[:, 0], triples[:, 2]])
+        order = torch.argsort(entities, stable=True)
+        self.incident = torch.cat([ids, ids])[order]
+        counts = torch.bincount(entities, minlength=n_e)
+        self.offsets = torch.cat([torch.zeros(1, dtype=torch.long, device=triples.device), torch.cumsum(counts, dim=0)])
+
+    def sample(self, seeds, n: int, generator=None):
+        """
+        :param seeds: (b,) ids of the seed triples.
+        :return: (b, n) triple ids, the seed first.
+        """
+        b = seeds.size(0)
+        device = seeds.device
+        rows = torch.arange(b, device=device)
+        out = torch.empty((b, n), dtype=torch.long, device=device)
+        out[:, 0] = seeds
+        # At most half of the slots are used, which keeps the probe sequences short.
+        table = torch.full((b, 1 << (2 * n - 1).bit_length()), -1, dtype=torch.long, device=device)
+        table[rows, probe(table, rows, seeds)[1]] = seeds
+        for k in range(1, n):
+            for attempt in range(self.retries + 1):
+                source = out[rows, torch.randint(k, (b,), device=device, generator=generator)]
+                entity = self.triples[source, torch.randint(2, (b,), device=device, generator=generator) * 2]
+                start, degree = self.offsets[entity], self.offsets[entity + 1] - self.offsets[entity]
+                step = (torch.rand(b, device=device, generator=generator) * degree).long().clamp(max=degree - 1)
+                drawn = self.incident[start + step]
+                new = drawn if attempt == 0 else torch.where(duplicate, drawn, new)
+                duplicate, slot = probe(table, rows, new)
+            out[:, k] = new
+            table[rows, slot] = new
+        return out
+
+def probe(table, rows, ids):
+    """
+    Looks ids up in the per row open addressing hash tables with linear probing.
+    :param table: (b, m) long tensor of ids, -1 for empty slots, m a power of two.
+    :return: (b,) bool tensor if the id is in its row and (b,) slot of the id or of the empty slot it would take.
+    """
+    mask = table.size(1) - 1
+    slot = (ids * 0x9E3779B1) & mask
+    while True:
+        current = table[rows, slot]
+        taken = (current != ids) & (current != -1)
+        if not taken.any():
+            return current == ids, slot
+        slot = torch.where(taken, (slot + 1) & mask, slot)
+
+class TripleGraphDataset(Dataset):
+    """
+    Graphs of n consecutive triples, or connected graphs sampled around seed triples if a sampler is given. The seed of
+    graph i is a random one of the consecutive triples i*n to i*n + n - 1, so the graphs of a batch have distinct seeds
+    and every triple can be a seed.
+    An item is a whole batch: indexed with a list of graph ids it returns the GraphBatch of those graphs, so the batch
+    is built in the loader worker and not in the training loop.
+    """
+    def __init__(self, triples, n: int, n_e: int, n_r: int, compact: bool=True, sampler: str='consecutive'):
+        """
+        :param triples: (N, 3) array, list or tensor of triples, a trailing remainder of less than n triples is dropped.
+                        An array, memory mapped or not, is kept as is and the triples of a batch are converted to int64.
+        :param compact: If true, the items are GraphBatches, else lists of the dense A, E, F.
+        :param sampler: 'consecutive' or 'subgraph', see SubgraphSampler.
+        """
+        self.triples = triples if isinstance(triples, np.ndarray) else triples_array(triples)
+        self.n_graphs = self.triples.shape[0] // n
+        self.n_e, self.n_r = n_e, n_r
+        self.compact = compact
+        self.sampler = SubgraphSampler(torch.from_numpy(triples_array(self.triples)), n_e) if sampler == 'subgraph' else None
+        self.n = n
+
+    def __len__(self):
+        return self.n_graphs
+
+    def __getitem__(self, index):
+        index = torch.as_tensor(index, dtype=torch.long).view(-1)
+        if self.sampler is None:
+            rows = (index.view(-1, 1) * self.n + torch.arange(self.n)).numpy()
+            graphs = torch.from_numpy(self.triples[rows].astype(np.int64))
+        else:
+            # the worker rng is seeded by the loader, so the seeds are reproducible
+            seeds = index * self.n + torch.randint(self.n, (index.size(0),))
+            graphs = self.sampler.triples[self.sampler.sample(seeds, self.n)]
+        if self.compact:
+            return GraphBatch.from_triples(graphs, self.n_e, self.n_r)
+        return list(GraphBatch.from_triples(graphs, self.n_e, self.n_r).dense())
+
+class DeviceGraphBatcher():
+    """
+    Alternative to graph_loader without any per batch Python objects: the triples are one contiguous tensor on the
+    device, the grouping into graphs of n triples is a precomputed (G, n) index tensor and a batch is a slice of a
+    per epoch permutation of the graphs, gathered and converted to a GraphBatch on the device.
+    """
+    def __init__(self, triples, n: int, batch_size: int, n_e: int, n_r: int, shuffle: bool=True, seed: int=0, device=None,
+                 sampler: str='consecutive'):
+        """
+        :param device: where the triples live, the default device if None. If it is the cpu while cuda is available,
+                       every batch is gathered into one of two preallocated pinned staging buffers and copied to the gpu
+                       from there without blocking. A buffer is only reused once its previous copy has finished.
+        :param sampler: 'consecutive' for fixed graphs of n consecutive triples or 'subgraph' for connected graphs
+                        sampled around a random one of the n triples of every graph in the epoch order, see
+                        SubgraphSampler.
+        """
+        self.device = torch.device(d() if device is None else device)
+        self.target = torch.device(d())
+        triples = torch.from_numpy(triples_array(triples)).contiguous()
+        self.triples = triples.to(self.device)
+        self.staging, self.copied = None, [None, None]
+        if self.device.type == 'cpu' and self.target.type == 'cuda':
+            # A gather from pinned memory is pageable again, so it is gathered into pinned memory directly.
+            self.staging = [torch.empty((batch_size * n, 3), dtype=torch.long).pin_memory() for _ in range(2)]
+        n_graphs = triples.size(0) // n
+        self.groups = torch.arange(n_graphs * n, device=self.device).view(n_graphs, n)
+        self.batch_size, self.n_e, self.n_r = batch_size, n_e, n_r
+        self.shuffle = shuffle
+        self.generator = torch.Generator(device=self.device).manual_seed(seed)
+        self.sampler = SubgraphSampler(self.triples, n_e) if sampler == 'subgraph' else None
+        self.n = n
+
+    def __len__(self):
+        return (self.groups.size(0) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n_graphs = self.groups.size(0)
+        if self.shuffle:
+            order = torch.randperm(n_graphs, generator=self.generator, device=self.device)
+        else:
+            order = torch.arange(n_graphs, device=self.device)
+        for fr in range(0, n_graphs, self.batch_size):
+            batch = order[fr:fr + self.batch_size]
+            if self.sampler is None:
+                ids = self.groups[batch]
+            else:
+                seeds = batch * self.n + torch.randint(self.n, (batch.size(0),), generator=self.generator, device=self.device)
+                ids = self.sampler.sample(seeds, self.n, generator=self.generator)
+            yield GraphBatch.from_triples(self.gather(ids, fr // self.batch_size), self.n_e, self.n_r)
+
+    def gather(self, ids, step: int):
+        """
+        :param ids: (b, n) triple ids of a batch.
+        :return: (b, n, 3) triples of the batch on the target device.
+        """
+        if self.staging is None:
+            return self.triples[ids].to(self.target, non_blocking=True)
+        k = step % 2
+        if self.copied[k] is not None:
+            self.copied[k].synchronize()
+        staging = self.staging[k][:ids.numel()]
+        torch.index_select(self.triples, 0, ids.view(-1), out=staging)
+        graphs = staging.view(ids.size(0), ids.size(1), 3).to(self.target, non_blocking=True)
+        self.copied[k] = torch.cuda.Event()
+        self.copied[k].record()
+        return graphs
+
+def seed_worker(worker_id):
+    """
+    Seeds numpy and random in a loader worker from its torch seed, which the loader derives from its generator.
+    """
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+def graph_loader(triples, n: int, batch_size: int, n_e: int, n_r: int, shuffle: bool=True, workers: int=2,
+                 prefetch: int=2, pin_memory: bool=None, compact: bool=True, seed: int=0, sampler: str='consecutive'):
+    """
+    DataLoader over batches of graphs. The graph order is reshuffled every epoch, deterministically given the seed, and
+    every worker is seeded from it as well. Batches are built by the workers, prefetch batches ahead per worker.
+    Move them with .to(d(), non_blocking=True), which overlaps the copy with compute when they are pinned.
+    :param batch_size: number of graphs per batch.
+    :param workers: number of loader processes, 0 builds the batches in the main process.
+    :param prefetch: number of batches loaded in advance by every worker.
+    :param pin_memory: pin the batches in page locked memory, by default if cuda is available.
+    :param sampler: 'consecutive' or 'subgraph', see TripleGraphDataset.
+    :return: DataLoader yielding GraphBatches (or lists of dense A, E, F if not compact).
+    """
+    dataset = TripleGraphDataset(triples, n, n_e, n_r, compact=compact, sampler=sampler)
+    generator = torch.Generator().manual_seed(seed)
+    order = RandomSampler(dataset, generator=generator) if shuffle else SequentialSampler(dataset)
+    pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+    kwargs = {'prefetch_factor': prefetch, 'persistent_workers': True} if workers > 0 else {}
+    return DataLoader(dataset, sampler=BatchSampler(order, batch_size, drop_last=False), batch_size=None,
+                      num_workers=workers, pin_memory=pin_memory, worker_init_fn=seed_worker, generator=generator, **kwargs)
+
+def to_device(batch, buffer: GraphBatchBuffer=None):
+    """
+    Moves a loader batch to the default device without blocking on the copy.
+    :param buffer: preallocated tensors the batch is densified into, if it needs to be.
+    """
+    if isinstance(batch, GraphBatch):
+        return batch.to(d(), non_blocking=True, buffer=buffer)     # only attaches the buffer for DeviceGraphBatcher
+    return [m.to(d(), non_blocking=True) for m in batch]
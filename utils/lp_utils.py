@@ -1,7 +1,7 @@
 """
 Utile functions for link prediction.
 """
-import gzip, os, pickle, tqdm
+import gzip, os, pickle, tqdm, hashlib, json, queue
 import torch
 import numpy as np
 import pandas as pd
@@ -13,6 +13,7 @@ from collections.abc import Iterable
 from torch import nn
 import re
 import wandb
+from utils.graph_batch import GraphBatch
 
 
 def locate_file(filepath):
@@ -25,73 +26,130 @@ def load_strings(file):
     with open(file, 'r') as f:
         return [line.split() for line in f]
 
-def load_link_prediction_data(name, use_test_set=False, limit=None):
+def dataset_files(name):
+    """
+    :return: paths of the train, validation and test files of a dataset.
+    """
+    folders = {'fb15k': 'fb15k', 'fb15k-237': 'fB15k-237', 'wn18': 'wn18', 'wn18rr': 'wn18rr'}
+    if name.lower() not in folders:
+        raise ValueError(f'Could not find \'{name}\' dataset')
+    folder = folders[name.lower()]
+    return [locate_file('data/{}/{}.txt'.format(folder, split)) for split in ['train', 'valid', 'test']]
+
+def file_sha1(file):
+    sha = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def unique_triples(triples, n_e: int, n_r: int):
+    """
+    Sorted unique rows of a (N, 3) int array, as int64.
+    """
+    triples = triples.astype(np.int64)
+    keys = np.unique((triples[:, 0] * n_r + triples[:, 1]) * n_e + triples[:, 2])
+    return np.stack([keys // (n_r * n_e), (keys // n_e) % n_r, keys % n_e], axis=1)
+
+def compile_link_prediction_data(name, force: bool=False, folder: str=None):
+    """
+    Compiles the text files of a dataset into data/<name>/compiled: sorted entity and relation vocabularies over all
+    three files, one int32 .npy array per split and the unique union of the known triples with and without the test split.
+    meta.json holds the sha1 of every source file, the cache is rebuilt when one of them changes. The size and
+    modification time of the files are kept as well, so an unchanged file is not hashed again.
+    :param force: If true, the cache is rebuilt regardless.
+    :param folder: cache folder, data/<name>/compiled if None.
+    :return: the cache folder.
+    """
+    files = dataset_files(name)
+    folder = os.path.join(os.path.dirname(files[0]), 'compiled') if folder is None else folder
+    meta_file = os.path.join(folder, 'meta.json')
+    stats = [[os.path.getsize(f), os.path.getmtime(f)] for f in files]
+
+    if not force and os.path.isfile(meta_file):
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+        if meta['stats'] == stats:
+            return folder
+        if meta['sha1'] == [file_sha1(f) for f in files]:        # touched, but not changed
+            meta['stats'] = stats
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f)
+            return folder
+
+    print('Compiling the {} dataset.'.format(name))
+    splits = [load_strings(f) for f in files]
+    for split in splits:
+        for triple in split:
+            if len(triple) < 3:
+                print(triple)
+    i2n = sorted({e for split in splits for s, _, o in split for e in (s, o)})
+    i2r = sorted({p for split in splits for _, p, _ in split})
+    n2i, r2i = {n: i for i, n in enumerate(i2n)}, {r: i for i, r in enumerate(i2r)}
+
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    arrays = [np.array([[n2i[s], r2i[p], n2i[o]] for s, p, o in split], dtype=np.int32).reshape(-1, 3) for split in splits]
+    for split, array in zip(['train', 'valid', 'test'], arrays):
+        np.save(os.path.join(folder, split + '.npy'), array)
+    np.save(os.path.join(folder, 'all_valid.npy'), unique_triples(np.concatenate(arrays[:2]), len(i2n), len(i2r)).astype(np.int32))
+    np.save(os.path.join(folder, 'all_test.npy'), unique_triples(np.concatenate(arrays), len(i2n), len(i2r)).astype(np.int32))
+    for vocab_file, vocab in [('entities.txt', i2n), ('relations.txt', i2r)]:
+        with open(os.path.join(folder, vocab_file), 'w') as f:
+            f.write('\n'.join(vocab))
+
+    with open(meta_file, 'w') as f:
+        json.dump({'sha1': [file_sha1(f) for f in files], 'stats': stats, 'n_e': len(i2n), 'n_r': len(i2r)}, f)
+    return folder
+
+def load_link_prediction_data(name, use_test_set=False, limit=None, folder: str=None):
     """
     Load knowledge graphs for relation Prediction  experiment.
     Source: https://github.com/pbloem/gated-rgcn/blob/1bde7f28af8028f468349b2d760c17d5c908b58b/kgmodels/data.py#L218
-    :param name: Dataset name ('aifb', 'am', 'bgs' or 'mutag')
+    The text files are compiled once by compile_link_prediction_data, after that the arrays are memory mapped from the
+    cache. The ids are the positions in the sorted vocabularies over all three files, so they are the same in every run
+    and with or without the test set.
+    :param name: Dataset name ('fb15k', 'fb15k-237', 'wn18' or 'wn18rr')
     :param use_test_set: If true, load the canonical test set, otherwise load validation set from file.
     :param limit: If set, only the first n triples are used.
-    :return: Relation prediction test and train sets:
-              - train: list of edges [subject, predicate object]
-              - test: list of edges [subject, predicate object]
-              - all_triples: sets of tuples (subject, predicate object)
-    """
-
-    if name.lower() == 'fb15k':
-        train_file = locate_file('data/fb15k/train.txt')
-        val_file = locate_file('data/fb15k/valid.txt')
-        test_file = locate_file('data/fb15k/test.txt')
-    elif name.lower() == 'fb15k-237':
-        train_file = locate_file('data/fB15k-237/train.txt')
-        val_file = locate_file('data/fB15k-237/valid.txt')
-        test_file = locate_file('data/fB15k-237/test.txt')
-    elif name.lower() == 'wn18':
-        train_file = locate_file('data/wn18/train.txt')
-        val_file = locate_file('data/wn18/valid.txt')
-        test_file = locate_file('data/wn18/test.txt')
-    elif name.lower() == 'wn18rr':
-        train_file = locate_file('data/wn18rr/train.txt')
-        val_file = locate_file('data/wn18rr/valid.txt')
-        test_file = locate_file('data/wn18rr/test.txt')
-    else:
-        raise ValueError(f'Could not find \'{name}\' dataset')
-
-    train = load_strings(train_file)
-    val = load_strings(val_file)
-    test = load_strings(test_file)
+    :param folder: cache folder, see compile_link_prediction_data.
+    :return: Relation prediction test and train sets, int32 arrays which are memory mapped unless they are concatenated
+             for the test set or the limit. Convert them to int64 per batch, or once where a consumer holds a copy anyway.
+              - train: (N, 3) int32 array of edges [subject, predicate object]
+              - test: (N, 3) int32 array of edges [subject, predicate object]
+              - all_triples: (N, 3) int32 array of the unique known triples (subject, predicate object)
+    """
+    folder = compile_link_prediction_data(name, folder=folder)
+    train, val, test = [np.load(os.path.join(folder, split + '.npy'), mmap_mode='r') for split in ['train', 'valid', 'test']]
+    with open(os.path.join(folder, 'entities.txt'), 'r') as f:
+        i2n = f.read().split('\n')
+    with open(os.path.join(folder, 'relations.txt'), 'r') as f:
+        i2r = f.read().split('\n')
+    n2i, r2i = {n: i for i, n in enumerate(i2n)}, {r: i for i, r in enumerate(i2r)}
 
     if use_test_set:
-        train = train + val
+        train = np.concatenate([train, val])
+        all_triples = np.load(os.path.join(folder, 'all_test.npy'), mmap_mode='r')
     else:
         test = val
+        all_triples = np.load(os.path.join(folder, 'all_valid.npy'), mmap_mode='r')
 
     if limit:
         train = train[:limit]
         test = test[:limit]
-
-    # Mappings for nodes (n) and relations (r)
-    nodes, rels = set(), set()
-    for i in train + val + test:
-      if len(i) < 3:
-        print(i)
-    for s, p, o in train + test:
-        nodes.add(s)
-        rels.add(p)
-        nodes.add(o)
-
-    i2n, i2r = list(nodes), list(rels)
-    n2i, r2i = {n: i for i, n in enumerate(nodes)}, {r: i for i, r in enumerate(rels)}
-
-    all_triples = set()
-    for s, p, o in train + test:
-        all_triples.add((n2i[s], r2i[p], n2i[o]))
-
-    train = [[n2i[st[0]], r2i[st[1]], n2i[st[2]]] for st in train]
-    test = [[n2i[st[0]], r2i[st[1]], n2i[st[2]]] for st in test]
+        all_triples = unique_triples(np.concatenate([train, test]), len(i2n), len(i2r)).astype(np.int32)
 
     return (n2i, i2n), (r2i, i2r), train, test, all_triples
 
+def graph_matrices(triples, n_e: int, n_r: int):
+    """
+    Builds the A, E, F matrices of a batch of graphs at once, with one index_put_ per matrix.
+    :param triples: (bs, n, 3) tensor, n triples per graph.
+    :return: A (bs, 2n, 2n), E (bs, 2n, 2n, n_r), F (bs, 2n, n_e).
+    """
+    triples = triples.to(device=d(), dtype=torch.long)
+    return GraphBatch.from_triples(triples, n_e, n_r).dense()
+
 def triple2matrix(triples, max_n: int, max_r: int):
     """
     Transforms triples into matrix form.
@@ -99,65 +157,60 @@ def triple2matrix(triples, max_n: int, max_r: int):
         triples: set of sparse triples
         max_n: total count of nodes
         max_t: total count of relations
-    Outputs the A,E,F matrices for the input triples,
-    """
-    # An exception for single triples.
-    triples = triples.detach().cpu().numpy()
-    n_list = list(dict.fromkeys([triple[0] for triple in triples]))+list(dict.fromkeys([triple[2] for triple in triples]))
-    n_dict =  dict(zip(n_list, np.arange(len(n_list))))
-    n = 2*len(triples)     # All matrices must be of same size
-
-    # The empty first dimension is to stacking into batches.
-    
-    A = torch.zeros((1,n,n), device=d())
-    E = torch.zeros((1,n,n,max_r), device=d())
-    F = torch.zeros((1,n,max_n), device=d())
-
-    for (s, r, o) in triples:
-        i_s, i_o = n_dict[s], n_dict[o]
-        A[0,i_s,i_o] = 1
-        E[0,i_s,i_o,r] = 1
-        F[0,i_s,s] = 1
-        F[0,i_o,o] = 1
-    return (A, E, F)
+    Outputs the A,E,F matrices for the input triples, with an empty first dimension for stacking into batches.
+    """
+    triples = torch.as_tensor(triples).reshape(1, -1, 3)
+    return graph_matrices(triples, max_n, max_r)
+
+def batch_matrix2triple(A, E, F, generator=None):
+    """
+    Converts a batch of sampled or target graphs back to triples, with tensor operations only.
+    Args:
+        A: (bs, n, n) adjacency, every nonzero entry is an edge.
+        E: (bs, n, n) relation ids or (bs, n, n, n_r) multi-hot relations. Of several relations of an edge a random one is taken.
+        F: (bs, n) entity ids or (bs, n, n_e) one-hot entities.
+        generator: torch generator for the choice between several relations.
+    returns a (T, 4) long tensor of (graph, subject, relation, object) and the number of inconsistent edges, which are in A
+    but have no relation in E and are dropped.
+    """
+    g, s, o = torch.nonzero(A, as_tuple=True)
+    if E.dim() == 4:
+        rels = E[g, s, o] != 0
+        consistent = rels.any(dim=1)
+        noise = torch.rand(rels.shape, device=rels.device, generator=generator)
+        r = torch.where(rels, noise, torch.full_like(noise, -1.)).argmax(dim=1)
+    else:
+        r = E[g, s, o].long()
+        consistent = torch.ones_like(r, dtype=torch.bool)
+    nodes = F.argmax(dim=-1) if F.dim() == 3 else F.long()
+    triples = torch.stack([g, nodes[g, s], r, nodes[g, o]], dim=1)
+    return triples[consistent], (~consistent).sum()
 
 def matrix2triple(graph):
     """
     Converts a sparse graph back to triple from.
     Args:
-        graph: Graph consisting of A, E, F matrix
-    returns a set of triples/one triple.
+        graph: Graph consisting of A, E, F matrix, with or without a batch dimension, or a GraphBatch. Of a batch the
+               triples of all graphs are returned.
+    returns a list of (s, r, o) triples.
     """
+    if isinstance(graph, GraphBatch):
+        return [tuple(t[1:]) for t in graph.triples().tolist()]
     A, E, F = graph
-    a = A.squeeze().detach().cpu().numpy()
-    e = E.squeeze().detach().cpu().numpy()
-    f = F.squeeze().detach().cpu().numpy()
-    
-    s, o = np.where(a != 0)
-    
-    triples = list()
-    for i in range(len(s)):
-        if len(e.shape) == 2:
-            r = e[s[i],o[i]]
-        else:
-            cho = np.where(e[s[i],o[i],:] == 1)[0]
-            if cho.size > 0:
-                r = np.array(np.random.choice(cho[0]))
-            else:
-                print('No attribute prediction for node {},{}. Graph inconsistent!'.format(s[i],o[i]))
-                break
-        if r.size > 0:
-            triple = (f[s[i]], r, f[o[i]])
-            triples.append(triple)
-    return triples
+    if A.dim() == 2:
+        A, E, F = A.unsqueeze(0), E.unsqueeze(0), F.unsqueeze(0)
+    triples, _ = batch_matrix2triple(A.detach(), E.detach(), F.detach())
+    return [tuple(t[1:]) for t in triples.tolist()]
 
 
 def translate_triple(triples, i2n, i2r, entity_dict=None):
     """
     Translate an indexed triple back to text.
     Args:
-    ....
+        entity_dict: dict of entity name to text, or an EntityStore, which translates the whole batch at once.
     """
+    if hasattr(entity_dict, 'translate'):
+        return entity_dict.translate(triples, i2r)
 
     triples_text = list()
     for triple in triples:
@@ -169,33 +222,26 @@ def translate_triple(triples, i2n, i2r, entity_dict=None):
     return triples_text
 
 
-def batch_t2m(batch, n: int, n_e: int, n_r: int):
+def batch_t2m(batch, n: int, n_e: int, n_r: int, compact: bool=False):
     """
     Converts batches of triples into matrix form.
 
-    :param batch: batch of triples
+    :param batch: (bs, n, 3) batch of graphs, or (bs * n, 3) triples which are split into graphs of n consecutive triples.
     :param n: number of triples per. matrix
     :param n_e: total node count.
     :param n_r: total edge attribute count.
-    :return: the batched matrices A, E, F.
+    :param compact: If true, return a GraphBatch, which the models and losses use without densifying it.
+    :return: the batched matrices A, E, F or a GraphBatch.
     """
     # This condition is needed for batch size = 1.
-    if len(batch.shape) > 1:
-        bs = batch.shape[0]
-    else:
-        bs = 1
+    if len(batch.shape) == 1:
         batch = batch.unsqueeze(0)
-    batch_a = list()
-    batch_e = list()
-    batch_f = list()
-    for ii in range(bs):
-        (A, E, F) = triple2matrix(batch[ii:ii+n,:], n_e, n_r)       # TODO adopt this to bigger n 
-        assert A.shape[1] != 1
-        batch_a.append(A)
-        batch_e.append(E)
-        batch_f.append(F)
-
-    return [torch.cat(batch_a, dim=0),torch.cat(batch_e, dim=0),torch.cat(batch_f, dim=0)]
+    if len(batch.shape) == 2:
+        assert batch.shape[0] % n == 0, f'{batch.shape[0]} triples do not split into graphs of {n}'
+        batch = batch.reshape(-1, n, 3)
+    if compact:
+        return GraphBatch.from_triples(batch.to(device=d(), dtype=torch.long), n_e, n_r)
+    return list(graph_matrices(batch, n_e, n_r))
 
 ###################### For actual link prediction ###########################
 
@@ -220,10 +266,13 @@ def filter_scores_(scores, batch, truedicts, head=True):
     Filters a score matrix by setting the scores of known non-target true triples to -inf
     :param scores:
     :param batch:
-    :param truedicts:
+    :param truedicts: pair of dicts from truedicts() or a FilterIndex
     :param head:
     :return:
     """
+    if isinstance(truedicts, FilterIndex):
+        truedicts.filter_(scores, batch, head=head)
+        return
 
     indices = [] # indices of triples whose scores should be set to -infty
 
@@ -248,6 +297,8 @@ def truedicts(all):
     :param all: A list of 3-tuples containing all known true triples
     :return:
     """
+    if not isinstance(all, (set, frozenset, list)):
+        all = triples_array(all).tolist()
     heads, tails = {(p, o) : [] for _, p, o in all}, {(s, p) : [] for s, p, _ in all}
 
     for s, p, o in all:
@@ -256,62 +307,606 @@ def truedicts(all):
 
     return heads, tails
 
-def eval(model : nn.Module, valset, truedicts, n, r, batch_size=16, hitsat=[1, 3, 10], filter_candidates=True, verbose=False, elbo=True):
+def triples_array(triples):
+    """
+    Converts a collection of triples (set of tuples, list of lists, array or tensor) into a (N, 3) int64 array.
+    """
+    if isinstance(triples, torch.Tensor):
+        triples = triples.detach().cpu().numpy()
+    elif isinstance(triples, (set, frozenset)):
+        triples = list(triples)
+    return np.asarray(triples, dtype=np.int64).reshape(-1, 3)
+
+def csr_index(keys, values):
+    """
+    Groups values by key in compressed sparse row form.
+    :param keys: int64 array of keys.
+    :param values: int64 array of values, same length as keys.
+    :return: sorted unique keys, offsets into values (len(ukeys)+1) and the values sorted by key.
+    """
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    ukeys, starts = np.unique(keys, return_index=True)
+    offsets = np.append(starts, len(keys)).astype(np.int64)
+    return ukeys, offsets, values
+
+class FilterIndex():
+    """
+    CSR index of all true head completions per (p, o) and tail completions per (s, p).
+    Replaces the python truedicts for filtered ranking: a whole batch of queries is filtered with a
+    single vectorized scatter of -inf.
+    """
+    def __init__(self, n_e: int, n_r: int, head_keys, head_offsets, head_values, tail_keys, tail_offsets, tail_values, digest: str=''):
+        """
+        :param n_e: total node count.
+        :param n_r: total relation count.
+        :param head_keys: sorted keys p*n_e+o.
+        :param head_offsets: CSR offsets into head_values.
+        :param head_values: true subjects, grouped by key.
+        :param tail_keys: sorted keys s*n_r+p.
+        :param tail_offsets: CSR offsets into tail_values.
+        :param tail_values: true objects, grouped by key.
+        :param digest: sha1 of the triples the index was built from.
+        """
+        self.n_e, self.n_r = n_e, n_r
+        self.digest = digest
+        self.head = tuple(torch.as_tensor(a, dtype=torch.long) for a in (head_keys, head_offsets, head_values))
+        self.tail = tuple(torch.as_tensor(a, dtype=torch.long) for a in (tail_keys, tail_offsets, tail_values))
+
+    @classmethod
+    def build(cls, all_triples, n_e: int, n_r: int):
+        """
+        Builds the index from all known true triples.
+        :param all_triples: set of tuples, list, array or tensor of (s, p, o) triples.
+        """
+        triples = triples_array(all_triples)
+        s, p, o = triples[:, 0], triples[:, 1], triples[:, 2]
+        head = csr_index(p * n_e + o, s)
+        tail = csr_index(s * n_r + p, o)
+        return cls(n_e, n_r, *head, *tail, digest=triples_digest(triples))
+
+    def save(self, path: str):
+        np.savez(path, n_e=self.n_e, n_r=self.n_r, digest=self.digest,
+                 head_keys=self.head[0].cpu().numpy(), head_offsets=self.head[1].cpu().numpy(), head_values=self.head[2].cpu().numpy(),
+                 tail_keys=self.tail[0].cpu().numpy(), tail_offsets=self.tail[1].cpu().numpy(), tail_values=self.tail[2].cpu().numpy())
+
+    @classmethod
+    def load(cls, path: str):
+        f = np.load(path)
+        return cls(int(f['n_e']), int(f['n_r']), f['head_keys'], f['head_offsets'], f['head_values'],
+                   f['tail_keys'], f['tail_offsets'], f['tail_values'], digest=str(f['digest']))
+
+    def share_memory(self):
+        """
+        Moves the index tensors to shared memory, so worker processes can read them without a copy.
+        """
+        for t in self.head + self.tail:
+            t.share_memory_()
+        return self
+
+    def to(self, device):
+        self.head = tuple(t.to(device) for t in self.head)
+        self.tail = tuple(t.to(device) for t in self.tail)
+        return self
+
+    def lookup(self, batch, head=True):
+        """
+        Finds the true completions of a batch of queries.
+        :param batch: (bn, 3) tensor of triples.
+        :return: row index into the batch and entity index of every known true completion.
+        """
+        if self.head[0].device != batch.device:
+            self.to(batch.device)
+        s, p, o = batch[:, 0], batch[:, 1], batch[:, 2]
+        keys, offsets, values = self.head if head else self.tail
+        query = p * self.n_e + o if head else s * self.n_r + p
+
+        if keys.size(0) == 0:
+            empty = torch.zeros(0, dtype=torch.long, device=batch.device)
+            return empty, empty
+
+        pos = torch.searchsorted(keys, query).clamp(max=keys.size(0) - 1)
+        found = keys[pos] == query
+        start = offsets[pos]
+        count = (offsets[pos + 1] - start) * found
+
+        rows = torch.repeat_interleave(torch.arange(batch.size(0), device=batch.device), count)
+        within = torch.arange(rows.size(0), device=batch.device) - (torch.cumsum(count, dim=0) - count)[rows]
+        return rows, values[start[rows] + within]
+
+    def filter_(self, scores, batch, head=True):
+        """
+        Sets the scores of all known true triples except the targets to -inf, in place.
+        :param scores: (bn, n_e) score matrix.
+        :param batch: (bn, 3) tensor of the query triples.
+        """
+        rows, cols = self.lookup(batch, head=head)
+        targets = batch[:, 0] if head else batch[:, 2]
+        keep = cols != targets[rows]
+        scores[rows[keep].to(scores.device), cols[keep].to(scores.device)] = float('-inf')
+
+def triples_digest(triples):
+    """
+    Order independent sha1 of a collection of triples.
+    """
+    triples = triples_array(triples)
+    triples = triples[np.lexsort((triples[:, 2], triples[:, 1], triples[:, 0]))]
+    return hashlib.sha1(np.ascontiguousarray(triples).tobytes()).hexdigest()
+
+def load_filter_index(name, all_triples, n_e: int, n_r: int):
+    """
+    Loads the filter index stored next to the dataset, or builds and stores it if it is missing or stale.
+    :param name: Dataset name.
+    :param all_triples: all known true triples.
+    :return: FilterIndex
+    """
+    path = os.path.join(os.path.dirname(dataset_files(name)[0]), 'filter_index.npz')
+    digest = triples_digest(all_triples)
+    if os.path.isfile(path):
+        index = FilterIndex.load(path)
+        if index.digest == digest and (index.n_e, index.n_r) == (n_e, n_r):
+            return index
+    index = FilterIndex.build(all_triples, n_e, n_r)
+    if os.path.isdir(os.path.dirname(path)):
+        index.save(path)
+    return index
+
+def score_bases(model : nn.Module, bases, n, r, batch_size=16, head=True, elbo=True, verbose=False, candidates=None):
+    """
+    Scores every candidate completion of a batch of unique query bases with the VAE.
+    :param model: VAE model exposing elbo/forward/reconstruction_loss.
+    :param bases: (bu, 2) tensor of (p, o) pairs for head or (s, p) pairs for tail prediction.
+    :param n: total node count.
+    :param r: total relation count.
+    :param batch_size: number of candidate graphs scored per forward pass.
+    :param head: If true, candidates replace the subject, otherwise the object.
+    :param elbo: If true, use full elbo as loss. Else just the reconstruction loss.
+    :param candidates: list of bu tensors with the entities to score per base, all entities if None.
+                       The scores of the other entities are -inf.
+    :return: (bu, n) score matrix, higher is better.
+    """
+    bu, _ = bases.size()
+
+    # collect the triples for which to compute scores
+    bexp = bases.view(bu, 1, 2).expand(bu, n, 2)
+    ar   = torch.arange(n, device=d()).view(1, n, 1).expand(bu, n, 1)
+    toscore = torch.cat([ar, bexp] if head else [bexp, ar], dim=2)
+    assert toscore.size() == (bu, n, 3)
+
+    tpg = model.n - 1    # number of triples per graph
+    scores = list()
+    for ii in tqdm.trange(bu, desc='Valset Batch', leave=False, disable=not verbose):
+        row = toscore[ii] if candidates is None else toscore[ii, candidates[ii].to(d())]
+        nc = row.size(0)
+        batch_scores = list()
+        for iii in range(0, nc, batch_size):
+            tt = min(iii + batch_size, nc)
+            sub_batch = batch_t2m(row[iii:tt, :].squeeze(), tpg, n, r, compact=True)
+            if elbo:
+                loss = - model.elbo(sub_batch)
+            else:
+                prediction = model.forward(sub_batch)
+                loss = model.reconstruction_loss(sub_batch, prediction)
+            batch_scores.append(loss)
+        if candidates is None:
+            scores.append(torch.cat(batch_scores, dim=0).view(1, n))
+        else:
+            full = torch.full((1, n), float('-inf'), device=d())
+            if nc > 0:
+                full[0, candidates[ii].to(d())] = torch.cat(batch_scores, dim=0).view(-1).to(full.dtype)
+            scores.append(full)
+    return torch.cat(scores, dim=0)
+
+class TopKRetriever():
+    """
+    First stage of retrieve and rerank link prediction. A cheap embedding model, like VLinkPredictor, scores all entities
+    of a query base and only its top k are passed on as candidates, to be reranked with the VAE elbo in eval.
+    """
+    def __init__(self, model : nn.Module, n_e: int, k: int=100, batch_size: int=64, filter=None):
+        """
+        :param model: triple scoring model called as model(s, p, o), higher is better.
+        :param n_e: total node count.
+        :param k: number of candidates per query base.
+        :param batch_size: number of query bases scored at once.
+        :param filter: truedicts or FilterIndex of the filtered ranking. If set, the top k are taken among the entities
+                       which are not known true completions of the base, and the true completions scoring at least as
+                       high are added, as any of them can be the target of a query.
+        """
+        self.model = model
+        self.n_e = n_e
+        self.k = min(k, n_e)
+        self.batch_size = batch_size
+        self.filter = filter
+
+    def scores(self, bases, head=True):
+        """
+        :return: (bu, n_e) matrix of the cheap scores of all completions of the bases.
+        """
+        if hasattr(self.model, 'score_1n'):
+            return self.model.score_1n(p=bases[:, 0], o=bases[:, 1]) if head else self.model.score_1n(s=bases[:, 0], p=bases[:, 1])
+        bu = bases.size(0)
+        bexp = bases.view(bu, 1, 2).expand(bu, self.n_e, 2)
+        ar = torch.arange(self.n_e, device=d()).view(1, self.n_e, 1).expand(bu, self.n_e, 1)
+        toscore = torch.cat([ar, bexp] if head else [bexp, ar], dim=2)
+        return self.model(toscore[:, :, 0], toscore[:, :, 1], toscore[:, :, 2])
+
+    def candidates(self, bases, head=True):
+        """
+        :param bases: (bu, 2) tensor of (p, o) pairs for head or (s, p) pairs for tail prediction.
+        :return: list of the top k entities per base, with the filter the top k unfiltered ones and the true completions
+                 scoring at least as high.
+        """
+        self.model.train(False)
+        bases = bases.to(d())
+        topk = list()
+        with torch.no_grad():
+            for fr in range(0, bases.size(0), self.batch_size):
+                scores = self.scores(bases[fr:fr + self.batch_size], head=head)
+                if self.filter is None:
+                    topk.extend(torch.topk(scores, self.k, dim=1).indices)
+                    continue
+                # Queries with a target of -1, so the filter masks every true completion of the base.
+                none = torch.full((scores.size(0), 1), -1, dtype=torch.long, device=d())
+                batch = torch.cat([none, bases[fr:fr + self.batch_size]] if head else [bases[fr:fr + self.batch_size], none], dim=1)
+                masked = scores.clone()
+                filter_scores_(masked, batch, self.filter, head=head)
+                kth = torch.topk(masked, self.k, dim=1).values[:, -1:]
+                topk.extend(torch.nonzero(row).view(-1) for row in scores >= kth)
+        return topk
+
+def relation_csr(rels, ents, n_e: int, n_r: int):
+    """
+    Unique entities per relation in compressed sparse row form.
+    :return: offsets (n_r+1) into the sorted entity array.
+    """
+    pairs = np.unique(rels * n_e + ents)
+    offsets = np.searchsorted(pairs // n_e, np.arange(n_r + 1))
+    return offsets.astype(np.int64), (pairs % n_e).astype(np.int64)
+
+class DomainRangeIndex():
+    """
+    Domain (subjects) and range (objects) per relation, seen in the training triples.
+    Restricts the candidates of a head prediction query to the relation's domain and of a tail prediction query to its range.
+    """
+    def __init__(self, n_e: int, n_r: int, domain_offsets, domain, range_offsets, range):
+        self.n_e, self.n_r = n_e, n_r
+        self.domain = (torch.as_tensor(domain_offsets, dtype=torch.long), torch.as_tensor(domain, dtype=torch.long))
+        self.range = (torch.as_tensor(range_offsets, dtype=torch.long), torch.as_tensor(range, dtype=torch.long))
+
+    @classmethod
+    def build(cls, train, n_e: int, n_r: int, i2n=None, types=None, type_support=0.5):
+        """
+        Builds the index from the training triples.
+        :param train: list, array or tensor of (s, p, o) training triples.
+        :param i2n: list of node names, needed for the type expansion.
+        :param types: EntityStore or dict node name -> whitespace separated types. If given, every domain and range is
+                      expanded with all entities of a type which at least type_support of its seen entities carry.
+        :param type_support: minimal fraction of a domain or range carrying a type for it to be expanded.
+        """
+        triples = triples_array(train)
+        s, p, o = triples[:, 0], triples[:, 1], triples[:, 2]
+        domain = relation_csr(p, s, n_e, n_r)
+        range = relation_csr(p, o, n_e, n_r)
+        if types is not None:
+            domain = expand_types(*domain, i2n, types, type_support)
+            range = expand_types(*range, i2n, types, type_support)
+        return cls(n_e, n_r, *domain, *range)
+
+    def candidates(self, bases, head=True):
+        """
+        :param bases: (bu, 2) tensor of (p, o) pairs for head or (s, p) pairs for tail prediction.
+        :return: list of candidate entity tensors, one per base.
+        """
+        offsets, ents = self.domain if head else self.range
+        rels = (bases[:, 0] if head else bases[:, 1]).tolist()
+        return [ents[offsets[p]:offsets[p + 1]] for p in rels]
+
+    def pruning(self):
+        """
+        :return: mean fraction of the entities which remain candidates, for head and for tail prediction.
+        """
+        return tuple((offsets[1:] - offsets[:-1]).to(torch.double).mean().item() / self.n_e for offsets, _ in (self.domain, self.range))
+
+def expand_types(offsets, ents, i2n, types, type_support=0.5):
+    """
+    Expands the entity sets of a relation CSR with all entities sharing a frequent type.
+    :param types: EntityStore or dict node name -> whitespace separated types.
+    :return: the expanded offsets and entities.
+    """
+    if isinstance(types, dict):
+        type_ids = dict()
+        et_ent, et_type = list(), list()
+        for e, name in enumerate(i2n):
+            for t in (types[name].split() if name in types else []):
+                et_ent.append(e)
+                et_type.append(type_ids.setdefault(t, len(type_ids)))
+        et_ent, et_type = np.asarray(et_ent, dtype=np.int64), np.asarray(et_type, dtype=np.int64)
+        n_types = len(type_ids)
+    else:
+        et_ent, et_type = types.type_pairs()
+        n_types = len(types.types())
+
+    expanded = list()
+    for p in range(len(offsets) - 1):
+        seen = ents[offsets[p]:offsets[p + 1]]
+        if len(seen) > 0 and len(et_type) > 0:
+            counts = np.bincount(et_type[np.isin(et_ent, seen)], minlength=n_types)
+            frequent = np.nonzero(counts >= type_support * len(seen))[0]
+            seen = np.union1d(seen, et_ent[np.isin(et_type, frequent)])
+        expanded.append(seen)
+    offsets = np.concatenate([[0], np.cumsum([len(e) for e in expanded])]).astype(np.int64)
+    return offsets, np.concatenate(expanded).astype(np.int64)
+
+class RankAccumulator():
+    """
+    Collects link prediction ranks in a preallocated tensor and keeps running sums of the reciprocal ranks
+    and hits@k, overall and per relation. Snapshots are O(1), so progress can be logged at any interval.
+    """
+    def __init__(self, size: int, n_r: int, hitsat=[1, 3, 10], device=None):
+        """
+        :param size: number of queries, every query has a slot in the rank tensor.
+        :param n_r: total relation count, for the per relation breakdown.
+        :param hitsat: the k's for hits@k.
+        :param device: device on which ranks and sums are kept.
+        """
+        device = d() if device is None else device
+        self.hitsat = list(hitsat)
+        self.ks = torch.tensor(self.hitsat, dtype=torch.long, device=device)
+        self.ranks = torch.zeros(size, dtype=torch.long, device=device)     # 0 means not ranked yet
+        self.rels = torch.full((size,), -1, dtype=torch.long, device=device)
+        self.count = 0
+        self.misses = torch.zeros((), dtype=torch.long, device=device)
+        self.rr_sum = torch.zeros((), dtype=torch.double, device=device)
+        self.rr_sq_sum = torch.zeros((), dtype=torch.double, device=device)
+        self.hits_sum = torch.zeros(len(self.hitsat), dtype=torch.double, device=device)
+        self.rel_count = torch.zeros(n_r, dtype=torch.double, device=device)
+        self.rel_rr = torch.zeros(n_r, dtype=torch.double, device=device)
+        self.rel_hits = torch.zeros(n_r, len(self.hitsat), dtype=torch.double, device=device)
+
+    def update(self, ranks, index, rels=None, missed=None):
+        """
+        Adds the ranks of a batch of queries. Every slot should only be updated once.
+        :param ranks: (bn,) tensor of ranks, starting at 1.
+        :param index: (bn,) tensor of query slots.
+        :param rels: (bn,) tensor of the query relations, optional.
+        :param missed: (bn,) bool tensor of queries whose target was not among the scored candidates, optional.
+        """
+        device = self.ranks.device
+        ranks, index = ranks.to(device).view(-1), index.to(device).view(-1)
+        self.ranks[index] = ranks
+        self.count += ranks.size(0)
+
+        rr = 1.0 / ranks.to(torch.double)
+        hits = (ranks.view(-1, 1) <= self.ks.view(1, -1)).to(torch.double)
+        self.rr_sum += rr.sum()
+        self.rr_sq_sum += (rr * rr).sum()
+        self.hits_sum += hits.sum(dim=0)
+        if missed is not None:
+            self.misses += missed.to(device).sum()
+
+        if rels is not None:
+            rels = rels.to(device).view(-1)
+            self.rels[index] = rels
+            self.rel_count.index_add_(0, rels, torch.ones_like(rr))
+            self.rel_rr.index_add_(0, rels, rr)
+            self.rel_hits.index_add_(0, rels, hits)
+
+    def snapshot(self):
+        """
+        Current metrics over all ranks seen so far.
+        :return: dict with 'mrr', 'h@k' for every k and the number of ranked queries 'n'.
+        """
+        count = max(self.count, 1)
+        values = torch.cat([self.rr_sum.view(1), self.hits_sum]).div(count).tolist()
+        snap = {'mrr': values[0], 'n': self.count, 'coverage': 1. - self.misses.item() / count}
+        for k, h in zip(self.hitsat, values[1:]):
+            snap['h@{}'.format(k)] = h
+        return snap
+
+    def per_relation(self):
+        """
+        Metrics per relation, for relations which occured in at least one query.
+        :return: dict relation id -> dict with 'mrr', 'h@k' and 'n'.
+        """
+        seen = torch.nonzero(self.rel_count > 0).view(-1)
+        count = self.rel_count[seen]
+        mrr = (self.rel_rr[seen] / count).tolist()
+        hits = (self.rel_hits[seen] / count.view(-1, 1)).tolist()
+        breakdown = dict()
+        for i, rel in enumerate(seen.tolist()):
+            breakdown[rel] = {'mrr': mrr[i], 'n': int(count[i].item())}
+            for k, h in zip(self.hitsat, hits[i]):
+                breakdown[rel]['h@{}'.format(k)] = h
+        return breakdown
+
+    def intervals(self, confidence=0.95, bootstrap=0, generator=None):
+        """
+        Confidence intervals of the current metrics, treating the ranked queries as a random sample of all queries.
+        :param confidence: coverage of the intervals.
+        :param bootstrap: number of bootstrap resamples, if 0 the normal approximation is used for the MRR and the
+                          Wilson score interval for the hits@k, which stays wide for hit rates close to 0 or 1.
+        :param generator: torch.Generator for the bootstrap resamples.
+        :return: dict metric name -> (low, high).
+        """
+        names = ['mrr'] + ['h@{}'.format(k) for k in self.hitsat]
+        count = self.count
+        if count < 2:
+            return {name: (0., 1.) for name in names}
+
+        if bootstrap > 0:
+            ranks = self.ranks[self.ranks > 0].to(torch.double)
+            values = torch.cat([(1.0 / ranks).view(-1, 1), (ranks.view(-1, 1) <= self.ks.view(1, -1)).to(torch.double)], dim=1)
+            means = list()
+            for _ in range(0, bootstrap, 100):      # resample in chunks to bound memory
+                b = min(100, bootstrap - len(means) * 100)
+                idx = torch.randint(count, (b, count), generator=generator).to(values.device)
+                means.append(values[idx].mean(dim=1))
+            means = torch.cat(means, dim=0)
+            alpha = (1. - confidence) / 2.
+            low = torch.quantile(means, alpha, dim=0).tolist()
+            high = torch.quantile(means, 1. - alpha, dim=0).tolist()
+            return {name: (lo, hi) for name, lo, hi in zip(names, low, high)}
+
+        z = torch.distributions.Normal(0., 1.).icdf(torch.tensor(0.5 + confidence / 2.)).item()
+        mrr = self.rr_sum / count
+        half = z * torch.sqrt((self.rr_sq_sum / count - mrr ** 2).clamp(min=0.) / count)
+        hits = self.hits_sum / count
+        center = (hits + z ** 2 / (2 * count)) / (1. + z ** 2 / count)
+        hits_half = z / (1. + z ** 2 / count) * torch.sqrt(hits * (1. - hits) / count + z ** 2 / (4 * count ** 2))
+        low = torch.cat([(mrr - half).view(1), center - hits_half]).tolist()
+        high = torch.cat([(mrr + half).view(1), center + hits_half]).tolist()
+        return {name: (lo, hi) for name, lo, hi in zip(names, low, high)}
+
+    def results(self):
+        """
+        :return: mrr, tuple of hits@k and the list of all ranks in slot order, like eval.
+        """
+        snap = self.snapshot()
+        ranks = self.ranks[self.ranks > 0].tolist()
+        return snap['mrr'], tuple(snap['h@{}'.format(k)] for k in self.hitsat), ranks
+
+class RankJournal():
+    """
+    Append only on-disk log of link prediction ranks, so an interrupted evaluation can be resumed.
+    Every line holds the direction (0 for head, 1 for tail prediction), the query index and its rank.
+    """
+    def __init__(self, path: str, nq: int):
+        """
+        :param path: journal file, created if it does not exist.
+        :param nq: number of triples in the evaluated set.
+        """
+        self.path = path
+        self.nq = nq
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+    def read(self):
+        """
+        :return: (2, nq) long tensor of the journaled ranks, 0 for queries which are not done yet. Only complete,
+                 newline terminated lines count.
+        """
+        ranks = torch.zeros(2, self.nq, dtype=torch.long)
+        if not os.path.isfile(self.path):
+            return ranks
+        with open(self.path, 'rb+') as f:
+            end = 0
+            for line in f:
+                if not line.endswith(b'\n'):     # cut off by an interruption
+                    break
+                hi, idx, rank = (int(e) for e in line.split())
+                ranks[hi, idx] = rank
+                end += len(line)
+            # Drops a partial last line, so the next append starts on a line of its own.
+            f.truncate(end)
+        return ranks
+
+    def append(self, hi, qidx, ranks):
+        """
+        Journals the ranks of a batch of queries. Matches the callback of eval.
+        """
+        lines = ['{} {} {}\n'.format(hi, i, rank) for i, rank in zip(qidx.tolist(), ranks.tolist())]
+        with open(self.path, 'a') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def accumulator(self, valset, n_r: int, hitsat=[1, 3, 10]):
+        """
+        Fills a RankAccumulator with all journaled ranks.
+        :param valset: the evaluated (nq, 3) triples, for the relations.
+        """
+        ranks = self.read()
+        acc = RankAccumulator(2 * self.nq, n_r, hitsat)
+        for hi in range(2):
+            idx = torch.nonzero(ranks[hi]).view(-1)
+            if idx.size(0) > 0:
+                acc.update(ranks[hi, idx], hi * self.nq + idx, rels=valset[idx.to(valset.device), 1])
+        return acc
+
+def model_digest(model : nn.Module):
+    """
+    sha1 of the parameters and buffers of a model, identifies a checkpoint.
+    """
+    sha = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+def tensor_digest(tensor):
+    """
+    sha1 of the content of a tensor, order dependent.
+    """
+    return hashlib.sha1(tensor.detach().cpu().contiguous().numpy().tobytes()).hexdigest()
+
+def eval(model : nn.Module, valset, truedicts, n, r, batch_size=16, hitsat=[1, 3, 10], filter_candidates=True, verbose=False, elbo=True,
+         log_int=1, accumulator=None, skip=None, callback=None, candidates=None, queries=None):
     """
     Evaluates a triple scoring model. Does the sorting in a single, GPU-accelerated operation.
+    Queries which share the same base, (p, o) for head and (s, p) for tail prediction, are grouped,
+    so that the candidate scores of every unique base are computed only once and then fanned out to
+    all queries using it. Ranks are returned in the order of the valset, heads first.
     :param model:
     :param val_set:
     :param alltriples:
     :param filter:
     :param eblo: If true, use full elbo as loss. Else just the reconstruction loss.
+    :param log_int: log the running metrics to wandb every log_int batches, never if 0 or None.
+    :param accumulator: RankAccumulator with 2*len(valset) slots to collect the ranks in, to read the
+                        per relation breakdown afterwards. A new one is created if None.
+    :param skip: (2, len(valset)) bool tensor of head and tail queries which are already ranked and skipped.
+    :param queries: (q,) long tensor of the valset rows to evaluate in both directions, all rows if None.
+    :param callback: called as callback(hi, qidx, ranks) after every batch, hi is 0 for head and 1 for tail prediction.
+    :param candidates: candidate pruning, an object with a method candidates(bases, head) returning the list of entities
+                       to score per base, like DomainRangeIndex. A target outside of its candidates is ranked directly
+                       behind all scored candidates, which is an optimistic bound.
     :return:
     """
 
     rng = tqdm.trange if verbose else range
 
-    heads, tails = truedicts
-
     tforward = tfilter = tsort = 0.0
 
     tic()
-    ranks = []
-    # head = False            # TODO change this back later to do both head tail
-    for head in tqdm.tqdm([True, False], desc='LP Head, Tail', leave=True):  # head or tail prediction
-        for fr in rng(0, valset.shape[0], batch_size, desc='Validation Set', leave=True):
-            to = min(fr + batch_size, valset.shape[0])
-            wandb.log({'batch': fr, 'set_size': valset.shape[0], 'head': 1 if head else 0})
-
-            batch = valset[fr:to, :].to(device=d())
-            bn, _ = batch.size()
-
-            # compute the full score matrix (filter later)
-            bases   = batch[:, 1:] if head else batch[:, :2]
-            targets = batch[:, 0]  if head else batch[:, 2]
-
-            # collect the triples for which to compute scores
-            bexp = bases.view(bn, 1, 2).expand(bn, n, 2)
-            ar   = torch.arange(n, device=d()).view(1, n, 1).expand(bn, n, 1)
-            toscore = torch.cat([ar, bexp] if head else [bexp, ar], dim=2)
-            assert toscore.size() == (bn, n, 3)
+    nq = valset.shape[0]
+    acc = RankAccumulator(2 * nq, r, hitsat) if accumulator is None else accumulator
+    step = 0
+    valset = valset.to(device=d())
+    for hi, head in enumerate(tqdm.tqdm([True, False], desc='LP Head, Tail', leave=True)):  # head or tail prediction
+
+        pending = torch.arange(nq, device=d()) if queries is None else queries.to(d())
+        if skip is not None:
+            pending = pending[~skip[hi].to(d())[pending]]
+        if pending.size(0) == 0:
+            continue
+
+        # deduplicate the bases, queries with the same base share one row of candidate scores
+        bases = valset[pending, 1:] if head else valset[pending, :2]
+        ubases, inverse = torch.unique(bases, dim=0, return_inverse=True)
+        nu = ubases.size(0)
+        order = torch.argsort(inverse)          # pending queries grouped by base
+        offsets = torch.cat([torch.zeros(1, dtype=torch.long, device=d()),
+                             torch.cumsum(torch.bincount(inverse, minlength=nu), dim=0)])
+        prt(verbose, f'{pending.size(0)} queries share {nu} unique {"(p, o)" if head else "(s, p)"} bases.')
+
+        for fr in rng(0, nu, batch_size):
+            to = min(fr + batch_size, nu)
 
             tic()
-            scores = list()
-            for ii in rng(0, bn, 1, desc='Valset Batch', leave=False):
-                batch_scores = list()
-                for iii in rng(0, n, batch_size, desc='Batch of Batch', leave=False):
-                    tt = min(iii + batch_size, toscore.shape[1])
-                    tpg = model.n -1    # number of triples per graph
-                    sub_batch = batch_t2m(toscore[ii, iii:tt, :].squeeze(), tpg, n, r)
-                    if elbo:
-                        loss = - model.elbo(sub_batch)
-                    else:
-                        prediction = model.forward(sub_batch)
-                        loss = model.reconstruction_loss(sub_batch, prediction)
-                    batch_scores.append(loss)
-                scores.append(torch.cat(batch_scores, dim=0).unsqueeze(0))
-            scores = torch.cat(scores, dim=0).squeeze()
+            ucandidates = None if candidates is None else candidates.candidates(ubases[fr:to], head)
+            uscores = score_bases(model, ubases[fr:to], n, r, batch_size=batch_size, head=head, elbo=elbo, verbose=verbose,
+                                  candidates=ucandidates)
             tforward += toc()
-            assert scores.size() == (bn, n)
+            assert uscores.size() == (to - fr, n)
+
+            # fan the unique rows out to every query that uses them
+            sel = order[offsets[fr]:offsets[to]]
+            scores = uscores[inverse[sel] - fr]
+            qidx = pending[sel]
+
+            batch = valset[qidx, :]
+            bn, _ = batch.size()
+            targets = batch[:, 0]  if head else batch[:, 2]
 
             # filter out the true triples that aren't the target
             tic()
@@ -326,25 +921,151 @@ def eval(model : nn.Module, valset, truedicts, n, r, batch_size=16, hitsat=[1, 3
 
             # Account for ties (put the true example halfway down the ties)
             branks = raw_ranks + (num_ties - 1) // 2
-            ranks.extend((branks + 1).tolist())
-            hits_temp = []
-            for k in hitsat:
-                hits_temp.append(sum([1.0 if rank <= k else 0.0 for rank in ranks]) / len(ranks))
-                
-            wandb.log({'MRR_temp': sum([1.0/rank for rank in ranks])/len(ranks),
-                        'Hits_1_temp': hits_temp[0], 'Hits_3_temp': hits_temp[1], 'Hits_10_temp': hits_temp[2],
-                        'test_set': fr, 'head': 1 if head else 0})
-                
-    mrr = sum([1.0/rank for rank in ranks])/len(ranks)
-
-    hits = []
-    for k in hitsat:
-        hits.append(sum([1.0 if rank <= k else 0.0 for rank in ranks]) / len(ranks))
+
+            missed = None
+            if candidates is not None:
+                # the target was pruned, rank it behind all scored candidates
+                missed = torch.isneginf(true_scores)
+                branks = torch.where(missed, torch.isfinite(scores).sum(dim=1), branks)
+            acc.update(branks + 1, hi * nq + qidx, rels=batch[:, 1], missed=missed)
+            if callback is not None:
+                callback(hi, qidx, branks + 1)
+
+            step += 1
+            if log_int and step % log_int == 0:
+                snap = acc.snapshot()
+                log = {'MRR_temp': snap['mrr'], 'test_set': fr, 'set_size': nu, 'head': 1 if head else 0}
+                for k in hitsat:
+                    log['Hits_{}_temp'.format(k)] = snap['h@{}'.format(k)]
+                wandb.log(log)
+
+    mrr, hits, ranks = acc.results()
 
     # if verbose:
     #     print(f'time {toc():.4}s total, {tforward:.4}s forward, {tfilter:.4}s filtering, {tsort:.4}s sorting.')
-    wandb.log({'MRR': mrr, 'Hits_1': hits[0], 'Hits_3': hits[1], 'Hits_10': hits[2]})
-    return mrr, tuple(hits), ranks
+    if log_int:
+        wandb.log({'MRR': mrr, 'Hits_1': hits[0], 'Hits_3': hits[1], 'Hits_10': hits[2]})
+    return mrr, hits, ranks
+
+def eval_sequential(model : nn.Module, valset, truedicts, n, r, ci_width=0.05, time_budget=None, confidence=0.95, bootstrap=0,
+                    chunk=16, batch_size=16, hitsat=[1, 3, 10], elbo=True, verbose=False, seed=0, candidates=None,
+                    min_queries=100):
+    """
+    Evaluates a triple scoring model on a random subsample of the valset of adaptive size. Triples are drawn in
+    random order, chunk by chunk, until the confidence intervals of the MRR and all hits@k are narrower than
+    ci_width, the time budget runs out or the valset is exhausted. The intervals are only trusted once min_queries
+    queries are ranked.
+    :param ci_width: target width of the confidence intervals.
+    :param time_budget: maximal time in seconds, checked after every chunk.
+    :param confidence: coverage of the intervals.
+    :param bootstrap: number of bootstrap resamples for the intervals, normal approximation if 0.
+    :param chunk: number of triples drawn before the intervals are checked, every triple gives a head and a tail query.
+    :param seed: seed of the order in which the triples are drawn.
+    :param candidates: candidate pruning or retrieval, see eval.
+    :param min_queries: number of queries ranked before the evaluation may stop on the interval width.
+    :return: mrr, hits, ranks and a dict with the achieved intervals 'ci', the number of queries 'n_queries',
+             the elapsed 'time' and if the target width was reached, 'converged'.
+    """
+    nq = valset.shape[0]
+    generator = torch.Generator().manual_seed(seed)
+    perm = torch.randperm(nq, generator=generator)
+    acc = RankAccumulator(2 * nq, r, hitsat)
+    start = time.time()
+    converged = False
+    ci = acc.intervals(confidence=confidence, bootstrap=bootstrap, generator=generator)     # for an empty valset
+
+    for fr in range(0, nq, chunk):
+        eval(model, valset, truedicts, n, r, batch_size=batch_size, hitsat=hitsat, verbose=False, elbo=elbo,
+             log_int=0, accumulator=acc, candidates=candidates, queries=perm[fr:fr + chunk])
+
+        ci = acc.intervals(confidence=confidence, bootstrap=bootstrap, generator=generator)
+        width = max(hi - lo for lo, hi in ci.values())
+        prt(verbose, f'{acc.count} queries, MRR {acc.snapshot()["mrr"]:.4}, widest interval {width:.4}')
+        if width <= ci_width and acc.count >= min_queries:
+            converged = True
+            break
+        if time_budget is not None and time.time() - start > time_budget:
+            break
+
+    mrr, hits, ranks = acc.results()
+    info = {'ci': ci, 'n_queries': acc.count, 'time': time.time() - start, 'converged': converged}
+    return mrr, hits, ranks, info
+
+def eval_shard(results, w, model : nn.Module, shard, truedicts, n, r, batch_size, hitsat, elbo, threads, dtype, candidates=None):
+    """
+    Worker of eval_sharded. Evaluates one shard of the valset without logging and puts its ranks, heads first, on the queue.
+    """
+    torch.set_num_threads(threads)
+    torch.set_default_dtype(dtype)
+    with torch.no_grad():
+        model.train(False)
+        _, _, ranks = eval(model, shard, truedicts, n, r, batch_size=batch_size, hitsat=hitsat, elbo=elbo, log_int=0,
+                           candidates=candidates)
+    results.put((w, ranks))
+
+def gather_results(results, procs, poll=5.):
+    """
+    Gets one result per worker process from a multiprocessing Queue. Checks the workers every poll seconds while it waits
+    and raises if one has died, instead of blocking forever.
+    """
+    gathered = list()
+    while len(gathered) < len(procs):
+        try:
+            gathered.append(results.get(timeout=poll))
+        except queue.Empty:
+            # A worker which exited cleanly has put its result, it is only still in transit.
+            for proc in procs:
+                if proc.exitcode not in (None, 0):
+                    raise RuntimeError(f'Worker {proc.name} died with exit code {proc.exitcode}')
+    return gathered
+
+def eval_sharded(model : nn.Module, valset, truedicts, n, r, workers=2, batch_size=16, hitsat=[1, 3, 10], elbo=True, verbose=False,
+                 candidates=None):
+    """
+    Evaluates a triple scoring model with the valset split over several worker processes.
+    The model and filter index are moved to shared memory, so the workers read the same copy. The per shard ranks are
+    merged into one RankAccumulator, the metrics are exactly those of eval on the full valset.
+    Every worker gets an equal share of the torch threads, which makes it scale with the number of cores on a cpu.
+    On cpu the workers are forked, so the model is never pickled (wandb.watch hooks are not picklable), on gpu they are spawned.
+    :param workers: number of worker processes.
+    :param candidates: candidate pruning or retrieval, see eval.
+    :return: mrr, hits, ranks and the accumulator holding the per relation breakdown.
+    """
+    nq = valset.shape[0]
+    valset = valset.cpu()
+    shards = [torch.arange(w, nq, workers) for w in range(workers)]
+    threads = max(1, torch.get_num_threads() // workers)
+
+    model.share_memory()
+    if isinstance(truedicts, FilterIndex):
+        truedicts.to('cpu').share_memory()
+
+    ctx = torch.multiprocessing.get_context('spawn' if torch.cuda.is_available() else 'fork')
+    results = ctx.Queue()
+    prt(verbose, f'Evaluating {nq} triples in {workers} shards with {threads} threads each.')
+    procs = [ctx.Process(target=eval_shard, args=(results, w, model, valset[shard], truedicts, n, r, batch_size, hitsat, elbo,
+                                                  threads, torch.get_default_dtype(), candidates)) for w, shard in enumerate(shards)]
+    for proc in procs:
+        proc.start()
+    try:
+        shard_ranks = dict(gather_results(results, procs))       # collect before joining, the queue could block the workers
+    except RuntimeError:
+        for proc in procs:
+            proc.terminate()
+        raise
+    finally:
+        for proc in procs:
+            proc.join()
+
+    acc = RankAccumulator(2 * nq, r, hitsat)
+    for w, shard in enumerate(shards):
+        ranks = torch.tensor(shard_ranks[w], dtype=torch.long).view(2, -1)
+        rels = valset[shard, 1]
+        acc.update(ranks[0], shard, rels=rels)
+        acc.update(ranks[1], nq + shard, rels=rels)
+
+    mrr, hits, ranks = acc.results()
+    return mrr, hits, ranks, acc
 
 def tic():
     tics.append(time.time())